@@ -0,0 +1,262 @@
+"""
+End-to-end benchmark of the Lambda handlers against local stand-ins of AWS.
+
+Generates synthetic files, uploads them to the local S3 of local_aws and
+runs main_data_integration.lambda_handler and process_input.lambda_handler
+on them, including the invocations process_input queues for itself. For
+every file and stage it reports rows/s, peak RSS and the S3, DynamoDB, SNS
+and Lambda requests and bytes, one JSON object per line. With more than
+one parse engine, main_data_integration runs once per engine on the same
+file. Run from the lambda_functions directory:
+
+    python -m benchmarks.benchmark_end_to_end --sizes-mb 1,64,1024 --formats csv,tsv,utf-16 --engines pandas,arrow
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from benchmarks.generate_files import FILE_FORMATS, generate_file, get_columns_details
+from benchmarks.local_aws import FakeContext, LocalAWS, RequestStats, RSSSampler
+
+INPUT_RAW_BUCKET = "benchmark-input-raw-zone"
+STAGING_ZONE_BUCKET = "benchmark-staging-zone"
+ERROR_ZONE_BUCKET = "benchmark-error-zone"
+RAW_ZONE_BUCKET = "benchmark-raw-zone"
+LANDING_ZONE_BUCKET = "benchmark-landing-zone"
+RULES_TABLE = "inventory_per_district"
+DOCUMENT_KEY = "benchmark/coahuila"
+DISTRICT_KEY = "benchmark_coahuila"
+SUCCESS_TOPIC_NAME = "benchmark-success"
+FUNCTION_NAME = "process_input"
+STAGES = ["data_integration", "process_input"]
+# Stages that parse with the engine of the rules, the others run once per file
+ENGINE_STAGES = ["data_integration"]
+PARSE_ENGINES = ["pandas", "arrow"]
+
+
+def import_handlers():
+    """
+    This function imports the handlers with the environment of the benchmark.
+    They read their settings and create their clients at import time.
+    """
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    # The stand-ins answer before any request is signed, but botocore still looks the credentials up
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.update({
+        "INPUT_RAW_BUCKET": INPUT_RAW_BUCKET,
+        "STAGING_ZONE_BUCKET": STAGING_ZONE_BUCKET,
+        "ERROR_ZONE_BUCKET": ERROR_ZONE_BUCKET,
+        "RAW_ZONE_BUCKET": RAW_ZONE_BUCKET,
+        "LANDING_ZONE_BUCKET": LANDING_ZONE_BUCKET,
+        "SUCCESS_TOPIC_NAME": SUCCESS_TOPIC_NAME,
+        # The stage times are read back from the metrics the handlers print
+        "METRICS_ENABLED": "true",
+    })
+    data_integration_dir = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_integration")
+    # Appended, so the benchmarks package of data_integration does not shadow this one
+    if data_integration_dir not in sys.path:
+        sys.path.append(data_integration_dir)
+
+    import main_data_integration
+    import process_input
+    return main_data_integration, process_input
+
+
+def get_clients(main_data_integration, process_input):
+    return [main_data_integration.s3_client, main_data_integration.sns,
+            main_data_integration.dynamodb.meta.client,
+            process_input.s3_resource.meta.client, process_input.lambda_client]
+
+
+def install_local_aws(local_aws, main_data_integration, process_input):
+    from checkpoints import InMemoryCheckpointStore
+
+    for client in get_clients(main_data_integration, process_input):
+        local_aws.install(client)
+    main_data_integration.rules_cache.invalidate()
+    main_data_integration.topic_arns.clear()
+    process_input.checkpoint_store = InMemoryCheckpointStore()
+
+
+def put_rules(local_aws, file_format, width, parse_engine="pandas"):
+    extension, encoding, delimiter, _ = FILE_FORMATS[file_format]
+    local_aws.dynamodb.create_table(RULES_TABLE, "document_key")
+    local_aws.dynamodb.put(RULES_TABLE, {
+        "document_key": DOCUMENT_KEY,
+        "files": {"inventory": {
+            "file_name_regex": rf"^\d{{8}}_inventory\.{extension}$",
+            "district_key": DISTRICT_KEY,
+            "output_base_file_name": "inventory",
+        }},
+    })
+    local_aws.dynamodb.put(RULES_TABLE, {
+        "document_key": DISTRICT_KEY,
+        "validation_rules": {
+            "file_extension": extension,
+            "encoding": encoding,
+            "delimiter": delimiter,
+            "columns_count": width,
+            "columns_details": get_columns_details(width),
+            "parse_engine": parse_engine,
+            "date_details": {"source_date": {"date_regex": r"\d{8}", "date_format": "%Y%m%d"}},
+        },
+    })
+
+
+def get_s3_event(key, **extra):
+    return {"Records": [{"s3": {"bucket": {"name": INPUT_RAW_BUCKET},
+                                "object": {"key": key}}}], **extra}
+
+
+def run_data_integration(main_data_integration, process_input, local_aws, key, file_format):
+    main_data_integration.lambda_handler(get_s3_event(key), None)
+    return 1
+
+
+def run_process_input(main_data_integration, process_input, local_aws, key, file_format):
+    """
+    This function runs process_input on a file and then every invocation it
+    queues, one after the other, until the queue is empty.
+    """
+    _, encoding, delimiter, _ = FILE_FORMATS[file_format]
+    invocations = [(FUNCTION_NAME, get_s3_event(key, encoding=encoding, delimiter=delimiter))]
+    invocations_count = 0
+    while invocations:
+        for function_name, event in invocations:
+            process_input.lambda_handler(event, FakeContext(function_name))
+            invocations_count += 1
+        invocations = local_aws.lambda_.pop_invocations()
+    return invocations_count
+
+
+def get_stage_ms(output):
+    """
+    This function adds up the stage times of the metric lines of the handlers,
+    one per invocation.
+    """
+    stage_ms = {}
+    for line in output.splitlines():
+        if not line.startswith('{"_aws"'):
+            continue
+        for name, value in json.loads(line).items():
+            if name.endswith("_ms") and name != "invocation_ms":
+                stage_ms[name[:-len("_ms")]] = round(stage_ms.get(name[:-len("_ms")], 0) + value, 3)
+    return stage_ms
+
+
+STAGE_RUNNERS = {"data_integration": run_data_integration, "process_input": run_process_input}
+
+
+def run_stage(stage, handlers, local_aws, key, file_format, rows, rss_sampler):
+    stats_before = local_aws.stats.snapshot()
+    rss_sampler.reset()
+    start = time.perf_counter()
+    error = None
+    # The handlers print every batch, which would flood the report
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            invocations = STAGE_RUNNERS[stage](*handlers, local_aws, key, file_format)
+        except Exception as exception:
+            invocations, error = None, repr(exception)
+    seconds = time.perf_counter() - start
+    requests = RequestStats.diff(local_aws.stats.snapshot(), stats_before)
+    s3_requests = {operation: stats for operation, stats in requests.items()
+                   if operation.startswith("s3.")}
+    return {
+        "stage": stage,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        "peak_rss_bytes": rss_sampler.peak_bytes,
+        "invocations": invocations,
+        "s3_requests": sum(stats["requests"] for stats in s3_requests.values()),
+        "s3_bytes_read": sum(stats["bytes_out"] for stats in s3_requests.values()),
+        "s3_bytes_written": sum(stats["bytes_in"] for stats in s3_requests.values()),
+        "stage_ms": get_stage_ms(output.getvalue()),
+        "requests": requests,
+        # A rejected file is not an exception of the handler, only its output tells
+        "staging_objects": len(local_aws.s3.list_keys(STAGING_ZONE_BUCKET)),
+        "error_zone_objects": len(local_aws.s3.list_keys(ERROR_ZONE_BUCKET)),
+        "raw_zone_objects": len(local_aws.s3.list_keys(RAW_ZONE_BUCKET)),
+        "landing_zone_objects": len(local_aws.s3.list_keys(LANDING_ZONE_BUCKET)),
+        "error": error,
+    }
+
+
+def run_case(handlers, size_mb, file_format, width, stages, rss_sampler, parse_engines=("pandas",)):
+    """
+    This function benchmarks every stage on one generated file, with a new
+    local AWS so the request counts of a case never mix with another one.
+    The stages of ENGINE_STAGES run once per parse engine.
+    """
+    with tempfile.TemporaryDirectory() as root_dir:
+        local_aws = LocalAWS(root_dir)
+        install_local_aws(local_aws, *handlers)
+        try:
+            local_aws.sns.create_topic(SUCCESS_TOPIC_NAME)
+
+            extension = FILE_FORMATS[file_format][0]
+            path = os.path.join(root_dir, f"input.{extension}")
+            rows = generate_file(path, int(size_mb * 1024 * 1024), width, file_format)
+            key = f"{DOCUMENT_KEY}/20230115_inventory.{extension}"
+            local_aws.s3.put_file(INPUT_RAW_BUCKET, key, path)
+
+            case = {"format": file_format, "size_bytes": os.path.getsize(path),
+                    "width": width, "rows": rows}
+            results = []
+            for i, parse_engine in enumerate(parse_engines):
+                put_rules(local_aws, file_format, width, parse_engine)
+                handlers[0].rules_cache.invalidate()
+                for stage in stages:
+                    if stage not in ENGINE_STAGES and i > 0:
+                        continue
+                    result = run_stage(stage, handlers, local_aws, key, file_format, rows, rss_sampler)
+                    engine = parse_engine if stage in ENGINE_STAGES else None
+                    results.append({**case, "engine": engine, **result})
+            return results
+        finally:
+            for client in get_clients(*handlers):
+                local_aws.uninstall(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes-mb", default="1,64",
+                        help="comma separated sizes of the generated files, in MB")
+    parser.add_argument("--formats", default="csv,tsv,utf-16",
+                        help=f"comma separated formats, of {sorted(FILE_FORMATS)}")
+    parser.add_argument("--width", type=int, default=10, help="number of columns of the files")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"comma separated stages, of {STAGES}")
+    parser.add_argument("--engines", default="pandas",
+                        help=f"comma separated parse engines of main_data_integration, of {PARSE_ENGINES}")
+    parser.add_argument("--output", help="file to append the JSON lines to, instead of stdout")
+    args = parser.parse_args()
+
+    handlers = import_handlers()
+    environment = {"python": platform.python_version(), "machine": platform.machine(),
+                   "timestamp": int(time.time())}
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        with RSSSampler() as rss_sampler:
+            for file_format in args.formats.split(","):
+                for size_mb in args.sizes_mb.split(","):
+                    for result in run_case(handlers, float(size_mb), file_format, args.width,
+                                           args.stages.split(","), rss_sampler, args.engines.split(",")):
+                        output.write(json.dumps({**environment, **result}) + "\n")
+                        output.flush()
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Generators of synthetic inventory files for the benchmarks.
+
+Every file has the zona, frame and fecha columns of the inventory files and
+width - 3 extra columns, alternating strings and integers. Files are written
+in blocks, so files of several GB can be generated with little memory.
+"""
+import codecs
+
+import numpy as np
+import pandas as pd
+
+# extension, encoding, field delimiter and line terminator of every format
+FILE_FORMATS = {
+    "csv": ("csv", "utf-8", ",", "\n"),
+    "tsv": ("tsv", "utf-8", "\t", "\n"),
+    "utf-16": ("txt", "utf-16", "|", "\r\n"),
+}
+ZONAS = ["MORELOS_MONCLOVA", "RIO_SABINAS", "CARBONIFERA", "CENTRO", "NORTE"]
+BLOCK_ROWS = 50000
+
+
+def get_columns(width):
+    columns = [("ZONA", "string"), ("FRAME", "int64"), ("FECHA", "date")]
+    for i in range(4, max(width, 3) + 1):
+        columns.append((f"COL_{i}", "string" if i % 2 == 0 else "int64"))
+    return columns
+
+
+def get_columns_details(width):
+    """
+    This function returns the columns_details of the validation rules of the generated files.
+    """
+    columns_details = []
+    for header, data_type in get_columns(width):
+        col = {"header": header.lower(), "data_type": data_type}
+        if header == "FRAME":
+            col.update({"min": 0, "max": 200})
+        if data_type == "date":
+            col["date_format"] = "%Y%m%d"
+        columns_details.append(col)
+    return columns_details
+
+
+def generate_block(rows, width, rng):
+    dates = pd.date_range("2022-01-01", periods=365).strftime("%Y%m%d").to_numpy()
+    data = {}
+    for header, data_type in get_columns(width):
+        if header == "ZONA":
+            data[header] = rng.choice(ZONAS, rows)
+        elif header == "FRAME":
+            data[header] = rng.integers(0, 201, rows)
+        elif header == "FECHA":
+            data[header] = rng.choice(dates, rows)
+        elif data_type == "string":
+            data[header] = np.char.add("val_", rng.integers(0, 1000, rows).astype(str))
+        else:
+            data[header] = rng.integers(0, 1000000, rows)
+    return pd.DataFrame(data)
+
+
+def generate_file(path, size_bytes, width=10, file_format="csv", seed=0):
+    """
+    This function writes a file of about size_bytes bytes, with at least one data row.
+
+    Returns:
+        int: The number of data rows of the file.
+    """
+    _, encoding, delimiter, line_terminator = FILE_FORMATS[file_format]
+    rng = np.random.default_rng(seed)
+    # The incremental encoder writes the BOM of utf-16 only once
+    encoder = codecs.getincrementalencoder(encoding)()
+    header = delimiter.join(header for header, _ in get_columns(width)) + line_terminator
+    rows = 0
+    with open(path, "wb") as file_object:
+        written = file_object.write(encoder.encode(header))
+        while written < size_bytes or rows == 0:
+            block = generate_block(BLOCK_ROWS, width, rng).to_csv(
+                header=False, index=False, sep=delimiter, lineterminator=line_terminator)
+            data = encoder.encode(block)
+            lines = block.split(line_terminator)[:-1]
+            if written + len(data) > size_bytes:
+                # Only the rows that fit in the target size
+                lines = lines[:max(1, len(lines) * (size_bytes - written) // len(data))]
+                data = encoder.encode(line_terminator.join(lines) + line_terminator)
+            written += file_object.write(data)
+            rows += len(lines)
+    return rows
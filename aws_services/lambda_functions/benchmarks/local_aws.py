@@ -0,0 +1,510 @@
+"""
+In-process stand-ins for the S3, DynamoDB, SNS and Lambda APIs used by the handlers.
+
+install() registers the stand-in on the botocore event hooks of a client,
+so the calls of the handlers, and of boto3 resources built on the client,
+are answered locally instead of being sent to AWS. Only the operations and
+parameters the handlers use are supported. Every call is counted, with the
+bytes sent to and received from the stand-in, in RequestStats.
+"""
+import copy
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+# Parameters are captured after the handlers of the resources, which are
+# registered for the service and run first, so DynamoDB keys and items always
+# reach the stand-in as typed attribute values, as with the client API
+PARAMS_CONTEXT_KEY = "local_aws_params"
+
+
+class LocalAWSError(Exception):
+
+    def __init__(self, status_code, code, message=""):
+        super().__init__(f"{code}: {message}")
+        self.status_code = status_code
+        self.code = code
+        self.message = message
+
+
+class RequestStats:
+    """
+    Number of requests and bytes per service and operation.
+    bytes_in are the bytes of the request bodies, bytes_out the bytes of the
+    response bodies.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def record(self, service_name, operation_name, bytes_in=0, bytes_out=0):
+        with self.lock:
+            stats = self.operations.setdefault(
+                f"{service_name}.{operation_name}", {"requests": 0, "bytes_in": 0, "bytes_out": 0})
+            stats["requests"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+
+    def snapshot(self):
+        with self.lock:
+            return copy.deepcopy(self.operations)
+
+    @staticmethod
+    def diff(after, before):
+        """
+        This function returns the requests and bytes recorded between two snapshots.
+        """
+        operations = {}
+        for operation, stats in after.items():
+            previous = before.get(operation, {})
+            delta = {name: value - previous.get(name, 0) for name, value in stats.items()}
+            if delta["requests"]:
+                operations[operation] = delta
+        return operations
+
+
+class FileRangeReader(io.RawIOBase):
+    """
+    Reads at most length bytes of a file from offset.
+    """
+
+    def __init__(self, path, offset, length):
+        self.file_object = open(path, "rb")
+        self.file_object.seek(offset)
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            self.file_object.close()
+            return 0
+        data = self.file_object.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.file_object.close()
+        super().close()
+
+
+def get_body_size(body):
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    return None
+
+
+def read_body(body):
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    return body.read()
+
+
+class LocalS3:
+    """
+    S3 stand-in that keeps the objects in files under root_dir, so objects
+    of several GB do not have to fit in memory. ETags are random, they only
+    change when an object is written.
+    """
+
+    def __init__(self, root_dir, stats):
+        self.root_dir = root_dir
+        self.stats = stats
+        self.objects = {}
+        self.uploads = {}
+        self.upload_metadata = {}
+        self.lock = threading.Lock()
+
+    def get_path(self):
+        return os.path.join(self.root_dir, uuid.uuid4().hex)
+
+    def put_file(self, bucket_name, key, path, metadata=None):
+        """
+        This function stores an existing file as an object, without copying it.
+        """
+        with self.lock:
+            self.objects[(bucket_name, key)] = {
+                "path": path, "size": os.path.getsize(path), "ETag": f'"{uuid.uuid4().hex}"',
+                "LastModified": datetime.now(timezone.utc), "Metadata": dict(metadata or {})}
+
+    def read(self, bucket_name, key):
+        with open(self.get_object_item(bucket_name, key)["path"], "rb") as file_object:
+            return file_object.read()
+
+    def list_keys(self, bucket_name, prefix=""):
+        return sorted(key for bucket, key in self.objects
+                      if bucket == bucket_name and key.startswith(prefix))
+
+    def get_object_item(self, bucket_name, key):
+        item = self.objects.get((bucket_name, key))
+        if item is None:
+            raise LocalAWSError(404, "NoSuchKey", key)
+        return item
+
+    def write(self, bucket_name, key, body, metadata=None):
+        path = self.get_path()
+        with open(path, "wb") as file_object:
+            file_object.write(read_body(body))
+        self.put_file(bucket_name, key, path, metadata)
+        return os.path.getsize(path)
+
+    def get_copy_source_item(self, CopySource, CopySourceIfMatch=None):
+        if isinstance(CopySource, str):
+            source_bucket, source_key = CopySource.split("/", 1)
+        else:
+            source_bucket, source_key = CopySource["Bucket"], CopySource["Key"]
+        item = self.get_object_item(source_bucket, source_key)
+        if CopySourceIfMatch is not None and CopySourceIfMatch != item["ETag"]:
+            raise LocalAWSError(412, "PreconditionFailed", source_key)
+        return item
+
+    def HeadObject(self, Bucket, Key, **kwargs):
+        item = self.get_object_item(Bucket, Key)
+        self.stats.record("s3", "HeadObject")
+        return {"ContentLength": item["size"], "ETag": item["ETag"],
+                "LastModified": item["LastModified"], "Metadata": dict(item["Metadata"])}
+
+    def GetObject(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        item = self.get_object_item(Bucket, Key)
+        if IfMatch is not None and IfMatch != item["ETag"]:
+            raise LocalAWSError(412, "PreconditionFailed", Key)
+        size = item["size"]
+        start, end = 0, size - 1
+        response = {}
+        if Range is not None:
+            range_start, range_end = Range.replace("bytes=", "").split("-")
+            start = int(range_start)
+            end = min(int(range_end), size - 1) if range_end else size - 1
+            if start >= size:
+                raise LocalAWSError(416, "InvalidRange", Range)
+            response["ContentRange"] = f"bytes {start}-{end}/{size}"
+        length = max(end - start + 1, 0)
+        self.stats.record("s3", "GetObject", bytes_out=length)
+        body = io.BufferedReader(FileRangeReader(item["path"], start, length))
+        response.update({"Body": StreamingBody(body, length), "ContentLength": length,
+                         "ETag": item["ETag"], "LastModified": item["LastModified"]})
+        return response
+
+    def PutObject(self, Bucket, Key, Body=b"", Metadata=None, **kwargs):
+        size = self.write(Bucket, Key, Body, Metadata)
+        self.stats.record("s3", "PutObject", bytes_in=size)
+        return {"ETag": self.objects[(Bucket, Key)]["ETag"]}
+
+    def CopyObject(self, Bucket, Key, CopySource, CopySourceIfMatch=None, Metadata=None, MetadataDirective="COPY", **kwargs):
+        item = self.get_copy_source_item(CopySource, CopySourceIfMatch)
+        if MetadataDirective != "REPLACE":
+            Metadata = item["Metadata"]
+        path = self.get_path()
+        shutil.copyfile(item["path"], path)
+        self.put_file(Bucket, Key, path, Metadata)
+        self.stats.record("s3", "CopyObject")
+        return {"CopyObjectResult": {"ETag": self.objects[(Bucket, Key)]["ETag"]}}
+
+    def CreateMultipartUpload(self, Bucket, Key, Metadata=None, **kwargs):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+            self.upload_metadata[upload_id] = Metadata
+        self.stats.record("s3", "CreateMultipartUpload")
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def UploadPart(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        path = self.get_path()
+        with open(path, "wb") as file_object:
+            file_object.write(read_body(Body))
+        e_tag = f'"{uuid.uuid4().hex}"'
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = (path, e_tag)
+        self.stats.record("s3", "UploadPart", bytes_in=os.path.getsize(path))
+        return {"ETag": e_tag}
+
+    def UploadPartCopy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange, CopySourceIfMatch=None, **kwargs):
+        item = self.get_copy_source_item(CopySource, CopySourceIfMatch)
+        start, end = (int(value) for value in CopySourceRange.replace("bytes=", "").split("-"))
+        path = self.get_path()
+        with open(item["path"], "rb") as source_file, open(path, "wb") as file_object:
+            source_file.seek(start)
+            file_object.write(source_file.read(end - start + 1))
+        e_tag = f'"{uuid.uuid4().hex}"'
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = (path, e_tag)
+        self.stats.record("s3", "UploadPartCopy")
+        return {"CopyPartResult": {"ETag": e_tag}}
+
+    def CompleteMultipartUpload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            metadata = self.upload_metadata.pop(UploadId, None)
+        path = self.get_path()
+        with open(path, "wb") as file_object:
+            for part in MultipartUpload["Parts"]:
+                part_path, e_tag = parts[part["PartNumber"]]
+                if e_tag != part["ETag"]:
+                    raise LocalAWSError(400, "InvalidPart", str(part["PartNumber"]))
+                with open(part_path, "rb") as part_file:
+                    file_object.write(part_file.read())
+                os.remove(part_path)
+        self.put_file(Bucket, Key, path, metadata)
+        self.stats.record("s3", "CompleteMultipartUpload")
+        return {"Bucket": Bucket, "Key": Key, "ETag": self.objects[(Bucket, Key)]["ETag"]}
+
+    def AbortMultipartUpload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            parts = self.uploads.pop(UploadId, {})
+            self.upload_metadata.pop(UploadId, None)
+        for part_path, _ in parts.values():
+            os.remove(part_path)
+        self.stats.record("s3", "AbortMultipartUpload")
+        return {}
+
+    def ListObjectsV2(self, Bucket, Prefix="", **kwargs):
+        self.stats.record("s3", "ListObjectsV2")
+        return {"IsTruncated": False, "KeyCount": len(self.list_keys(Bucket, Prefix)),
+                "Contents": [{"Key": key, "Size": self.objects[(Bucket, key)]["size"],
+                              "ETag": self.objects[(Bucket, key)]["ETag"]}
+                             for key in self.list_keys(Bucket, Prefix)]}
+
+    def DeleteObjects(self, Bucket, Delete, **kwargs):
+        with self.lock:
+            for s3_object in Delete["Objects"]:
+                self.objects.pop((Bucket, s3_object["Key"]), None)
+        self.stats.record("s3", "DeleteObjects")
+        return {}
+
+
+class LocalDynamoDB:
+    """
+    DynamoDB stand-in for the reads and writes of whole items. Condition
+    and update expressions are not supported; the checkpoint and dedup
+    stores have their own in-memory implementations for that.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.tables = {}
+        self.key_names = {}
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def create_table(self, table_name, *key_names):
+        self.tables[table_name] = {}
+        self.key_names[table_name] = key_names
+
+    def put(self, table_name, item):
+        key = tuple(item[name] for name in self.key_names[table_name])
+        self.tables[table_name][key] = copy.deepcopy(item)
+
+    def get_table(self, table_name):
+        if table_name not in self.tables:
+            raise LocalAWSError(400, "ResourceNotFoundException", table_name)
+        return self.tables[table_name]
+
+    def deserialize(self, attributes):
+        return {name: self.deserializer.deserialize(value) for name, value in attributes.items()}
+
+    def GetItem(self, TableName, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        key = tuple(self.deserialize(Key)[name] for name in self.key_names[TableName])
+        item = self.get_table(TableName).get(key)
+        self.stats.record("dynamodb", "GetItem")
+        if item is None:
+            return {}
+        if ProjectionExpression is not None:
+            names = [(ExpressionAttributeNames or {}).get(name.strip(), name.strip())
+                     for name in ProjectionExpression.split(",")]
+            item = {name: item[name] for name in names if name in item}
+        return {"Item": {name: self.serializer.serialize(value) for name, value in item.items()}}
+
+    def PutItem(self, TableName, Item, **kwargs):
+        if "ConditionExpression" in kwargs:
+            raise LocalAWSError(400, "ValidationException", "Condition expressions are not supported")
+        self.get_table(TableName)
+        self.put(TableName, self.deserialize(Item))
+        self.stats.record("dynamodb", "PutItem")
+        return {}
+
+
+class LocalSNS:
+
+    def __init__(self, stats, region_name):
+        self.stats = stats
+        self.region_name = region_name
+        self.topics = {}
+
+    def create_topic(self, name):
+        topic_arn = f"arn:aws:sns:{self.region_name}:000000000000:{name}"
+        self.topics[topic_arn] = []
+        return topic_arn
+
+    def ListTopics(self, NextToken=None, **kwargs):
+        self.stats.record("sns", "ListTopics")
+        return {"Topics": [{"TopicArn": topic_arn} for topic_arn in self.topics]}
+
+    def Publish(self, TopicArn, Message, **kwargs):
+        self.topics[TopicArn].append(Message)
+        self.stats.record("sns", "Publish", bytes_in=len(Message.encode("utf-8")))
+        return {"MessageId": uuid.uuid4().hex}
+
+    def PublishBatch(self, TopicArn, PublishBatchRequestEntries, **kwargs):
+        self.topics[TopicArn] += [entry["Message"] for entry in PublishBatchRequestEntries]
+        self.stats.record("sns", "PublishBatch", bytes_in=sum(
+            len(entry["Message"].encode("utf-8")) for entry in PublishBatchRequestEntries))
+        return {"Successful": [{"Id": entry["Id"], "MessageId": uuid.uuid4().hex}
+                               for entry in PublishBatchRequestEntries], "Failed": []}
+
+
+class LocalLambda:
+    """
+    Lambda stand-in that queues the asynchronous invocations, so the caller
+    decides when, and in which process, they run.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.invocations = []
+        self.lock = threading.Lock()
+
+    def Invoke(self, FunctionName, Payload=b"", InvocationType="RequestResponse", **kwargs):
+        payload = read_body(Payload)
+        with self.lock:
+            self.invocations.append((FunctionName, json.loads(payload)))
+        self.stats.record("lambda", "Invoke", bytes_in=len(payload))
+        return {"StatusCode": 202 if InvocationType == "Event" else 200}
+
+    def pop_invocations(self):
+        with self.lock:
+            invocations, self.invocations = self.invocations, []
+        return invocations
+
+
+class LocalAWS:
+
+    def __init__(self, root_dir, region_name="us-east-1"):
+        self.stats = RequestStats()
+        self.services = {
+            "s3": LocalS3(root_dir, self.stats),
+            "dynamodb": LocalDynamoDB(self.stats),
+            "sns": LocalSNS(self.stats, region_name),
+            "lambda": LocalLambda(self.stats),
+        }
+
+    @property
+    def s3(self):
+        return self.services["s3"]
+
+    @property
+    def dynamodb(self):
+        return self.services["dynamodb"]
+
+    @property
+    def sns(self):
+        return self.services["sns"]
+
+    @property
+    def lambda_(self):
+        return self.services["lambda"]
+
+    def install(self, client):
+        """
+        This function answers every call of a boto3 client with the stand-in.
+        For resources, install it on resource.meta.client.
+        """
+        events = client.meta.events
+        events.register_first("before-parameter-build", self.capture_params)
+        events.register("before-call", self.handle_call)
+
+    def uninstall(self, client):
+        events = client.meta.events
+        events.unregister("before-parameter-build", self.capture_params)
+        events.unregister("before-call", self.handle_call)
+
+    def capture_params(self, params, model, context, **kwargs):
+        if model.service_model.service_name == "dynamodb":
+            context[PARAMS_CONTEXT_KEY] = copy.deepcopy(params)
+        else:
+            context[PARAMS_CONTEXT_KEY] = dict(params)
+
+    def handle_call(self, model, context, **kwargs):
+        service = self.services[model.service_model.service_name]
+        operation = getattr(service, model.name, None)
+        status_code = 200
+        try:
+            if operation is None:
+                raise LocalAWSError(400, "NotImplemented", model.name)
+            parsed = operation(**context[PARAMS_CONTEXT_KEY])
+        except LocalAWSError as error:
+            status_code = error.status_code
+            parsed = {"Error": {"Code": error.code, "Message": error.message}}
+        parsed["ResponseMetadata"] = {"HTTPStatusCode": status_code, "HTTPHeaders": {},
+                                      "RequestId": uuid.uuid4().hex, "RetryAttempts": 0}
+        return AWSResponse("http://localhost", status_code, {}, None), parsed
+
+
+class RSSSampler:
+    """
+    Samples the resident set size of the process from a background thread
+    and keeps the peak since the last reset, so each stage of a benchmark
+    gets its own peak. Without /proc the peak is the one of the whole process.
+    """
+
+    def __init__(self, interval_seconds=0.01):
+        self.interval_seconds = interval_seconds
+        self.peak_bytes = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.reset()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def reset(self):
+        self.peak_bytes = get_rss_bytes()
+
+    def run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            self.peak_bytes = max(self.peak_bytes, get_rss_bytes())
+
+
+def get_rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+class FakeContext:
+    """
+    Lambda context of a local invocation, with the remaining time of a real timeout.
+    """
+
+    def __init__(self, function_name, timeout_ms=900000):
+        self.function_name = function_name
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
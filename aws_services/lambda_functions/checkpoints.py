@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+
+import boto3
+import botocore.exceptions
+
+CHECKPOINT_TABLE = os.getenv("CHECKPOINT_TABLE", "process_input_checkpoints")
+CHECKPOINT_TTL_DAYS = int(os.getenv("CHECKPOINT_TTL_DAYS", "7"))
+
+
+def get_job_id(bucket_name, key, e_tag, end_offset):
+    """
+    This function builds the checkpoint id of a chain of invocations.
+    A chain processes one byte range of one version of an object, so the ETag
+    and the end of the range are part of the id.
+    """
+    return f"{bucket_name}/{key}:{e_tag.strip(chr(34))}:{end_offset}"
+
+
+class DynamoDBCheckpointStore:
+    """
+    Checkpoint store backed by a DynamoDB table with job_id as partition key.
+
+    Every job keeps a single item with the end offset of the last committed
+    batch and the number of rows committed so far. A batch can only be
+    committed if it starts exactly where the previous one ended, so two
+    invocations of the same job can never commit the same batch.
+    """
+
+    def __init__(self, table_name=CHECKPOINT_TABLE, region_name=None):
+        dynamodb = boto3.resource(
+            "dynamodb", region_name=region_name or os.getenv("REGION"))
+        self.table = dynamodb.Table(table_name)
+
+    def get_committed_offset(self, job_id):
+        response = self.table.get_item(
+            Key={"job_id": job_id}, ConsistentRead=True)
+        item = response.get("Item")
+        if item is None:
+            return None
+        return int(item["committed_offset"])
+
+    def commit_batch(self, job_id, start_offset, end_offset, rows_count):
+        try:
+            self.table.update_item(
+                Key={"job_id": job_id},
+                UpdateExpression="SET committed_offset = :end, expires_at = :expires ADD rows_count :rows",
+                ConditionExpression="attribute_not_exists(committed_offset) OR committed_offset = :start",
+                ExpressionAttributeValues={
+                    ":start": start_offset,
+                    ":end": end_offset,
+                    ":rows": rows_count,
+                    ":expires": int(time.time()) + CHECKPOINT_TTL_DAYS * 24 * 3600,
+                },
+            )
+        except botocore.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+
+class InMemoryCheckpointStore:
+    """
+    Local stand-in for DynamoDBCheckpointStore, used in tests.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get_committed_offset(self, job_id):
+        item = self.items.get(job_id)
+        if item is None:
+            return None
+        return item["committed_offset"]
+
+    def commit_batch(self, job_id, start_offset, end_offset, rows_count):
+        with self.lock:
+            item = self.items.get(job_id)
+            if item is not None and item["committed_offset"] != start_offset:
+                return False
+            rows_count += item["rows_count"] if item is not None else 0
+            self.items[job_id] = {
+                "committed_offset": end_offset, "rows_count": rows_count}
+        return True
@@ -0,0 +1,151 @@
+"""
+Arrow engine of the delimited files, the alternative to pandas.read_csv.
+
+The file is parsed by the multithreaded CSV reader of pyarrow, in blocks
+of ARROW_BLOCK_SIZE bytes, with the Arrow types of the DtypePlan of the
+district. Every block stays an Arrow table up to the parquet writer: the
+row rules only see the columns they check, as pandas series, and only the
+rejected rows become a dataframe.
+
+A district selects its engine with "parse_engine" in its validation rules,
+PARSE_ENGINE by default. The Arrow reader is stricter than read_csv: a row
+with a different number of fields fails the file instead of being read.
+Quoted values may hold line breaks, like in read_csv.
+"""
+import os
+from datetime import datetime, time
+
+from aux_data_integration import get_file_dates
+from dtype_plan import set_table_column
+
+PARSE_ENGINE = os.getenv("PARSE_ENGINE", "pandas")
+PARSE_ENGINES = ["pandas", "arrow"]
+ARROW_BLOCK_SIZE = int(os.getenv("ARROW_BLOCK_SIZE_MB", "16")) * 1024 * 1024
+
+
+def get_parse_engine(validation_rules):
+    """
+    This function returns the parse engine of the validation rules of a district.
+    """
+    parse_engine = validation_rules.get("parse_engine", PARSE_ENGINE)
+    if parse_engine not in PARSE_ENGINES:
+        raise ValueError(f"Unknown parse engine {parse_engine}, expected one of {PARSE_ENGINES}")
+    return parse_engine
+
+
+def get_csv_options(dtype_plan, encoding, delimiter, column_names=None, block_size=ARROW_BLOCK_SIZE):
+    """
+    This function returns the read, parse and convert options of pyarrow.csv.
+    When column_names is given, it replaces the header line of the file.
+    Empty values are nulls in every column, and quoted values may hold line
+    breaks, like in read_csv.
+    """
+    import pyarrow.csv as pv
+
+    read_options = pv.ReadOptions(
+        use_threads=True, block_size=block_size, encoding=encoding or "utf8",
+        column_names=column_names, skip_rows=1 if column_names else 0)
+    parse_options = pv.ParseOptions(delimiter=delimiter or ",", newlines_in_values=True)
+    convert_options = pv.ConvertOptions(
+        column_types=dtype_plan.get_arrow_types(), strings_can_be_null=True)
+    return read_options, parse_options, convert_options
+
+
+def read_csv_tables(input_file, dtype_plan, encoding, delimiter, column_names=None, block_size=ARROW_BLOCK_SIZE):
+    """
+    This function reads a file as a stream of Arrow tables, one per block.
+    The next blocks are parsed by the threads of pyarrow while a table is
+    being processed.
+
+    Returns:
+        generator of pyarrow.Table
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    with pv.open_csv(input_file, *get_csv_options(
+            dtype_plan, encoding, delimiter, column_names, block_size)) as reader:
+        for batch in reader:
+            yield pa.Table.from_batches([batch])
+
+
+def read_csv_table(input_file, dtype_plan, encoding, delimiter, column_names=None):
+    """
+    This function reads a whole file as one Arrow table, its blocks are parsed in parallel.
+    """
+    import pyarrow.csv as pv
+
+    return pv.read_csv(input_file, *get_csv_options(dtype_plan, encoding, delimiter, column_names))
+
+
+def validate_table(table, row_validator, first_row=0):
+    """
+    This function splits an Arrow table into its valid and rejected rows,
+    like RowValidator.validate. Only the columns of the row rules are
+    converted to pandas, and the rejected rows are returned as a dataframe.
+
+    Parameters:
+        table (pyarrow.Table): The rows to validate.
+        row_validator (RowValidator): The validator of the file.
+        first_row (int): The 0-based row number of the first row of the table in the file.
+
+    Returns:
+        tuple: The valid rows and the rejected rows, or None if every row is valid.
+    """
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+
+    if not row_validator.row_rules:
+        return table, None
+    columns = [column_name for column_name in row_validator.columns
+               if column_name in table.column_names]
+    invalid, masks = row_validator.evaluate(table.select(columns).to_pandas())
+    if not invalid.any():
+        return table, None
+    rejected = table.filter(pa.array(invalid)).to_pandas()
+    rejected.index = pd.Index(np.flatnonzero(invalid) + first_row)
+    rejected = row_validator.add_reasons(rejected, invalid, masks)
+    return table.filter(pa.array(~invalid)), rejected
+
+
+def parse_table_date_columns(table, columns_details):
+    """
+    This function parses the date columns of an Arrow table with the date
+    format of the columns details, to timestamps in nanoseconds like parse_dates.
+    """
+    import pyarrow.compute as pc
+
+    for col in columns_details:
+        column_name = col["header"]
+        if col["data_type"] == "date" and "date_format" in col and column_name in table.column_names:
+            table = set_table_column(table, column_name, pc.strptime(
+                table[column_name], format=col["date_format"], unit="ns"))
+    return table
+
+
+def add_table_date_columns(table, date_details, file_name, output_base_file_name):
+    """
+    This function is add_date_columns for an Arrow table.
+
+    Returns:
+        tuple: The table with the date columns and the output file name.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if "parameter_date" in date_details:
+        values = table[date_details["parameter_date"]]
+        if pa.types.is_timestamp(values.type):
+            values = values.cast(pa.timestamp("ns"))
+        else:
+            values = pc.strptime(values, format="%Y-%m-%d", unit="ns")
+        table = set_table_column(table, "parameter_date", values)
+
+    source_date, file_date, output_file_name = get_file_dates(
+        date_details, file_name, output_base_file_name)
+    for column_name, value in [("source_date", source_date), ("file_date", file_date)]:
+        if value is not None:
+            scalar = pa.scalar(datetime.combine(value, time()), pa.timestamp("ns"))
+            table = set_table_column(table, column_name, pa.repeat(scalar, len(table)))
+    return table, output_file_name
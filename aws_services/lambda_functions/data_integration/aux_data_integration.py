@@ -1,9 +1,11 @@
 import re
+import csv
+import codecs
 from datetime import datetime
 
-# Packages from layers
-import cchardet
-import pandas as pd
+# Packages from layers (cchardet, numpy and pandas) are imported in the
+# functions that use them, so the Lambda cold start does not pay for them
+# on code paths that never need them.
 
 
 def validate_file_extension(file_name, expected_extension):
@@ -18,39 +20,229 @@ def validate_file_extension(file_name, expected_extension):
     return False
 
 
+# Only the first bytes of a file are used to detect its encoding
+ENCODING_SAMPLE_BYTES = 64 * 1024
+# Longest BOMs first, the UTF-32 LE BOM starts with the UTF-16 LE one
+ENCODING_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+UNICODE_ENCODINGS = {"utf-8", "utf-8-sig", "utf-16", "utf-16-le", "utf-16-be",
+                     "utf-32", "utf-32-le", "utf-32-be"}
+# Encodings that are the same for the purpose of reading a file
+ENCODING_FAMILIES = {"utf-8-sig": "utf-8", "utf-16-le": "utf-16", "utf-16-be": "utf-16",
+                     "utf-32-le": "utf-32", "utf-32-be": "utf-32"}
+
+
+def normalize_encoding(encoding):
+    """
+    This function returns the canonical name of an encoding, e.g. "cp1252" for "WINDOWS-1252".
+    """
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return encoding.lower()
+
+
+def encodings_match(detected_encoding, expected_encoding):
+    """
+    This function returns True if a file detected with detected_encoding
+    can be read with expected_encoding. ASCII content is valid in every
+    encoding that is a superset of ASCII.
+    """
+    detected_encoding = normalize_encoding(detected_encoding)
+    expected_encoding = normalize_encoding(expected_encoding)
+    if detected_encoding == "ascii":
+        return ENCODING_FAMILIES.get(expected_encoding, expected_encoding) not in {"utf-16", "utf-32"}
+    return ENCODING_FAMILIES.get(detected_encoding, detected_encoding) == \
+        ENCODING_FAMILIES.get(expected_encoding, expected_encoding)
+
+
+def strict_decode(file_bytes, encoding):
+    """
+    This function returns True if the bytes decode without errors.
+    An incomplete character at the end is allowed, since the bytes are
+    usually the first range of a bigger file.
+    """
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(file_bytes, final=False)
+    except UnicodeError:
+        # The utf-16 and utf-32 decoders raise a plain UnicodeError on bytes without a BOM
+        return False
+    return True
+
+
+def resolve_byte_order(file_bytes, encoding):
+    """
+    This function returns the codec that decodes a file starting with file_bytes.
+    The utf-16 and utf-32 codecs read the byte order from the BOM and fail
+    without it, a file without a BOM is little endian, like in
+    process_input.get_file_encoding. Other encodings are returned as is.
+    """
+    name = normalize_encoding(encoding)
+    if name not in ("utf-16", "utf-32"):
+        return encoding
+    if any(bytes(file_bytes).startswith(bom) for bom, bom_encoding in ENCODING_BOMS if bom_encoding == name):
+        return encoding
+    return name + "-le"
+
+
+def detect_encoding(file_bytes, expected_encoding):
+    """
+    This function detects the encoding of the first ENCODING_SAMPLE_BYTES of a file.
+    It checks the BOM first, then tries a strict decode with the expected
+    encoding, and only runs the statistical detection of cchardet when
+    the cheap checks are not conclusive.
+    It returns the normalized encoding and a confidence between 0 and 1.
+    """
+    file_bytes = bytes(file_bytes[:ENCODING_SAMPLE_BYTES])
+    expected_encoding = normalize_encoding(expected_encoding)
+    for bom, encoding in ENCODING_BOMS:
+        if file_bytes.startswith(bom):
+            return encoding, 1.0
+
+    if file_bytes.isascii() and encodings_match("ascii", expected_encoding):
+        return "ascii", 1.0
+
+    if strict_decode(file_bytes, expected_encoding):
+        if expected_encoding in UNICODE_ENCODINGS:
+            return expected_encoding, 1.0
+        # Single byte encodings decode almost anything, a sample that is also
+        # valid UTF-8 is much more likely to be UTF-8
+        if not strict_decode(file_bytes, "utf-8"):
+            return expected_encoding, 0.9
+
+    import cchardet
+
+    result = cchardet.detect(file_bytes)
+    if result["encoding"] is None:
+        return None, 0.0
+    return normalize_encoding(result["encoding"]), result["confidence"] or 0.0
+
+
 def validate_file_encoding(file_bytes, expected_encoding):
     """
     This function validates the encoding of a file.
     It takes the file content and the expected encoding as input and
     returns True if the file encoding matches the expected encoding.
     """
-    result = cchardet.detect(file_bytes)
-    print(f"Incoming encoding: {result}")
-    if result["encoding"].lower() == expected_encoding:
+    encoding, confidence = detect_encoding(file_bytes, expected_encoding)
+    if encoding is not None and encodings_match(encoding, expected_encoding):
         return True
+    print(
+        f"Incoming encoding: {encoding} (confidence {confidence:.2f}), expected: {expected_encoding}")
     return False
 
 
+HEADER_INVALID_CHARACTERS = re.compile(r"[^a-zA-Z0-9_ -]")
+HEADER_SEPARATORS = str.maketrans({" ": "_", "-": "_"})
+
+
+class HeaderReport:
+    """
+    Result of HeaderValidator.validate: the normalized headers of the file and
+    one dict per failed check.
+    """
+
+    def __init__(self, headers, errors):
+        self.headers = headers
+        self.errors = errors
+
+    @property
+    def valid(self):
+        return not self.errors
+
+
+class HeaderValidator:
+    """
+    Validator of the header of a file, built once per district rule set.
+
+    The header line is parsed once with the csv module, so quoted headers
+    are supported, and normalized with a precompiled regex and translate
+    table. The column names are checked with set lookups.
+    """
+
+    def __init__(self, delimiter, columns_count=None, columns_details=None):
+        self.delimiter = delimiter
+        self.columns_count = columns_count
+        self.expected_columns_names = None
+        if columns_details is not None:
+            self.expected_columns_names = {
+                col["header"] for col in columns_details}
+
+    def parse_header(self, file_content):
+        """
+        This function returns the headers of the first line of the file content.
+        """
+        # Trailing spaces, and the \r of Windows line breaks, are not part of the header
+        header_line = file_content.split("\n", 1)[0].strip()
+        return next(csv.reader([header_line], delimiter=self.delimiter), [])
+
+    def normalize(self, headers):
+        return [normalize_header(header) for header in headers]
+
+    def check_columns_count(self, headers):
+        if self.columns_count is not None and len(headers) != self.columns_count:
+            return {"check": "columns_count", "expected": self.columns_count,
+                    "found": len(headers)}
+        return None
+
+    def check_columns_names(self, headers):
+        if self.expected_columns_names is None:
+            return None
+        unexpected_columns = [header for header in headers
+                              if header.strip() not in self.expected_columns_names]
+        if unexpected_columns:
+            return {"check": "columns_names", "unexpected": unexpected_columns}
+        return None
+
+    def validate(self, file_content):
+        """
+        This function normalizes the header of the file content and runs every check on it.
+        It returns a HeaderReport with all the failures instead of stopping at the first one.
+        """
+        if self.delimiter is None:
+            return HeaderReport([], [{"check": "delimiter", "expected": "delimiter"}])
+        return self.validate_headers(self.parse_header(file_content))
+
+    def validate_headers(self, headers):
+        """
+        This function normalizes headers that are already split, such as the
+        first row of a spreadsheet, and runs every check on them.
+        """
+        headers = self.normalize(headers)
+        errors = [error for error in (self.check_columns_count(headers),
+                                      self.check_columns_names(headers))
+                  if error is not None]
+        return HeaderReport(headers, errors)
+
+
+def compile_header_validator(validation_rules):
+    """
+    This function builds the HeaderValidator of the validation rules of a district.
+    """
+    return HeaderValidator(validation_rules.get("delimiter"),
+                           validation_rules.get("columns_count"),
+                           validation_rules.get("columns_details"))
+
+
+def normalize_header(header):
+    return HEADER_INVALID_CHARACTERS.sub("", header).lstrip().translate(HEADER_SEPARATORS).lower()
+
+
 def normalize_headers(file_content, delimiter):
     """
     This function normalizes the headers of a file.
     It takes the file content and the delimiter as input and
     returns the file content with the headers normalized.
     """
-    lines = file_content.split("\n")
-    headers = lines[0].strip().split(delimiter)
-    normalized_headers = [
-        re.sub(r"[^a-zA-Z0-9_ -]", "", header)
-        .lstrip()
-        .replace(" ", "_")
-        .replace("(", "")
-        .replace(")", "")
-        .replace("-", "_")
-        .lower()
-        for header in headers
-    ]
-    lines[0] = delimiter.join(normalized_headers)
-    return "\n".join(lines)
+    validator = HeaderValidator(delimiter)
+    headers = validator.normalize(validator.parse_header(file_content))
+    _, line_break, other_lines = file_content.partition("\n")
+    return delimiter.join(headers) + line_break + other_lines
 
 
 def validate_file_number_of_columns(file_content, expected_columns_count, delimiter):
@@ -59,10 +251,8 @@ def validate_file_number_of_columns(file_content, expected_columns_count, delimi
     It takes the file content, the expected number of columns and the delimiter as input and
     returns True if the number of columns in the file matches the expected number of columns.
     """
-    columns_count = len(file_content.split("\n")[0].split(delimiter))
-    if columns_count == expected_columns_count:
-        return True
-    return False
+    validator = HeaderValidator(delimiter, columns_count=expected_columns_count)
+    return validator.check_columns_count(validator.parse_header(file_content)) is None
 
 
 def validate_file_columns_names(file_content, columns_details, delimiter):
@@ -71,42 +261,80 @@ def validate_file_columns_names(file_content, columns_details, delimiter):
     It takes the file content, the columns details and the delimiter as input and
     returns True if the names of columns in the file match the expected names of columns.
     """
-    columns_names = file_content.split("\n")[0].strip().split(delimiter)
-    expected_columns_names = [col['header'] for col in columns_details]
-    if all(header in expected_columns_names for header in columns_names):
-        return True
-    return False
+    validator = HeaderValidator(delimiter, columns_details=columns_details)
+    return validator.check_columns_names(validator.parse_header(file_content)) is None
 
 
-def add_date_columns(df, date_details, file_name, output_base_file_name):
+def parse_dates(values, date_format):
     """
-    This function adds date columns to a pandas dataframe.
-    It takes the dataframe, the date details and the file name as input and
-    returns the dataframe with additional date columns.
+    This function parses a column of dates with the given format.
+    Every distinct value is parsed only once and the result is broadcast
+    back to the rows, which is much faster on columns with repeated dates.
     """
+    import numpy as np
+    import pandas as pd
 
-    if "parameter_date" in date_details:
-        df["parameter_date"] = pd.to_datetime(
-            df[date_details["parameter_date"]], format="%Y-%m-%d")
+    codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(uniques, format=date_format, cache=True)
+    # Nulls have the code -1, which takes the trailing NaT, even when every value is null
+    dates = np.append(parsed.values.astype("datetime64[ns]"), np.datetime64("NaT", "ns")).take(codes)
+    return pd.Series(dates, index=getattr(values, "index", None))
+
+
+def get_source_date(date_details, file_name):
+    """
+    This function returns the source date of a file, taken from its name with
+    the date_regex and date_format of the source_date details.
+    """
+    source_date = re.search(
+        date_details["source_date"]["date_regex"], file_name).group()
+    return datetime.strptime(
+        source_date, date_details["source_date"]["date_format"])
 
+
+def get_file_dates(date_details, file_name, output_base_file_name):
+    """
+    This function returns the dates added to every row of a file by its date
+    details, and its output file name: the base name prefixed with the
+    source date and suffixed with the file date.
+
+    Returns:
+        tuple: The source date and the file date, or None for the dates the
+            details do not ask for, and the output file name.
+    """
+    source_date = None
+    file_date = None
     if "source_date" in date_details:
-        source_date = re.search(
-            date_details["source_date"]["date_regex"], file_name).group()
-        source_date = datetime.strptime(
-            source_date, date_details["source_date"]["date_format"])
-        df["source_date"] = source_date.strftime("%Y-%m-%d")
-        df["source_date"] = pd.to_datetime(
-            df["source_date"], format="%Y-%m-%d")
+        source_date = get_source_date(date_details, file_name).date()
         output_base_file_name = source_date.strftime(
             "%Y%m%d") + "_" + output_base_file_name
 
     if "file_date" in date_details and date_details["file_date"] == True:
-        now = datetime.now()
-        df["file_date"] = pd.to_datetime(
-            now.strftime("%Y-%m-%d"), format="%Y-%m-%d")
+        file_date = datetime.now().date()
         output_base_file_name = output_base_file_name + \
-            "_" + now.strftime("%Y%m%d")
-    output_file_name = output_base_file_name
+            "_" + file_date.strftime("%Y%m%d")
+    return source_date, file_date, output_base_file_name
+
+
+def add_date_columns(df, date_details, file_name, output_base_file_name):
+    """
+    This function adds date columns to a pandas dataframe.
+    It takes the dataframe, the date details and the file name as input and
+    returns the dataframe with additional date columns.
+    """
+    import pandas as pd
+
+    if "parameter_date" in date_details:
+        df["parameter_date"] = parse_dates(
+            df[date_details["parameter_date"]], "%Y-%m-%d")
+
+    source_date, file_date, output_file_name = get_file_dates(
+        date_details, file_name, output_base_file_name)
+    # The dates are the same for every row, so they are broadcast as typed scalars
+    if source_date is not None:
+        df["source_date"] = pd.Timestamp(source_date)
+    if file_date is not None:
+        df["file_date"] = pd.Timestamp(file_date)
     return df, output_file_name
 
 
@@ -114,13 +342,13 @@ def get_record_delimiter(file_extension, encoding):
     if file_extension == 'csv':
         return '\n'
     elif file_extension == "tsv":
-        return "\t"
+        return "\n"
     elif file_extension == 'txt':
         if encoding == 'utf-8':
             return '\n'
         elif encoding == 'utf-16':
             return '\r\n'
-    # Not sure about this one
+    # Spreadsheets are read by spreadsheets.py, they have no record delimiter
     elif file_extension == 'xls' or file_extension == 'xlsx' or file_extension == 'xlsb' or file_extension == 'xlsm':
         return '\r\n'
     else:
@@ -0,0 +1,351 @@
+"""
+Reprocessing of the files of an input raw zone prefix, e.g. after a change
+of the rules of a district.
+
+The files are listed and grouped by document key, and every group is split
+in tasks of a few files that run main_data_integration.process_file in a
+pool of processes. A task loads the rules of its document once, and each
+process keeps them in its rules cache for the next tasks of the group. Run
+from the data_integration directory, with the environment of the Lambda:
+
+    python backfill.py --prefix coahuila/ --workers 16 --max-requests-per-second 500
+
+The bucket must be the INPUT_RAW_BUCKET of the environment, the buckets of
+the other zones are derived from it.
+
+The outcome of every file is appended to the progress file, with the
+district its file name routes to and the version of the validation rules
+of that district. A run with the same progress file skips the files already
+processed or rejected with the same content (ETag) and the same version of
+the rules of their district, so a rules change reprocesses them.
+Failed files are retried. Deduplication is off
+unless --keep-dedup is given, since a backfill has to rewrite the output of
+files whose content did not change.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+BACKFILL_FILES_PER_TASK = int(os.getenv("BACKFILL_FILES_PER_TASK", "20"))
+DONE_STATUSES = {"processed", "rejected"}
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the threads of a process. acquire blocks until a
+    token is available; up to rate tokens accumulate while it is idle.
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = rate
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            # The debt is paid by waiting, inside the lock so the callers queue up
+            if self.tokens < 0:
+                self.sleep(-self.tokens / self.rate)
+
+    def install(self, client):
+        """
+        This function rate limits every request of a boto3 client, retries included.
+        """
+        client.meta.events.register("before-send", self.before_send)
+
+    def before_send(self, **kwargs):
+        self.acquire()
+
+
+def get_document_key(key):
+    # Same grouping as main_data_integration.process_batch
+    return "/".join(re.split("/", key)[:-1])
+
+
+def list_input_files(s3_client, bucket_name, prefix=""):
+    """
+    This function lists the files under a prefix, without the folder placeholders.
+
+    Returns:
+        list: The Key, Size and ETag of every object, in key order.
+    """
+    files = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for s3_object in page.get("Contents", []):
+            if s3_object["Key"].endswith("/"):
+                continue
+            files.append({"Key": s3_object["Key"], "Size": s3_object["Size"],
+                          "ETag": s3_object["ETag"]})
+    return files
+
+
+def get_rules_version(table, document_key):
+    """
+    This function reads the version of an item of the rules table, e.g. the
+    validation rules of a district, None if the item has no version.
+    """
+    response = table.get_item(
+        Key={"document_key": document_key},
+        ProjectionExpression="#version",
+        ExpressionAttributeNames={"#version": "version"})
+    version = response.get("Item", {}).get("version")
+    # DynamoDB numbers are decimals, the progress file is JSON
+    return None if version is None else int(version)
+
+
+def read_progress(progress_path):
+    """
+    This function returns the ETag, the district key and the version of its
+    rules of every file already processed or rejected. The last line of a
+    file wins, so a failure recorded after a success reprocesses it.
+    """
+    done = {}
+    if progress_path is None or not os.path.exists(progress_path):
+        return done
+    with open(progress_path) as progress_file:
+        for line in progress_file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted run may be truncated
+                continue
+            if result["status"] in DONE_STATUSES:
+                done[result["key"]] = (result["etag"], result.get("district_key"), result.get("version"))
+            else:
+                done.pop(result["key"], None)
+    return done
+
+
+def plan_tasks(files, done=None, files_per_task=BACKFILL_FILES_PER_TASK, versions=None):
+    """
+    This function groups the files by document key and splits every group in
+    tasks of at most files_per_task files. Files in done with the same ETag,
+    and the version of the rules of their district in versions, are left out.
+
+    Returns:
+        list: The (document_key, files) tuple of every task.
+    """
+    done = done or {}
+    versions = versions or {}
+    groups = {}
+    for s3_object in files:
+        document_key = get_document_key(s3_object["Key"])
+        if s3_object["Key"] in done:
+            e_tag, district_key, version = done[s3_object["Key"]]
+            if e_tag == s3_object["ETag"] and version == versions.get(district_key):
+                continue
+        groups.setdefault(document_key, []).append(s3_object)
+    tasks = []
+    for document_key, group in groups.items():
+        for i in range(0, len(group), files_per_task):
+            tasks.append((document_key, group[i:i + files_per_task]))
+    return tasks
+
+
+def init_worker(max_requests_per_second, keep_dedup):
+    """
+    This function prepares the handler module in a process of the pool.
+    """
+    import main_data_integration
+
+    if not keep_dedup:
+        main_data_integration.dedup_index = None
+    if max_requests_per_second:
+        RateLimiter(max_requests_per_second).install(main_data_integration.s3_client)
+
+
+def get_district_version(routing_index, key):
+    """
+    This function returns the district a file routes to and the version of
+    its validation rules, which are loaded in the rules cache of the process.
+
+    Returns:
+        tuple: The district key and the version, None if unknown.
+    """
+    import main_data_integration
+
+    if routing_index is None:
+        return None, None
+    district_data, _ = routing_index.route(key.rsplit("/", 1)[-1])
+    if district_data is None:
+        return None, None
+    district_key = district_data["district_key"]
+    try:
+        main_data_integration.get_rules_item(district_key, main_data_integration.compile_district_rules)
+    except Exception:
+        # process_file reports the missing rules of the file
+        return district_key, None
+    entry = main_data_integration.rules_cache.get_entry(district_key)
+    if entry is None or entry.version is None:
+        return district_key, None
+    return district_key, int(entry.version)
+
+
+def process_task(input_bucket_name, document_key, files):
+    """
+    This function processes the files of a task one after the other, so a
+    process downloads one file at a time.
+
+    Returns:
+        list: The outcome of every file, as written to the progress file.
+    """
+    import main_data_integration
+
+    results = []
+    routing_index = None
+    try:
+        routing_index = main_data_integration.get_rules_item(
+            document_key, main_data_integration.compile_district_documents)
+    except Exception as error:
+        # process_file reports the missing rules of every file
+        print(f"Could not load the rules of {document_key}: {error}")
+    for s3_object in files:
+        start = time.perf_counter()
+        district_key, version = get_district_version(routing_index, s3_object["Key"])
+        result = {"key": s3_object["Key"], "etag": s3_object["ETag"], "district_key": district_key,
+                  "version": version, "size": s3_object["Size"]}
+        try:
+            processed = main_data_integration.process_file(input_bucket_name, s3_object["Key"])
+            result["status"] = "processed" if processed else "rejected"
+        except Exception as error:
+            result.update(status="failed", error=str(error))
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        results.append(result)
+    return results
+
+
+def run_tasks(executor, input_bucket_name, tasks, max_in_flight, on_results):
+    """
+    This function submits the tasks to the executor with at most
+    max_in_flight of them queued or running, and calls on_results with the
+    results of every task as soon as it finishes.
+    """
+    pending = set()
+    for document_key, files in tasks:
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                on_results(future.result())
+        pending.add(executor.submit(process_task, input_bucket_name, document_key, files))
+    for future in wait(pending).done:
+        on_results(future.result())
+
+
+class Progress:
+    """
+    Appends the outcome of the files to the progress file and keeps the totals of the run.
+    """
+
+    def __init__(self, progress_path, total_files, clock=time.perf_counter):
+        self.progress_file = open(progress_path, "a") if progress_path else None
+        self.total_files = total_files
+        self.clock = clock
+        self.start = clock()
+        self.statuses = {}
+        self.files = 0
+        self.bytes = 0
+
+    def record(self, results):
+        for result in results:
+            if self.progress_file is not None:
+                self.progress_file.write(json.dumps(result) + "\n")
+            self.statuses[result["status"]] = self.statuses.get(result["status"], 0) + 1
+            self.files += 1
+            self.bytes += result["size"]
+            if result["status"] == "failed":
+                print(f"Failed {result['key']}: {result['error']}")
+        if self.progress_file is not None:
+            self.progress_file.flush()
+        seconds = max(self.clock() - self.start, 1e-6)
+        print(f"{self.files}/{self.total_files} files, {self.bytes / seconds / 1024 / 1024:.1f} MB/s, "
+              f"{self.statuses}", flush=True)
+
+    def close(self):
+        if self.progress_file is not None:
+            self.progress_file.close()
+
+    def get_summary(self):
+        seconds = self.clock() - self.start
+        return {"files": self.files, "bytes": self.bytes, "seconds": round(seconds, 1),
+                "statuses": self.statuses}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--bucket", default=os.getenv("INPUT_RAW_BUCKET"),
+                        help="input raw zone bucket, INPUT_RAW_BUCKET by default")
+    parser.add_argument("--prefix", default="", help="prefix of the files to reprocess")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of processes, and of files downloaded at the same time")
+    parser.add_argument("--files-per-task", type=int, default=BACKFILL_FILES_PER_TASK)
+    parser.add_argument("--max-in-flight", type=int,
+                        help="maximum number of queued and running tasks, twice the workers by default")
+    parser.add_argument("--max-requests-per-second", type=float,
+                        help="maximum number of S3 requests per second of the whole run")
+    parser.add_argument("--progress-file", default="backfill_progress.jsonl",
+                        help="file of the outcome of every file, read back to resume a run")
+    parser.add_argument("--keep-dedup", action="store_true",
+                        help="skip the files already in the deduplication index")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print the tasks that would run")
+    args = parser.parse_args()
+    if not args.bucket:
+        parser.error("--bucket or INPUT_RAW_BUCKET is required")
+
+    import main_data_integration
+
+    # process_file rejects the files of any other bucket
+    if args.bucket != main_data_integration.INPUT_RAW_BUCKET:
+        parser.error(f"--bucket {args.bucket} is not the INPUT_RAW_BUCKET of the environment, "
+                     f"{main_data_integration.INPUT_RAW_BUCKET}")
+    files = list_input_files(main_data_integration.s3_client, args.bucket, args.prefix)
+    done = read_progress(args.progress_file)
+    versions = {district_key: get_rules_version(main_data_integration.table, district_key)
+                for district_key in {district_key for _, district_key, _ in done.values()}
+                if district_key is not None}
+    tasks = plan_tasks(files, done, args.files_per_task, versions)
+    total_files = sum(len(task_files) for _, task_files in tasks)
+    print(f"{len(files)} files under {args.bucket}/{args.prefix}, {len(files) - total_files} "
+          f"already done, {total_files} files in {len(tasks)} tasks")
+    if args.dry_run:
+        groups = {}
+        for document_key, task_files in tasks:
+            group = groups.setdefault(document_key, {"files": 0, "bytes": 0})
+            group["files"] += len(task_files)
+            group["bytes"] += sum(s3_object["Size"] for s3_object in task_files)
+        for document_key, group in groups.items():
+            print(json.dumps({"document_key": document_key, **group}))
+        return
+
+    # The S3 budget is shared evenly by the processes
+    max_requests_per_second = None
+    if args.max_requests_per_second:
+        max_requests_per_second = args.max_requests_per_second / args.workers
+    progress = Progress(args.progress_file, total_files)
+    # spawn, boto3 clients and their connection pools must not be shared with forked processes
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker,
+                             initargs=(max_requests_per_second, args.keep_dedup)) as executor:
+        try:
+            run_tasks(executor, args.bucket, tasks, args.max_in_flight or 2 * args.workers,
+                      progress.record)
+        finally:
+            progress.close()
+    print(json.dumps(progress.get_summary()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of the date enrichment of add_date_columns and create_dataframe.
+
+Compares the former implementation, which formats the constant dates back to
+strings and parses every row, with the current one. Run from the
+data_integration directory:
+
+    python -m benchmarks.benchmark_date_columns --rows 2000000
+"""
+import argparse
+import re
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from aux_data_integration import add_date_columns, parse_dates
+
+DATE_DETAILS = {
+    "parameter_date": "fecha",
+    "source_date": {"date_regex": r"\d{8}", "date_format": "%Y%m%d"},
+    "file_date": True,
+}
+FILE_NAME = "20230115_acereros_inventory.csv"
+
+
+def legacy_add_date_columns(df, date_details, file_name, output_base_file_name):
+    if "parameter_date" in date_details:
+        df["parameter_date"] = pd.to_datetime(
+            df[date_details["parameter_date"]], format="%Y-%m-%d")
+    if "source_date" in date_details:
+        source_date = re.search(
+            date_details["source_date"]["date_regex"], file_name).group()
+        source_date = datetime.strptime(
+            source_date, date_details["source_date"]["date_format"])
+        df["source_date"] = source_date.strftime("%Y-%m-%d")
+        df["source_date"] = pd.to_datetime(
+            df["source_date"], format="%Y-%m-%d")
+    if "file_date" in date_details and date_details["file_date"] == True:
+        now = datetime.now()
+        df["file_date"] = pd.to_datetime(
+            now.strftime("%Y-%m-%d"), format="%Y-%m-%d")
+    return df, output_base_file_name
+
+
+def legacy_parse_dates(values, date_format):
+    return pd.to_datetime(values, format=date_format, cache=False)
+
+
+def generate_dataframe(rows, distinct_dates):
+    dates = pd.date_range("2020-01-01", periods=distinct_dates).strftime("%Y-%m-%d")
+    return pd.DataFrame({
+        "zona": np.random.choice(["MORELOS_MONCLOVA", "RIO_SABINAS"], rows),
+        "fecha": pd.Series(np.random.choice(dates, rows), dtype="string"),
+    })
+
+
+def time_it(function, df):
+    df = df.copy()
+    start = time.perf_counter()
+    function(df)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--distinct-dates", type=int, default=365)
+    parser.add_argument("--date-format", default="%Y%m%d",
+                        help="format of the date column parsed by create_dataframe")
+    args = parser.parse_args()
+
+    df = generate_dataframe(args.rows, args.distinct_dates)
+    df["raw_fecha"] = pd.to_datetime(df["fecha"]).dt.strftime(
+        args.date_format).astype("string")
+    results = {
+        "add_date_columns (legacy)": time_it(
+            lambda df: legacy_add_date_columns(df, DATE_DETAILS, FILE_NAME, "out"), df),
+        "add_date_columns": time_it(
+            lambda df: add_date_columns(df, DATE_DETAILS, FILE_NAME, "out"), df),
+        "date column parsing (legacy)": time_it(
+            lambda df: legacy_parse_dates(df["raw_fecha"], args.date_format), df),
+        "date column parsing": time_it(
+            lambda df: parse_dates(df["raw_fecha"], args.date_format), df),
+    }
+    print(f"rows: {args.rows}, distinct dates: {args.distinct_dates}")
+    for name, seconds in results.items():
+        print(f"{name}: {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
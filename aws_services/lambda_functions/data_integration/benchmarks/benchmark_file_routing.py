@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the file name routing of get_validation_rules.
+
+Compares the former linear re.match scan over every file of a document with
+FileRoutingIndex. Run from the data_integration directory:
+
+    python -m benchmarks.benchmark_file_routing --patterns 5000
+"""
+import argparse
+import random
+import re
+import time
+
+from file_routing import FileRoutingIndex
+
+
+def generate_files(patterns_count):
+    files = {}
+    for i in range(patterns_count):
+        district = f"district_{i:05d}"
+        extension = random.choice(["csv", "txt", "tsv"])
+        if i % 2:
+            regex = rf"^(.*)([0-9]{{8}})_{district}_inventory(.*)\.{extension}$"
+        else:
+            regex = rf"^{district}_inventory(.*)\.{extension}$"
+        files[district] = {"file_name_regex": regex,
+                           "district_key": district,
+                           "output_base_file_name": f"{district}_inventory",
+                           "extension": extension}
+    return files
+
+
+def generate_file_names(files, file_names_count):
+    file_names = []
+    for district_data in random.choices(list(files.values()), k=file_names_count):
+        file_names.append(
+            f"20230115_{district_data['district_key']}_inventory.{district_data['extension']}")
+    return file_names
+
+
+def linear_route(files, file_name):
+    district_data = None
+    for _, data in files.items():
+        if re.match(data["file_name_regex"], file_name):
+            district_data = data
+    return district_data
+
+
+def time_it(function, file_names):
+    start = time.perf_counter()
+    for file_name in file_names:
+        function(file_name)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--patterns", type=int, default=5000)
+    parser.add_argument("--file-names", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    files = generate_files(args.patterns)
+    file_names = generate_file_names(files, args.file_names)
+
+    start = time.perf_counter()
+    index = FileRoutingIndex(files)
+    build_time = time.perf_counter() - start
+
+    for file_name in file_names:
+        assert linear_route(files, file_name) is index.route(file_name)[0]
+
+    linear_time = time_it(lambda file_name: linear_route(files, file_name), file_names)
+    index_time = time_it(index.route, file_names)
+    print(f"patterns: {args.patterns}, file names: {args.file_names}")
+    print(f"index build: {build_time * 1000:.2f} ms")
+    print(f"linear scan: {linear_time / len(file_names) * 1e6:.1f} us/file")
+    print(f"routing index: {index_time / len(file_names) * 1e6:.1f} us/file")
+    print(f"speedup: {linear_time / index_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
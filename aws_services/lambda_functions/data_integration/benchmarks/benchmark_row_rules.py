@@ -0,0 +1,110 @@
+"""
+Benchmark of the row rules of RowValidator on synthetic data.
+
+Compares the vectorized rules with a row by row evaluation of the same rules
+in Python. The data is validated in chunks of CHUNK_SIZE_ROWS rows, as in
+create_dataframe_chunks. Run from the data_integration directory:
+
+    python -m benchmarks.benchmark_row_rules --rows 10000000
+"""
+import argparse
+import os
+import re
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from row_rules import RowValidator, compile_row_rules
+
+VALIDATION_RULES = {"columns_details": [
+    {"header": "id", "data_type": "int64", "unique": True},
+    {"header": "zona", "data_type": "string", "categorical": True,
+     "not_null": True, "regex": "[A-Z_]+"},
+    {"header": "ing", "data_type": "string", "allowed_values": ["ING1", "ING2", "ING3"]},
+    {"header": "frame", "data_type": "int64", "min": 0, "max": 200},
+    {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+]}
+# Same default as main_data_integration, which needs AWS credentials to import
+CHUNK_SIZE_ROWS = int(os.getenv("CHUNK_SIZE_ROWS", "100000"))
+ZONAS = ["MORELOS_MONCLOVA", "RIO_SABINAS", "CARBONIFERA", "centro", None]
+
+
+def generate_chunk(start, rows, rng):
+    dates = pd.date_range("2020-01-01", periods=365).strftime("%Y%m%d").tolist() + ["2023"]
+    ids = np.arange(start, start + rows)
+    # About 1% of the ids are repeated from earlier rows
+    repeated = rng.random(rows) < 0.01
+    ids[repeated] = rng.integers(0, start + 1, repeated.sum())
+    return pd.DataFrame({
+        "id": ids,
+        "zona": pd.Categorical(rng.choice(ZONAS, rows, p=[0.3, 0.3, 0.3, 0.05, 0.05])),
+        "ing": pd.array(rng.choice(["ING1", "ING2", "ING3", "ING9"], rows,
+                                   p=[0.33, 0.33, 0.33, 0.01]), dtype="string"),
+        "frame": rng.integers(0, 202, rows),
+        "fecha": pd.array(rng.choice(dates, rows), dtype="string"),
+    }, index=pd.RangeIndex(start, start + rows))
+
+
+def validate_row_by_row(chunk, seen):
+    zona_regex = re.compile("[A-Z_]+")
+    valid = []
+    for row in chunk.itertuples(index=False):
+        reasons = []
+        if row.id in seen:
+            reasons.append("unique:id")
+        seen.add(row.id)
+        if pd.isna(row.zona):
+            reasons.append("not_null:zona")
+        elif not zona_regex.fullmatch(row.zona):
+            reasons.append("regex:zona")
+        if not pd.isna(row.ing) and row.ing not in ("ING1", "ING2", "ING3"):
+            reasons.append("allowed_values:ing")
+        if not 0 <= row.frame <= 200:
+            reasons.append("range:frame")
+        try:
+            datetime.strptime(row.fecha, "%Y%m%d")
+        except ValueError:
+            reasons.append("date_format:fecha")
+        valid.append(not reasons)
+    return chunk[valid]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=10000000)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE_ROWS)
+    parser.add_argument("--row-by-row-rows", type=int, default=1000000,
+                        help="rows validated by the row by row baseline, which is much slower")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    chunks = [generate_chunk(start, min(args.chunk_size, args.rows - start), rng)
+              for start in range(0, args.rows, args.chunk_size)]
+
+    validator = RowValidator(compile_row_rules(VALIDATION_RULES))
+    start = time.perf_counter()
+    valid_rows = sum(len(validator.validate(chunk)[0]) for chunk in chunks)
+    vectorized_seconds = time.perf_counter() - start
+    print(f"rows: {args.rows}, chunk size: {args.chunk_size}")
+    print(f"vectorized rules: {vectorized_seconds * 1000:.1f} ms, "
+          f"{args.rows / vectorized_seconds:,.0f} rows/s, "
+          f"valid: {valid_rows}, rejected: {validator.rejected_rows_count}")
+
+    rows = 0
+    seen = set()
+    start = time.perf_counter()
+    for chunk in chunks:
+        if rows >= args.row_by_row_rows:
+            break
+        validate_row_by_row(chunk, seen)
+        rows += len(chunk)
+    row_by_row_seconds = time.perf_counter() - start
+    if rows:
+        print(f"row by row ({rows} rows): {row_by_row_seconds * 1000:.1f} ms, "
+              f"{rows / row_by_row_seconds:,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
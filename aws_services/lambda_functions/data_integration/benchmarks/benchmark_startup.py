@@ -0,0 +1,90 @@
+"""
+Startup benchmark of the Lambda handlers.
+
+Every handler is imported in a fresh Python process, like a Lambda cold
+start, and invoked once with an event that does not reach AWS (the
+DynamoDB lookups are stubbed). For each handler it reports the import time,
+the first invocation latency and the heavy packages loaded so far. Run from
+the data_integration directory:
+
+    python -m benchmarks.benchmark_startup --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_FUNCTIONS_DIR = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+HEAVY_MODULES = ["pandas", "numpy", "pyarrow", "cchardet"]
+
+HANDLERS = {
+    "main_data_integration": {
+        "path": os.path.join(LAMBDA_FUNCTIONS_DIR, "data_integration"),
+        "setup": "module.table.get_item = lambda **kwargs: {}",
+        "event": {"Records": [{"s3": {"bucket": {"name": "other-bucket"},
+                                      "object": {"key": "Inventory_Per_District/Coahuila/file.csv"}}}]},
+    },
+    "process_input": {
+        "path": LAMBDA_FUNCTIONS_DIR,
+        "setup": "",
+        "event": {"Records": []},
+    },
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module} as module
+imported = time.perf_counter()
+{setup}
+module.lambda_handler(json.loads(sys.argv[1]), None)
+invoked = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "first_invocation_ms": (invoked - imported) * 1000,
+    "heavy_modules": [name for name in {heavy_modules!r} if name in sys.modules],
+}}))
+"""
+
+
+def run_probe(module, handler):
+    env = {**os.environ, "AWS_DEFAULT_REGION": os.getenv("AWS_DEFAULT_REGION", "us-east-1"),
+           "INPUT_RAW_BUCKET": "input-raw-zone"}
+    code = PROBE.format(module=module, setup=handler["setup"],
+                        heavy_modules=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code, json.dumps(handler["event"])],
+                            cwd=handler["path"], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true",
+                        help="print machine readable results")
+    args = parser.parse_args()
+
+    results = {}
+    for module, handler in HANDLERS.items():
+        probes = [run_probe(module, handler) for _ in range(args.repeat)]
+        results[module] = {
+            "import_ms": statistics.median(probe["import_ms"] for probe in probes),
+            "first_invocation_ms": statistics.median(probe["first_invocation_ms"] for probe in probes),
+            "heavy_modules": probes[-1]["heavy_modules"],
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for module, result in results.items():
+        print(f"{module}: import {result['import_ms']:.1f} ms, "
+              f"first invocation {result['first_invocation_ms']:.1f} ms, "
+              f"heavy modules loaded: {result['heavy_modules'] or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
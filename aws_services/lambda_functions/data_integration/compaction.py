@@ -0,0 +1,237 @@
+"""
+Compaction of the partitioned output of the staging zone.
+
+Meant to run on a schedule as its own Lambda, with the event
+{"bucket": "<bucket>", "prefix": "<prefix>"}. Both are optional, the bucket
+defaults to STAGING_ZONE_BUCKET and the prefix to the whole bucket.
+
+The outputs are referenced by the item of their content in the
+deduplication index, by the duplicate pointers of their content and by the
+stage metadata of the copy of their input file in the landing zone. Those
+references are moved to the compacted file before the merged files are
+deleted. Outputs written without their source metadata cannot be traced to
+their references and are never compacted, nor are the compacted files,
+which have many sources: they are left out of the bins when planned, and a
+bin with fewer than COMPACTION_MIN_FILES files that can be compacted is
+not written.
+"""
+import io
+import json
+import os
+import uuid
+from datetime import datetime
+
+import botocore.exceptions
+
+import main_data_integration
+from main_data_integration import STAGING_ZONE_BUCKET, ParquetS3Writer, get_zone_bucket_name, s3_client
+from partitioning import PARQUET_DATA_PAGE_SIZE_BYTES, PARQUET_ROW_GROUP_SIZE_ROWS, is_partition_prefix
+from zones import copy_s3_object, read_output_metadata, read_stage_metadata, to_ascii
+
+COMPACTION_TARGET_SIZE_BYTES = int(os.getenv("COMPACTION_TARGET_SIZE_MB", "256")) * 1024 * 1024
+# Files at least this big are already right-sized and are never rewritten
+COMPACTION_SMALL_FILE_BYTES = int(os.getenv("COMPACTION_SMALL_FILE_MB", "64")) * 1024 * 1024
+COMPACTION_MIN_FILES = int(os.getenv("COMPACTION_MIN_FILES", "2"))
+COMPACTED_FILE_PREFIX = "compacted_"
+# delete_objects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+
+def list_partitions(bucket_name, prefix=""):
+    """
+    This function lists the parquet files of every partition under a prefix.
+
+    Returns:
+        dict: The partition path of each partition and its files, as dicts
+            with the Key and Size of the S3 objects, in key order.
+    """
+    partitions = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for s3_object in page.get("Contents", []):
+            key = s3_object["Key"]
+            if not key.endswith(".parquet") or "/" not in key:
+                continue
+            partition_prefix = key.rsplit("/", 1)[0]
+            if is_partition_prefix(partition_prefix):
+                partitions.setdefault(partition_prefix, []).append(
+                    {"Key": key, "Size": s3_object["Size"]})
+    return partitions
+
+
+def plan_compaction(files, target_size=COMPACTION_TARGET_SIZE_BYTES, small_file_size=COMPACTION_SMALL_FILE_BYTES, min_files=COMPACTION_MIN_FILES):
+    """
+    This function groups the small files of a partition into bins of at most
+    target_size bytes, in key order. Compacted files are left out, and so
+    are the bins with fewer than min_files files, not worth rewriting.
+
+    Returns:
+        list: The list of keys of each bin.
+    """
+    bins = []
+    current_bin, current_size = [], 0
+    for s3_object in files:
+        if s3_object["Size"] >= small_file_size or \
+                s3_object["Key"].rsplit("/", 1)[-1].startswith(COMPACTED_FILE_PREFIX):
+            continue
+        if current_bin and current_size + s3_object["Size"] > target_size:
+            bins.append(current_bin)
+            current_bin, current_size = [], 0
+        current_bin.append(s3_object["Key"])
+        current_size += s3_object["Size"]
+    bins.append(current_bin)
+    return [keys for keys in bins if len(keys) >= min_files]
+
+
+def read_tables(bucket_name, keys, compacted_files):
+    """
+    This function downloads the files of a bin one at a time and yields them
+    as Arrow tables. Files whose schema differs from the first one, e.g.
+    written before a change of the district rules, are skipped and left for
+    a later compaction, and so are the files without source metadata. The
+    source of every yielded table is added to compacted_files, by key.
+    """
+    import pyarrow.parquet as pq
+
+    schema = None
+    for key in keys:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+        source = read_output_metadata(response.get("Metadata", {}))
+        if source is None:
+            print(f"Skipping {key}, its references cannot be updated without its source metadata")
+            continue
+        table = pq.read_table(io.BytesIO(response["Body"].read()))
+        if schema is None:
+            schema = table.schema
+        elif not table.schema.equals(schema, check_metadata=False):
+            print(f"Skipping {key}, its schema differs from {keys[0]}")
+            continue
+        compacted_files[key] = source
+        yield table
+
+
+def delete_objects(bucket_name, keys):
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in keys[i:i + DELETE_BATCH_SIZE]],
+                    "Quiet": True})
+        if response.get("Errors"):
+            print(f"Could not delete compacted files: {response['Errors']}")
+
+
+def update_landing_metadata(landing_bucket_name, key, old_output_key, output_key):
+    """
+    This function points the landing zone copy of an input file to the new
+    output of the file, if it still points to the old one. The object is
+    copied onto itself, server side, with the updated metadata.
+    """
+    try:
+        response = s3_client.head_object(Bucket=landing_bucket_name, Key=key)
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return
+        raise
+    metadata = response.get("Metadata", {})
+    if read_stage_metadata(metadata).get("output-key") != to_ascii(old_output_key):
+        return
+    copy_s3_object(s3_client, landing_bucket_name, key, landing_bucket_name, key,
+                   {**metadata, "diavs-output-key": to_ascii(output_key)},
+                   response["ContentLength"], response.get("ETag"))
+
+
+def update_duplicate_pointer(bucket_name, pointer_key, old_output_key, output_key):
+    """
+    This function points a duplicate pointer to the new output of the file
+    it duplicates, if it still points to the old one.
+
+    Returns:
+        str: The source key of the duplicate file, or None if the pointer
+            is gone or points to another output.
+    """
+    try:
+        body = s3_client.get_object(Bucket=bucket_name, Key=pointer_key)["Body"].read()
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    pointer = json.loads(body)
+    if pointer["duplicate_of"]["output_key"] != old_output_key:
+        return None
+    pointer["duplicate_of"]["output_key"] = output_key
+    s3_client.put_object(
+        Bucket=bucket_name, Key=pointer_key,
+        Body=json.dumps(pointer).encode("utf-8"), ContentType="application/json",
+        Metadata={"duplicate-of": output_key})
+    return pointer["source_key"]
+
+
+def update_references(bucket_name, source, old_output_key, output_key):
+    """
+    This function moves the references to a compacted file to the file it
+    was merged into: its deduplication item, the pointers of its duplicates
+    and the landing zone copies of its input file and of the duplicates.
+    """
+    dedup_index = main_data_integration.dedup_index
+    landing_bucket_name = get_zone_bucket_name(
+        source["source-bucket"], main_data_integration.LANDING_ZONE_BUCKET)
+    landing_keys = [source["source-key"]]
+    district_key = source.get("district-key")
+    if dedup_index is not None and district_key is not None:
+        pointer_keys = dedup_index.get_duplicates(district_key, old_output_key)
+        for pointer_key in pointer_keys:
+            duplicate_key = update_duplicate_pointer(bucket_name, pointer_key, old_output_key, output_key)
+            if duplicate_key is not None:
+                landing_keys.append(duplicate_key)
+        if pointer_keys:
+            dedup_index.add_duplicates(district_key, output_key, pointer_keys)
+            dedup_index.delete_duplicates(district_key, old_output_key)
+        if "content-hash" in source:
+            dedup_index.replace_output_key(
+                district_key, source["content-hash"], old_output_key, output_key)
+    if landing_bucket_name is not None:
+        for key in landing_keys:
+            update_landing_metadata(landing_bucket_name, key, old_output_key, output_key)
+
+
+def compact_files(bucket_name, partition_prefix, keys, min_files=COMPACTION_MIN_FILES):
+    """
+    This function merges the files of a bin into a new file of the same
+    partition, moves the references to them to the new file and then
+    deletes them. The new file is written before the old ones are deleted,
+    so a failure never loses rows, but a reader listing the partition in
+    between can see them twice. When fewer than min_files files of the bin
+    can be compacted, the new file is discarded and nothing is deleted.
+
+    Returns:
+        list: The keys of the files merged into the new file.
+    """
+    compacted_files = {}
+    output_prefix = (f"{partition_prefix}/{COMPACTED_FILE_PREFIX}{datetime.utcnow():%Y%m%d%H%M%S}"
+                     f"_{uuid.uuid4().hex[:8]}")
+    with ParquetS3Writer(bucket_name, output_prefix + ".parquet", row_group_size=PARQUET_ROW_GROUP_SIZE_ROWS,
+                         data_page_size=PARQUET_DATA_PAGE_SIZE_BYTES) as writer:
+        for table in read_tables(bucket_name, keys, compacted_files):
+            writer.write(table)
+        if len(compacted_files) < min_files:
+            writer.abort()
+            print(f"Skipping {partition_prefix}, {len(compacted_files)} of its {len(keys)} files "
+                  f"can be compacted")
+            return []
+    for key, source in compacted_files.items():
+        update_references(bucket_name, source, key, output_prefix + ".parquet")
+    compacted_keys = list(compacted_files)
+    delete_objects(bucket_name, compacted_keys)
+    print(f"Compacted {len(compacted_keys)} files into {output_prefix}.parquet")
+    return compacted_keys
+
+
+def lambda_handler(event, context):
+    bucket_name = event.get("bucket", STAGING_ZONE_BUCKET)
+    partitions = list_partitions(bucket_name, event.get("prefix", ""))
+    compacted_files_count = 0
+    for partition_prefix, files in partitions.items():
+        for keys in plan_compaction(files):
+            compacted_files_count += len(compact_files(
+                bucket_name, partition_prefix, keys))
+    return {"partitions": len(partitions), "compacted_files": compacted_files_count}
@@ -0,0 +1,203 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+import botocore.exceptions
+
+DEDUP_TABLE = os.getenv("DEDUP_TABLE")
+DEDUP_RETENTION_DAYS = int(os.getenv("DEDUP_RETENTION_DAYS", "30"))
+DEDUP_MAX_ITEMS = int(os.getenv("DEDUP_MAX_ITEMS", "10000"))
+# When false, objects without a usable checksum are keyed by their multipart
+# ETag instead of being downloaded to be hashed
+DEDUP_STREAM_HASH = os.getenv("DEDUP_STREAM_HASH", "false").lower() == "true"
+HASH_READ_SIZE = 8 * 1024 * 1024
+# Sort key prefix of the items that list the duplicate pointers of an output.
+# They have no expires_at, the pointers outlive the item of their content hash.
+DUPLICATES_PREFIX = "duplicates#"
+
+
+def get_content_hash(s3_client, bucket_name, key, stream_hash=DEDUP_STREAM_HASH):
+    """
+    This function returns a key that identifies the content of an S3 object.
+
+    The key is taken from the object metadata whenever possible, so the object
+    is not downloaded:
+        - the full object SHA-256 checksum, if the object was uploaded with one.
+        - the ETag of objects uploaded in a single part, which is their MD5.
+    Multipart ETags depend on the part size of the upload, so with stream_hash
+    the object is hashed with SHA-256 while it is downloaded, and otherwise
+    the ETag itself is used, which only matches the same upload layout.
+    """
+    response = s3_client.head_object(
+        Bucket=bucket_name, Key=key, ChecksumMode="ENABLED")
+    # Checksums of multipart uploads are checksums of the parts, like their ETags
+    checksum = response.get("ChecksumSHA256")
+    if checksum and "-" not in checksum:
+        return f"sha256:{checksum}"
+    e_tag = response["ETag"].strip('"')
+    if "-" not in e_tag:
+        return f"md5:{e_tag}"
+    if not stream_hash:
+        return f"etag:{e_tag}"
+
+    body = s3_client.get_object(
+        Bucket=bucket_name, Key=key, IfMatch=response["ETag"])["Body"]
+    content_hash = hashlib.sha256()
+    for chunk in iter(lambda: body.read(HASH_READ_SIZE), b""):
+        content_hash.update(chunk)
+    return f"sha256-hex:{content_hash.hexdigest()}"
+
+
+class DynamoDBDedupIndex:
+    """
+    Index of the files already processed, backed by a DynamoDB table with
+    district_key as partition key and content_hash as sort key.
+
+    Every item points to the source and output objects of the first file
+    processed with that content. Items expire after DEDUP_RETENTION_DAYS
+    through the DynamoDB TTL of expires_at; since the TTL deletion is lazy,
+    expired items are also ignored on read.
+
+    The keys of the duplicate pointers of an output are kept in an item of
+    their own, so compaction can rewrite them when the output is moved.
+    """
+
+    def __init__(self, table_name=DEDUP_TABLE, region_name=None, retention_days=DEDUP_RETENTION_DAYS, config=None):
+        dynamodb = boto3.resource(
+            "dynamodb", region_name=region_name or os.getenv("REGION"), config=config)
+        self.table = dynamodb.Table(table_name)
+        self.retention_seconds = retention_days * 24 * 3600
+        # boto3 resources are not thread safe
+        self.lock = threading.Lock()
+
+    def get(self, district_key, content_hash):
+        with self.lock:
+            response = self.table.get_item(
+                Key={"district_key": district_key, "content_hash": content_hash})
+        item = response.get("Item")
+        if item is None or int(item["expires_at"]) <= time.time():
+            return None
+        return item
+
+    def put(self, district_key, content_hash, source_key, output_key):
+        """
+        This function records a processed file. It returns False if the
+        content was already recorded by another invocation.
+        """
+        try:
+            with self.lock:
+                self.table.put_item(
+                    Item={
+                        "district_key": district_key,
+                        "content_hash": content_hash,
+                        "source_key": source_key,
+                        "output_key": output_key,
+                        "expires_at": int(time.time()) + self.retention_seconds,
+                    },
+                    ConditionExpression="attribute_not_exists(content_hash) OR expires_at <= :now",
+                    ExpressionAttributeValues={":now": int(time.time())},
+                )
+        except botocore.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def replace_output_key(self, district_key, content_hash, old_output_key, output_key):
+        """
+        This function points the item of a content to the new output of its
+        file. It returns False if the item is gone or points to another output.
+        """
+        try:
+            with self.lock:
+                self.table.update_item(
+                    Key={"district_key": district_key, "content_hash": content_hash},
+                    UpdateExpression="SET output_key = :output_key",
+                    ConditionExpression="output_key = :old_output_key",
+                    ExpressionAttributeValues={":output_key": output_key,
+                                               ":old_output_key": old_output_key})
+        except botocore.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def add_duplicates(self, district_key, output_key, pointer_keys):
+        with self.lock:
+            self.table.update_item(
+                Key={"district_key": district_key, "content_hash": DUPLICATES_PREFIX + output_key},
+                UpdateExpression="ADD pointer_keys :pointer_keys",
+                ExpressionAttributeValues={":pointer_keys": set(pointer_keys)})
+
+    def get_duplicates(self, district_key, output_key):
+        """
+        This function returns the keys of the duplicate pointers of an output.
+        """
+        with self.lock:
+            response = self.table.get_item(
+                Key={"district_key": district_key, "content_hash": DUPLICATES_PREFIX + output_key})
+        return sorted(response.get("Item", {}).get("pointer_keys", []))
+
+    def delete_duplicates(self, district_key, output_key):
+        with self.lock:
+            self.table.delete_item(
+                Key={"district_key": district_key, "content_hash": DUPLICATES_PREFIX + output_key})
+
+
+class InMemoryDedupIndex:
+    """
+    Local stand-in for DynamoDBDedupIndex, used in tests. Besides the
+    retention, it keeps at most max_items items, evicting the oldest ones.
+    """
+
+    def __init__(self, retention_days=DEDUP_RETENTION_DAYS, max_items=DEDUP_MAX_ITEMS, clock=time.time):
+        self.retention_seconds = retention_days * 24 * 3600
+        self.max_items = max_items
+        self.clock = clock
+        self.items = OrderedDict()
+        self.duplicates = {}
+        self.lock = threading.Lock()
+
+    def get(self, district_key, content_hash):
+        item = self.items.get((district_key, content_hash))
+        if item is None or item["expires_at"] <= self.clock():
+            return None
+        return item
+
+    def put(self, district_key, content_hash, source_key, output_key):
+        with self.lock:
+            if self.get(district_key, content_hash) is not None:
+                return False
+            self.items[(district_key, content_hash)] = {
+                "district_key": district_key,
+                "content_hash": content_hash,
+                "source_key": source_key,
+                "output_key": output_key,
+                "expires_at": self.clock() + self.retention_seconds,
+            }
+            self.items.move_to_end((district_key, content_hash))
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return True
+
+    def replace_output_key(self, district_key, content_hash, old_output_key, output_key):
+        with self.lock:
+            item = self.items.get((district_key, content_hash))
+            if item is None or item["output_key"] != old_output_key:
+                return False
+            item["output_key"] = output_key
+        return True
+
+    def add_duplicates(self, district_key, output_key, pointer_keys):
+        with self.lock:
+            self.duplicates.setdefault((district_key, output_key), set()).update(pointer_keys)
+
+    def get_duplicates(self, district_key, output_key):
+        return sorted(self.duplicates.get((district_key, output_key), ()))
+
+    def delete_duplicates(self, district_key, output_key):
+        with self.lock:
+            self.duplicates.pop((district_key, output_key), None)
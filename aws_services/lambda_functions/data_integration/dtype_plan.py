@@ -0,0 +1,177 @@
+import os
+
+STRING_STORAGE = os.getenv("STRING_STORAGE", "pyarrow")
+INTEGER_TYPES = ["int8", "int16", "int32", "int64"]
+UNSIGNED_INTEGER_TYPES = ["uint8", "uint16", "uint32", "uint64"]
+INTEGER_ALIASES = {"int", "integer"}
+FLOAT_ALIASES = {"float", "double"}
+
+
+def get_smallest_integer_type(minimum, maximum):
+    """
+    This function returns the smallest numpy integer type that holds every
+    value between minimum and maximum.
+    """
+    import numpy as np
+
+    types = UNSIGNED_INTEGER_TYPES if minimum >= 0 else INTEGER_TYPES
+    for integer_type in types:
+        info = np.iinfo(integer_type)
+        if info.min <= minimum and maximum <= info.max:
+            return integer_type
+    return "int64"
+
+
+class DtypePlan:
+    """
+    Plan of the pandas dtypes used to read the columns of a district.
+
+    It is built from the columns_details of the validation rules:
+        - "categorical": true reads the column as a pandas category.
+        - string columns are read as Arrow backed strings (STRING_STORAGE).
+        - integer columns with "min" and "max" are read with their declared
+          type and downcast by apply to the smallest integer type that holds
+          the range. read_csv wraps values that overflow the dtype silently,
+          so the rows out of range must be rejected before the downcast.
+        - float columns with "downcast": true are read as float32.
+        - date columns are read as strings and parsed afterwards.
+
+    With auto_categorical_ratio, the string columns whose number of distinct
+    values in the first chunk is at most that ratio of its rows are turned
+    into categories for the whole file. The decision is taken once, so every
+    chunk of a file has the same dtypes.
+    """
+
+    def __init__(self, columns_details, string_storage=STRING_STORAGE, auto_categorical_ratio=None):
+        self.read_dtypes = {}
+        self.downcast_dtypes = {}
+        self.auto_categorical_columns = []
+        self.auto_categorical_ratio = auto_categorical_ratio
+        self.categorical_columns = None
+        for col in columns_details:
+            column_name = col["header"]
+            self.read_dtypes[column_name] = get_column_dtype(col, string_storage)
+            downcast_dtype = get_downcast_dtype(col)
+            if downcast_dtype is not None:
+                self.downcast_dtypes[column_name] = downcast_dtype
+            if col["data_type"] == "string" and "categorical" not in col:
+                self.auto_categorical_columns.append(column_name)
+
+    def apply(self, chunk):
+        """
+        This function downcasts the integer columns with a range and converts
+        the auto-detected categorical columns of a chunk.
+        """
+        downcast_dtypes = {column_name: dtype for column_name, dtype in self.downcast_dtypes.items()
+                           if column_name in chunk.columns}
+        if downcast_dtypes:
+            chunk = chunk.astype(downcast_dtypes)
+        if self.auto_categorical_ratio is None:
+            return chunk
+        if self.categorical_columns is None:
+            self.categorical_columns = [
+                column_name for column_name in self.auto_categorical_columns
+                if column_name in chunk.columns and len(chunk) > 0
+                and chunk[column_name].nunique() <= self.auto_categorical_ratio * len(chunk)
+            ]
+        for column_name in self.categorical_columns:
+            chunk[column_name] = chunk[column_name].astype("category")
+        return chunk
+
+    def get_arrow_types(self):
+        """
+        This function maps the read dtypes to the Arrow types of the columns,
+        for readers that build Arrow tables instead of dataframes. Categories
+        become dictionary columns with int32 indices and string values, like
+        the categories read by read_csv.
+        """
+        import numpy as np
+        import pyarrow as pa
+
+        arrow_types = {}
+        for column_name, dtype in self.read_dtypes.items():
+            if dtype == "category":
+                arrow_types[column_name] = pa.dictionary(pa.int32(), pa.string())
+            elif dtype.startswith("string"):
+                arrow_types[column_name] = pa.string()
+            else:
+                arrow_types[column_name] = pa.from_numpy_dtype(np.dtype(dtype))
+        return arrow_types
+
+    def apply_table(self, table):
+        """
+        This function is apply for an Arrow table: it downcasts the integer
+        columns with a range and dictionary encodes the auto-detected
+        categorical columns.
+        """
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        for column_name, dtype in self.downcast_dtypes.items():
+            if column_name in table.column_names:
+                table = set_table_column(table, column_name, table[column_name].cast(
+                    pa.from_numpy_dtype(np.dtype(dtype))))
+        if self.auto_categorical_ratio is None:
+            return table
+        if self.categorical_columns is None:
+            self.categorical_columns = [
+                column_name for column_name in self.auto_categorical_columns
+                if column_name in table.column_names and len(table) > 0
+                and pc.count_distinct(table[column_name]).as_py() <= self.auto_categorical_ratio * len(table)
+            ]
+        for column_name in self.categorical_columns:
+            table = set_table_column(table, column_name, pc.dictionary_encode(table[column_name]))
+        return table
+
+
+def set_table_column(table, column_name, values):
+    """
+    This function replaces, or appends, a column of an Arrow table.
+    """
+    if column_name in table.column_names:
+        return table.set_column(table.column_names.index(column_name), column_name, values)
+    return table.append_column(column_name, values)
+
+
+def get_column_dtype(col, string_storage=STRING_STORAGE):
+    column_type = col["data_type"]
+    if column_type == "date":
+        return "string"
+    if col.get("categorical"):
+        return "category"
+    if column_type == "string":
+        return f"string[{string_storage}]" if string_storage else "string"
+    if column_type in INTEGER_ALIASES or column_type in INTEGER_TYPES:
+        return "int64" if column_type in INTEGER_ALIASES else column_type
+    if column_type in FLOAT_ALIASES or column_type in {"float32", "float64"}:
+        if col.get("downcast"):
+            return "float32"
+        return "float64" if column_type in FLOAT_ALIASES else column_type
+    return column_type
+
+
+def get_downcast_dtype(col):
+    """
+    This function returns the smallest integer type of an integer column
+    with "min" and "max", or None if the column is not downcast.
+    """
+    column_type = col["data_type"]
+    if column_type not in INTEGER_ALIASES and column_type not in INTEGER_TYPES:
+        return None
+    if col.get("categorical") or "min" not in col or "max" not in col:
+        return None
+    return get_smallest_integer_type(int(col["min"]), int(col["max"]))
+
+
+def build_dtype_plan(validation_rules):
+    """
+    This function builds the DtypePlan of the validation rules of a district.
+    The optional "dtype_plan" map of the rules sets "string_storage" and
+    "auto_categorical_ratio".
+    """
+    options = validation_rules.get("dtype_plan", {})
+    auto_categorical_ratio = options.get("auto_categorical_ratio")
+    return DtypePlan(validation_rules.get("columns_details", []),
+                     string_storage=options.get("string_storage", STRING_STORAGE),
+                     auto_categorical_ratio=float(auto_categorical_ratio) if auto_categorical_ratio is not None else None)
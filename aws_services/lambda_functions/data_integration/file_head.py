@@ -0,0 +1,146 @@
+import io
+import os
+
+import botocore.exceptions
+
+HEADER_PREFETCH_BYTES = int(os.getenv("HEADER_PREFETCH_BYTES", str(64 * 1024)))
+HEADER_PREFETCH_MAX_BYTES = 1000000
+
+
+class FileHead:
+    """
+    Prefix of an S3 object downloaded with range requests that grow geometrically.
+
+    Every call to fetch downloads the next range, twice as big as the previous
+    one, so a header of any width takes a logarithmic number of requests. The
+    bytes are kept so the full read of the file can start after them, and the
+    ETag of the first response pins every later read to the same object version.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, first_range_size=HEADER_PREFETCH_BYTES):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.range_size = first_range_size
+        self.content = bytearray()
+        self.file_size = None
+        self.e_tag = None
+
+    @property
+    def eof(self):
+        return self.file_size is not None and len(self.content) >= self.file_size
+
+    def fetch(self):
+        """
+        This function downloads the next range of the object and returns its bytes.
+        """
+        if self.eof:
+            return b""
+        start = len(self.content)
+        extra_args = {"IfMatch": self.e_tag} if self.e_tag else {}
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=self.key,
+                Range=f"bytes={start}-{start + self.range_size - 1}", **extra_args)
+        except botocore.exceptions.ClientError as error:
+            # S3 rejects any range on an empty object
+            if error.response["Error"]["Code"] == "InvalidRange" and start == 0:
+                self.file_size = 0
+                return b""
+            raise
+        chunk = response["Body"].read()
+        self.file_size = int(response["ContentRange"].rsplit("/", 1)[-1])
+        self.e_tag = response.get("ETag")
+        self.content += chunk
+        self.range_size *= 2
+        return chunk
+
+    def open(self):
+        """
+        This function returns a binary file object with the whole content of the object.
+        The prefetched bytes are read from memory, only the rest is downloaded.
+        """
+        head = io.BytesIO(bytes(self.content))
+        if self.eof:
+            return head
+        extra_args = {"IfMatch": self.e_tag} if self.e_tag else {}
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=self.key,
+            Range=f"bytes={len(self.content)}-", **extra_args)
+        return io.BufferedReader(ChainedStream([head, response["Body"]]))
+
+
+class ChainedStream(io.RawIOBase):
+    """
+    Read-only binary stream that reads a list of streams one after the other.
+    """
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.streams:
+            data = self.streams[0].read(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+            self.streams.pop(0)
+        return 0
+
+
+class S3SeekableFile(io.RawIOBase):
+    """
+    Read-only, seekable binary stream over an S3 object, read with range requests.
+
+    Formats that need random access, like the zip containers of xlsx files,
+    can read an object without downloading all of it. It is meant to be
+    wrapped in an io.BufferedReader, whose buffer size sets the minimum size
+    of the requests. The ETag pins every request to the same object version.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, size=None, e_tag=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        if size is None:
+            response = s3_client.head_object(Bucket=bucket_name, Key=key)
+            size = response["ContentLength"]
+            e_tag = response.get("ETag")
+        self.size = size
+        self.e_tag = e_tag
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        extra_args = {"IfMatch": self.e_tag} if self.e_tag else {}
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=self.key,
+            Range=f"bytes={self.position}-{end}", **extra_args)
+        data = response["Body"].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
@@ -0,0 +1,172 @@
+import re
+
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+QUANTIFIERS = set("*+?{")
+
+
+def get_literal_prefix(pattern):
+    """
+    This function returns the literal text every match of pattern starts with.
+    re.match anchors at the start of the string, so the prefix holds with or
+    without a leading "^". Patterns with alternations or inline flags return
+    an empty prefix, which matches every file name.
+    """
+    if "|" in pattern or "(?" in pattern:
+        return ""
+    prefix = []
+    i = 1 if pattern.startswith("^") else 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            literal = pattern[i + 1]
+            i += 2
+        elif char not in REGEX_METACHARACTERS:
+            literal = char
+            i += 1
+        else:
+            break
+        # A quantified character is optional or repeated, so it is not part of the prefix
+        if i < len(pattern) and pattern[i] in QUANTIFIERS:
+            break
+        prefix.append(literal)
+    return "".join(prefix)
+
+
+def get_literal_suffix(pattern):
+    """
+    This function returns the literal text every match of pattern ends with.
+    Only patterns anchored with a trailing "$" have a suffix.
+    """
+    if "|" in pattern or "(?" in pattern:
+        return ""
+    if not pattern.endswith("$") or is_escaped(pattern, len(pattern) - 1):
+        return ""
+    suffix = []
+    i = len(pattern) - 2
+    while i >= 0:
+        char = pattern[i]
+        if is_escaped(pattern, i):
+            if char.isalnum():
+                break
+            suffix.append(char)
+            i -= 2
+        elif char not in REGEX_METACHARACTERS:
+            suffix.append(char)
+            i -= 1
+        else:
+            break
+    return "".join(reversed(suffix))
+
+
+def get_required_literal(pattern):
+    """
+    This function returns the longest literal text every match of pattern contains.
+    Only the top level of the pattern is scanned, text inside groups and
+    character classes may be optional and is skipped.
+    """
+    if "|" in pattern or "(?" in pattern:
+        return ""
+    literals = [""]
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            literal = None if pattern[i + 1].isalnum() else pattern[i + 1]
+            i += 2
+        elif char == "[":
+            # Skip the character class, "]" right after "[" or "[^" is a literal
+            i += 2 if pattern[i + 1:i + 2] == "^" else 1
+            i = pattern.find("]", i + 1) + 1 or len(pattern)
+            literal = None
+        elif char == "(":
+            depth += 1
+            literal = None
+            i += 1
+        elif char == ")":
+            depth -= 1
+            literal = None
+            i += 1
+        elif char == "{":
+            i = pattern.find("}", i) + 1 or len(pattern)
+            literal = None
+        elif char in REGEX_METACHARACTERS:
+            literal = None
+            i += 1
+        else:
+            literal = char
+            i += 1
+        quantified = i < len(pattern) and pattern[i] in QUANTIFIERS
+        if literal is None or depth > 0 or quantified:
+            literals.append("")
+        else:
+            literals[-1] += literal
+    return max(literals, key=len)
+
+
+def is_escaped(pattern, index):
+    backslashes = 0
+    index -= 1
+    while index >= 0 and pattern[index] == "\\":
+        backslashes += 1
+        index -= 1
+    return backslashes % 2 == 1
+
+
+class FileRoutingIndex:
+    """
+    Index that routes a file name to the files of a document of the rules table.
+
+    The patterns are prefiltered with a trie of their literal prefixes, their
+    literal suffix (usually the extension) and the longest literal they
+    require, so only the few candidates that can match are evaluated with
+    re.match. All the matching files are returned in document order; as
+    before, the last one wins.
+    """
+
+    def __init__(self, files):
+        self.files = list(files.items())
+        self.patterns = []
+        self.suffixes = []
+        self.required_literals = []
+        self.trie = {}
+        for position, (_, district_data) in enumerate(self.files):
+            regex = district_data["file_name_regex"]
+            self.patterns.append(re.compile(regex))
+            self.suffixes.append(get_literal_suffix(regex))
+            self.required_literals.append(get_required_literal(regex))
+            node = self.trie
+            for char in get_literal_prefix(regex):
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(position)
+
+    def get_candidates(self, file_name):
+        candidates = list(self.trie.get(None, []))
+        node = self.trie
+        for char in file_name:
+            node = node.get(char)
+            if node is None:
+                break
+            candidates += node.get(None, [])
+        return sorted(candidates)
+
+    def match(self, file_name):
+        """
+        This function returns the (file key, district data) pairs whose
+        file_name_regex matches the file name, in document order.
+        """
+        return [self.files[position] for position in self.get_candidates(file_name)
+                if file_name.endswith(self.suffixes[position])
+                and self.required_literals[position] in file_name
+                and self.patterns[position].match(file_name)]
+
+    def route(self, file_name):
+        """
+        This function returns the district data of the file name, or None if no
+        file matches, and the sorted keys of all the matching files. More than
+        one key means the document has ambiguous patterns.
+        """
+        matches = self.match(file_name)
+        if not matches:
+            return None, []
+        return matches[-1][1], sorted(file_key for file_key, _ in matches)
@@ -0,0 +1,307 @@
+"""
+Timing and memory instrumentation of the stages of the Lambda handlers.
+
+A stage is timed with metrics.stage, metrics.timed or metrics.timed_iter,
+and the totals of an invocation are printed as one log line in CloudWatch
+Embedded Metric Format, which CloudWatch Logs turns into metrics without
+any API call. With METRICS_ENABLED off, the default, stage returns a shared
+no-op context manager and the wrappers return what they were given, so the
+handlers pay one attribute check per stage.
+"""
+import contextlib
+import functools
+import io
+import json
+import os
+import resource
+import threading
+import time
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "DataIntegration")
+
+
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+PROC_STATUS = "/proc/self/status"
+
+
+def reset_max_rss():
+    """
+    This function resets the high-water mark of the resident memory of the
+    process, VmHWM, to its current resident memory, so that the peak of a
+    warm container is the peak of the current invocation.
+
+    Returns:
+        bool: True if the mark was reset, False where /proc does not allow it.
+    """
+    try:
+        with open(PROC_CLEAR_REFS, "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_max_rss_bytes():
+    """
+    This function returns the high-water mark of the resident memory of the
+    process since reset_max_rss, read from VmHWM. Without /proc, it is
+    ru_maxrss, the high-water mark since the process started.
+    """
+    try:
+        with open(PROC_STATUS) as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    # In kilobytes
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class NullStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, rows=0, bytes_read=0, bytes_written=0):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class StageTotals:
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.max_rss_bytes = 0
+
+
+class Stage:
+    """
+    One timed interval of a stage. The time spent in a stage nested in it,
+    on the same thread, is only counted in the nested stage, so the times of
+    the stages of a thread add up to the time the thread actually spent.
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.seconds = 0.0
+        self.start = None
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        stack = self.metrics.get_stack()
+        now = self.metrics.clock()
+        if stack:
+            stack[-1].seconds += now - stack[-1].start
+        self.start = now
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = self.metrics.get_stack()
+        now = self.metrics.clock()
+        stack.pop()
+        self.seconds += now - self.start
+        if stack:
+            stack[-1].start = now
+        self.metrics.record(self)
+        return False
+
+    def add(self, rows=0, bytes_read=0, bytes_written=0):
+        self.rows += rows
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+
+class TimedReader(io.RawIOBase):
+    """
+    Raw binary stream that times the reads of another stream as a stage,
+    with the number of bytes read.
+    """
+
+    def __init__(self, metrics, name, raw):
+        self.metrics = metrics
+        self.name = name
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        with self.metrics.stage(self.name) as stage:
+            data = self.raw.read() if size is None or size < 0 else self.raw.read(size)
+            stage.add(bytes_read=len(data))
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class InvocationMetrics:
+    """
+    Totals of the stages of the current invocation, shared by every thread.
+
+    Lambda runs one invocation at a time per container, so a module level
+    instance is enough: invocation resets the totals when the handler starts
+    and emits them when it returns or raises. The memory of a stage is the
+    high-water mark of the process when the stage ends, so the first stage
+    that raises it is the one that needs the memory. The mark is reset with
+    the totals; where it cannot be, max_rss_scope is "process" instead of
+    "invocation" and the memory metrics are the peaks of the container.
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED, namespace=METRICS_NAMESPACE, clock=time.perf_counter, emit=print):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.clock = clock
+        self.emit = emit
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.start = clock()
+        self.max_rss_scope = "process"
+
+    def get_stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def timed(self, name):
+        """
+        This function returns a decorator that times every call of a function as a stage.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Stage(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iter(self, name, iterable):
+        """
+        This function times the production of every item of an iterable, e.g.
+        the chunks of a reader, as a stage and counts their rows with len.
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iter(iterable))
+
+    def _timed_iter(self, name, iterator):
+        while True:
+            with Stage(self, name) as stage:
+                item = next(iterator, None)
+                if item is not None:
+                    stage.add(rows=len(item))
+            if item is None:
+                return
+            yield item
+
+    def timed_reader(self, name, raw):
+        if not self.enabled:
+            return raw
+        return TimedReader(self, name, raw)
+
+    def record(self, stage):
+        max_rss_bytes = get_max_rss_bytes()
+        with self.lock:
+            totals = self.stages.setdefault(stage.name, StageTotals())
+            totals.seconds += stage.seconds
+            totals.calls += 1
+            totals.rows += stage.rows
+            totals.bytes_read += stage.bytes_read
+            totals.bytes_written += stage.bytes_written
+            totals.max_rss_bytes = max(totals.max_rss_bytes, max_rss_bytes)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.start = self.clock()
+            self.max_rss_scope = "invocation" if reset_max_rss() else "process"
+
+    @contextlib.contextmanager
+    def _invocation(self, dimensions, properties):
+        self.reset()
+        try:
+            yield self
+        finally:
+            self.emit(json.dumps(self.get_document(dimensions, properties)))
+
+    def invocation(self, dimensions=None, properties=None):
+        """
+        This function returns a context manager around a handler invocation,
+        which emits its metrics as one log line on exit.
+
+        Parameters:
+            dimensions (dict): The CloudWatch dimensions of every metric,
+                usually {"FunctionName": context.function_name}.
+            properties (dict): Other fields of the log line, searchable in
+                CloudWatch Logs Insights but not turned into metrics.
+        """
+        if not self.enabled:
+            return contextlib.nullcontext(self)
+        return self._invocation(dimensions or {}, properties or {})
+
+    def get_document(self, dimensions, properties):
+        """
+        This function builds the Embedded Metric Format document of the
+        current totals. Counters that stayed at zero are left out.
+        """
+        values = {"invocation_ms": round((self.clock() - self.start) * 1000, 3),
+                  "invocation_max_rss_mb": round(get_max_rss_bytes() / 1024 / 1024, 1)}
+        units = {"invocation_ms": "Milliseconds", "invocation_max_rss_mb": "Megabytes"}
+        with self.lock:
+            stages = dict(self.stages)
+        for name, totals in stages.items():
+            values[f"{name}_ms"] = round(totals.seconds * 1000, 3)
+            units[f"{name}_ms"] = "Milliseconds"
+            values[f"{name}_max_rss_mb"] = round(totals.max_rss_bytes / 1024 / 1024, 1)
+            units[f"{name}_max_rss_mb"] = "Megabytes"
+            for counter, unit in [("rows", "Count"), ("bytes_read", "Bytes"), ("bytes_written", "Bytes")]:
+                value = getattr(totals, counter)
+                if value:
+                    values[f"{name}_{counter}"] = value
+                    units[f"{name}_{counter}"] = unit
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()],
+                }],
+            },
+            **properties,
+            **dimensions,
+            **values,
+            "max_rss_scope": self.max_rss_scope,
+            "stage_calls": {name: totals.calls for name, totals in stages.items()},
+        }
+
+
+# Shared by the modules of a handler
+metrics = InvocationMetrics()
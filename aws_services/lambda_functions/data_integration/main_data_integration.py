@@ -1,17 +1,39 @@
 import boto3
+import botocore.config
 import json
 import re
 import os
 import io
-from io import BytesIO
 from datetime import datetime
-import tempfile
+from urllib.parse import unquote_plus
+import itertools
+import codecs
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# Packages from layers
-import cchardet
-import pandas as pd
+# Packages from layers (pandas and pyarrow) are imported in the functions
+# that use them, files rejected by the validations never load them.
 
-from aux_data_integration import *
+from aux_data_integration import (add_date_columns, compile_header_validator, get_file_dates, get_record_delimiter,
+                                  get_source_date, parse_dates, resolve_byte_order, validate_file_encoding,
+                                  validate_file_extension)
+from s3_multipart_writer import S3MultipartWriter, MULTIPART_PART_SIZE, MULTIPART_CONCURRENCY
+from rules_cache import TTLCache
+from file_routing import FileRoutingIndex
+from file_head import FileHead, S3SeekableFile, HEADER_PREFETCH_MAX_BYTES
+from notifications import StatusNotifier
+from dtype_plan import build_dtype_plan
+from row_rules import RowValidator, compile_row_rules
+from partitioning import (PARTITIONED_OUTPUT, PARQUET_DATA_PAGE_SIZE_BYTES, PARQUET_ROW_GROUP_SIZE_ROWS,
+                          drop_partition_columns, get_partition_prefix)
+from spreadsheets import (cast_sheet_dates, get_sheet_suffix, is_spreadsheet, iter_record_batches,
+                          open_workbook, select_sheets)
+from dedup_index import DEDUP_TABLE, DynamoDBDedupIndex, get_content_hash
+from instrumentation import metrics
+from zones import ZoneTransitions, get_output_metadata
+from arrow_engine import (add_table_date_columns, get_parse_engine, parse_table_date_columns,
+                          read_csv_table, read_csv_tables, validate_table)
+from schema_profile import SCHEMA_PROFILE_SAMPLE_BYTES, find_schema_drift, get_sample_rows
 
 REGION = os.getenv("REGION")
 INPUT_RAW_BUCKET = os.getenv("INPUT_RAW_BUCKET")
@@ -19,36 +41,87 @@ RAW_ZONE_BUCKET = os.getenv("RAW_ZONE_BUCKET")
 LANDING_ZONE_BUCKET = os.getenv("LANDING_ZONE_BUCKET")
 STAGING_ZONE_BUCKET = os.getenv("STAGING_ZONE_BUCKET")
 ERROR_ZONE_BUCKET = os.getenv("ERROR_ZONE_BUCKET")
-s3_client = boto3.client("s3")
-sns = boto3.client("sns")
-dynamodb = boto3.resource("dynamodb", region_name=REGION)
+STREAMING_MODE = os.getenv("STREAMING_MODE", "true").lower() == "true"
+CHUNK_SIZE_ROWS = int(os.getenv("CHUNK_SIZE_ROWS", "100000"))
+RULES_CACHE_TTL_SECONDS = int(os.getenv("RULES_CACHE_TTL_SECONDS", "300"))
+RULES_CACHE_MAX_ITEMS = int(os.getenv("RULES_CACHE_MAX_ITEMS", "256"))
+BATCH_MEMORY_PER_WORKER_MB = int(os.getenv("BATCH_MEMORY_PER_WORKER_MB", "512"))
+MAX_BATCH_WORKERS = int(os.getenv("MAX_BATCH_WORKERS", "8"))
+SUCCESS_TOPIC_NAME = os.getenv("SUCCESS_TOPIC_NAME")
+FAILURE_TOPIC_NAME = os.getenv("FAILURE_TOPIC_NAME")
+MAX_POOL_CONNECTIONS = int(os.getenv("MAX_POOL_CONNECTIONS", "50"))
+ZONE_COPY_WORKERS = int(os.getenv("ZONE_COPY_WORKERS", "8"))
+# Clients are created once per Lambda container, during the init phase, and
+# reused by every warm invocation. The pool must fit the multipart upload
+# threads and the batch workers.
+client_config = botocore.config.Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    connect_timeout=5,
+    read_timeout=60,
+)
+s3_client = boto3.client("s3", config=client_config)
+sns = boto3.client("sns", region_name=REGION, config=client_config)
+dynamodb = boto3.resource("dynamodb", region_name=REGION, config=client_config)
 table = dynamodb.Table("inventory_per_district")
+# Lives across warm invocations of the same Lambda container
+rules_cache = TTLCache(RULES_CACHE_TTL_SECONDS, RULES_CACHE_MAX_ITEMS)
+# boto3 resources are not thread safe, and concurrent misses should load an item only once
+rules_lock = threading.Lock()
+# Topic name to ARN, preloaded from SNS_TOPIC_ARNS (a JSON object) and
+# completed by get_topic_arn, lives across warm invocations
+topic_arns = json.loads(os.getenv("SNS_TOPIC_ARNS", "{}"))
+topic_arns_lock = threading.Lock()
+notifier = StatusNotifier(sns, lambda topic_name: get_topic_arn(topic_name))
+# Zone copies run in their own pool, a batch worker waits for the copies of its file
+zone_executor = ThreadPoolExecutor(max_workers=ZONE_COPY_WORKERS)
+# Files already processed per district, deduplication is off without DEDUP_TABLE
+dedup_index = DynamoDBDedupIndex(
+    DEDUP_TABLE, REGION, config=client_config) if DEDUP_TABLE else None
 
 
 def get_topic_arn(topic_name):
     """
     This function retrieves the ARN of a topic with the specified name.
-    It retrieves all the topics available in the SNS service and looks
-    for the topic with the specified name.
-    """
-    response = sns.list_topics()
-    topics = response["Topics"]
-    next_token = response.get("NextToken", None)
-    while next_token:
-        response = sns.list_topics(NextToken=next_token)
-        topics += response["Topics"]
-        next_token = response.get("NextToken", None)
-    for topic in topics:
-        if topic["TopicArn"].split(":")[-1] == topic_name:
-            return topic["TopicArn"]
-    return None
+    The ARN is read from topic_arns when it is known. Otherwise the topics
+    available in the SNS service are listed page by page, every topic seen
+    is added to topic_arns, and the listing stops as soon as the topic
+    with the specified name is found.
+    """
+    topic_arn = topic_arns.get(topic_name)
+    if topic_arn is not None:
+        return topic_arn
+
+    with topic_arns_lock:
+        if topic_name in topic_arns:
+            return topic_arns[topic_name]
+        response = sns.list_topics()
+        while True:
+            for topic in response["Topics"]:
+                topic_arns[topic["TopicArn"].split(":")[-1]] = topic["TopicArn"]
+            if topic_name in topic_arns:
+                return topic_arns[topic_name]
+            next_token = response.get("NextToken", None)
+            if not next_token:
+                return None
+            response = sns.list_topics(NextToken=next_token)
+
+
+def get_zone_bucket_name(input_bucket_name, zone_bucket_name):
+    """
+    This function maps the input raw bucket to the bucket of a zone.
+    It returns None if the zone has no bucket, the zone is then skipped.
+    """
+    if not zone_bucket_name:
+        return None
+    return re.sub(INPUT_RAW_BUCKET, zone_bucket_name, input_bucket_name)
 
 
 def write_df_to_s3_parquet(df, output_bucket_name, output_prefix):
     """
     This function writes a dataframe to S3 in parquet format.
-    The dataframe is written to a temporary file in the local filesystem,
-    and then uploaded to S3.
+    The parquet bytes are streamed from memory to S3 with a multipart upload,
+    no temporary file is written in the local filesystem.
 
     Parameters:
         df (pandas.DataFrame): The dataframe to be written to S3.
@@ -58,19 +131,397 @@ def write_df_to_s3_parquet(df, output_bucket_name, output_prefix):
     Returns:
         None
     """
+    write_chunks_to_s3_parquet([df], output_bucket_name, output_prefix)
+
+
+class ParquetS3Writer:
+    """
+    Parquet file of S3 written one chunk at a time. Every chunk is appended
+    as a new row group, or buffered into row groups of row_group_size rows,
+    and the encoded bytes are streamed into an S3 multipart upload.
+
+    The file is only created with the first chunk, its schema is taken from
+    that chunk and every following chunk is cast to it. append is an alias
+    of write, so the writer can collect the chunks produced as a side effect
+    of another stream, like the rows rejected by the row rules.
+
+    If an error is raised inside the with block, or the writer is aborted,
+    the multipart upload is aborted.
+    """
+
+    def __init__(self, output_bucket_name, output_key, part_size=MULTIPART_PART_SIZE, concurrency=MULTIPART_CONCURRENCY, row_group_size=None, data_page_size=None, null_type=None, metadata=None):
+        """
+        Parameters:
+            null_type (pyarrow.DataType): If given, the type of the columns
+                that only have nulls in the first chunk, instead of null.
+            metadata (dict): If given, the S3 user metadata of the file.
+        """
+        self.output_bucket_name = output_bucket_name
+        self.output_key = output_key
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.row_group_size = row_group_size
+        self.data_page_size = data_page_size
+        self.null_type = null_type
+        self.metadata = metadata
+        self.rows_count = 0
+        self.schema = None
+        self._output_file = None
+        self._writer = None
+        self._buffer = []
+        self._buffered_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _open(self, first_chunk):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = get_parquet_schema(first_chunk)
+        if self.null_type is not None:
+            schema = pa.schema([field.with_type(self.null_type) if pa.types.is_null(field.type) else field
+                                for field in schema], metadata=schema.metadata)
+        self.schema = schema
+        self._output_file = S3MultipartWriter(
+            s3_client, self.output_bucket_name, self.output_key,
+            part_size=self.part_size, concurrency=self.concurrency, metadata=self.metadata)
+        self._writer = pq.ParquetWriter(
+            self._output_file, schema, compression='snappy',
+            use_dictionary=get_dictionary_columns(schema),
+            write_statistics=True, data_page_size=self.data_page_size)
+
+    def write(self, chunk):
+        """
+        This function encodes a dataframe, or an Arrow table, into the file.
+        """
+        import pyarrow as pa
+
+        if self._writer is None:
+            self._open(chunk)
+        with metrics.stage("encode") as stage:
+            if isinstance(chunk, pa.Table):
+                table = chunk.select(self.schema.names).cast(self.schema)
+            else:
+                table = pa.Table.from_pandas(
+                    chunk, schema=self.schema, preserve_index=False)
+            self.rows_count += len(chunk)
+            stage.add(rows=len(chunk))
+            if self.row_group_size is None:
+                self._writer.write_table(table)
+                return
+            self._buffer.append(table)
+            self._buffered_rows += len(table)
+            if self._buffered_rows >= self.row_group_size:
+                self._flush_buffer()
+
+    append = write
+
+    def _flush_buffer(self):
+        import pyarrow as pa
 
-    # Create a temporary file
-    with tempfile.NamedTemporaryFile() as temp:
+        self._writer.write_table(pa.concat_tables(self._buffer),
+                                 row_group_size=self.row_group_size)
+        self._buffer, self._buffered_rows = [], 0
 
-        # Write the dataframe to the temporary file in parquet format
-        df.to_parquet(temp.name, index=False, compression='snappy')
+    def close(self):
+        """
+        This function writes the footer of the file and completes the upload.
 
-        # Move the file pointer to the beginning of the file
-        temp.seek(0)
+        Returns:
+            bool: False if no chunk was written, the file was then not created.
+        """
+        if self._writer is None:
+            return False
+        if self._output_file.closed:
+            return True
+        try:
+            if self._buffer:
+                with metrics.stage("encode"):
+                    self._flush_buffer()
+            self._writer.close()
+        except Exception:
+            self._output_file.abort()
+            raise
+        self._output_file.close()
+        return True
 
-        # Upload the file to S3
-        output_prefix = output_prefix + ".parquet"
-        s3_client.upload_file(temp.name, output_bucket_name, output_prefix)
+    def abort(self):
+        """
+        This function cancels the upload, nothing is written to S3.
+        """
+        if self._output_file is not None:
+            self._output_file.abort()
+            try:
+                # Closes the encoder, which fails to write the footer to the aborted upload
+                self._writer.close()
+            except ValueError:
+                pass
+
+
+def write_chunks_to_s3_parquet(chunks, output_bucket_name, output_prefix, part_size=MULTIPART_PART_SIZE, concurrency=MULTIPART_CONCURRENCY, row_group_size=None, data_page_size=None, metadata=None):
+    """
+    This function writes an iterable of dataframes to S3 as a single parquet file.
+    Every dataframe is appended as a new row group, so only one chunk is held
+    in memory at a time. The schema is taken from the first chunk and every
+    following chunk is cast to it. Column statistics are written, so readers
+    can skip the row groups out of the range of their filters.
+
+    The encoded row groups are streamed into an S3 multipart upload, parts
+    are uploaded concurrently while the next chunks are still being encoded.
+    On failure the multipart upload is aborted.
+
+    Parameters:
+        chunks (iterable of pandas.DataFrame or pyarrow.Table): The dataframes to be written to S3.
+        output_bucket_name (str): The name of the S3 bucket to which the dataframes will be written.
+        output_prefix (str): The name of the output file in S3.
+        part_size (int): The size in bytes of each multipart part.
+        concurrency (int): The maximum number of parts uploaded at the same time.
+        row_group_size (int): If given, the chunks are buffered and written
+            in row groups of this number of rows instead of one per chunk.
+        data_page_size (int): If given, the target size in bytes of the data pages.
+        metadata (dict): If given, the S3 user metadata of the file.
+
+    Returns:
+        int: The number of rows written.
+    """
+    with ParquetS3Writer(output_bucket_name, output_prefix + ".parquet", part_size=part_size,
+                         concurrency=concurrency, row_group_size=row_group_size,
+                         data_page_size=data_page_size, metadata=metadata) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.rows_count
+
+
+def get_output_file_name(validation_rules, file_name, output_base_file_name):
+    """
+    This function returns the output file name of a file before its rows are
+    read: the base name with the dates of the date details, if any.
+    """
+    if "date_details" not in validation_rules:
+        return output_base_file_name
+    return get_file_dates(validation_rules["date_details"], file_name, output_base_file_name)[2]
+
+
+def get_output_prefix(prefix, output_file_name, district_key, file_name, district_rules):
+    """
+    This function returns the output path of a file in the staging zone.
+    With PARTITIONED_OUTPUT, the file is written in its Hive style partition
+    of district and source date, otherwise next to the path of the input file.
+    """
+    base_prefix = prefix.rsplit("/", 1)[0]
+    if not PARTITIONED_OUTPUT:
+        return base_prefix + "/" + output_file_name
+    date_details = district_rules["validation_rules"].get("date_details", {})
+    source_date = None
+    if "source_date" in date_details:
+        source_date = get_source_date(date_details, file_name)
+    return get_partition_prefix(base_prefix, district_key, source_date) + "/" + output_file_name
+
+
+def write_staging_output(chunks, output_bucket_name, output_prefix, metadata=None):
+    """
+    This function writes the valid rows of a file to the staging zone, with
+    the S3 user metadata of get_output_metadata, if given. The partitioned
+    output drops the partition columns and uses row groups and pages sized for scans.
+
+    Returns:
+        bool: False if there was no chunk, e.g. every row was rejected, and
+            no object was written.
+    """
+    chunks = iter(chunks)
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return False
+    chunks = itertools.chain([first_chunk], chunks)
+    if not PARTITIONED_OUTPUT:
+        write_chunks_to_s3_parquet(chunks, output_bucket_name, output_prefix, metadata=metadata)
+    else:
+        write_chunks_to_s3_parquet(
+            drop_partition_columns(chunks), output_bucket_name, output_prefix,
+            row_group_size=PARQUET_ROW_GROUP_SIZE_ROWS, data_page_size=PARQUET_DATA_PAGE_SIZE_BYTES,
+            metadata=metadata)
+    return True
+
+
+def get_rejected_rows_writer(input_bucket_name, prefix, output_file_name):
+    """
+    This function opens the file of the error zone that receives the rows
+    rejected by the row rules, next to the path of the file in the staging
+    zone. It is passed as the rejected_chunks of the create functions, so the
+    rejected rows are written as they are found instead of being held in memory.
+    The file is only created if a row is rejected.
+
+    Returns:
+        ParquetS3Writer
+    """
+    import pyarrow as pa
+
+    error_bucket_name = get_zone_bucket_name(input_bucket_name, ERROR_ZONE_BUCKET)
+    error_key = prefix.rsplit("/", 1)[0] + "/" + output_file_name + "_rejected.parquet"
+    # A column can be null in every rejected row of the first chunk
+    return ParquetS3Writer(error_bucket_name, error_key, null_type=pa.string())
+
+
+@metrics.timed("dedup")
+def find_duplicate_file(input_bucket_name, prefix, district_key):
+    """
+    This function looks up the content hash of a file in dedup_index.
+
+    Returns:
+        tuple: The content hash of the file and the index item of the file
+            already processed with the same content, or None.
+    """
+    if dedup_index is None:
+        return None, None
+    content_hash = get_content_hash(s3_client, input_bucket_name, prefix)
+    return content_hash, dedup_index.get(district_key, content_hash)
+
+
+def write_duplicate_pointer(input_bucket_name, prefix, content_hash, duplicate):
+    """
+    This function writes a pointer to the output of the file already processed
+    with the same content, instead of processing the duplicate file again.
+    The pointer is a small JSON object next to the file path in the staging
+    zone, and its key is recorded in dedup_index for the compaction.
+    """
+    output_bucket_name = re.sub(
+        INPUT_RAW_BUCKET, STAGING_ZONE_BUCKET, input_bucket_name)
+    pointer_key = prefix + ".duplicate.json"
+    pointer = {
+        "source_key": prefix,
+        "content_hash": content_hash,
+        "duplicate_of": {"source_key": duplicate["source_key"],
+                         "output_key": duplicate["output_key"]},
+    }
+    s3_client.put_object(
+        Bucket=output_bucket_name, Key=pointer_key,
+        Body=json.dumps(pointer).encode("utf-8"), ContentType="application/json",
+        Metadata={"duplicate-of": duplicate["output_key"]})
+    dedup_index.add_duplicates(duplicate["district_key"], duplicate["output_key"], [pointer_key])
+    print(f"{prefix} is a duplicate of {duplicate['source_key']}")
+
+
+def handle_duplicate_file(input_bucket_name, prefix, district_key, transitions=None):
+    """
+    This function looks up a validated file in dedup_index. A duplicate file
+    is not transformed again: it gets a pointer to the output of the first
+    file with its content, and that output is recorded in its landing zone
+    transition, in transitions if given.
+
+    Returns:
+        tuple: The content hash of the file, None without deduplication,
+            and True if the file is a duplicate.
+    """
+    content_hash, duplicate = find_duplicate_file(
+        input_bucket_name, prefix, district_key)
+    if duplicate is None:
+        return content_hash, False
+    write_duplicate_pointer(
+        input_bucket_name, prefix, content_hash, duplicate)
+    if transitions is not None:
+        transitions.transformed(duplicate["output_key"])
+    return content_hash, True
+
+
+@metrics.timed("rules_lookup")
+def get_rules_item(document_key, compile_item=None):
+    """
+    This function retrieves an item of the rules table through rules_cache.
+    When a cached item has expired and has a "version" attribute, only the
+    version is read from DynamoDB, and the cached item is kept if it did not
+    change. compile_item, if given, is applied to the item once before it is
+    cached, so derived values such as compiled regexes are reused as well.
+    """
+    cached_item = rules_cache.get(document_key)
+    if cached_item is not None:
+        return cached_item
+
+    with rules_lock:
+        return load_rules_item(document_key, compile_item)
+
+
+def load_rules_item(document_key, compile_item=None):
+    cached_item = rules_cache.get(document_key)
+    if cached_item is not None:
+        return cached_item
+
+    entry = rules_cache.get_entry(document_key)
+    if entry is not None and entry.version is not None:
+        response = table.get_item(
+            Key={"document_key": document_key},
+            ProjectionExpression="#version",
+            ExpressionAttributeNames={"#version": "version"})
+        if response.get("Item", {}).get("version") == entry.version:
+            rules_cache.touch(document_key)
+            return entry.value
+
+    response = table.get_item(Key={"document_key": document_key})
+    item = response.get("Item")
+    if item is None:
+        return None
+    if compile_item is not None:
+        item = compile_item(item)
+    rules_cache.set(document_key, item, response["Item"].get("version"))
+    return item
+
+
+def compile_district_documents(district_documents):
+    """
+    This function builds the file routing index of a document.
+    """
+    return FileRoutingIndex(district_documents["files"])
+
+
+def compile_district_rules(district_rules):
+    """
+    This function adds the compiled header validator and row rules, and the
+    parse engine, to the rules of a district.
+    """
+    return {**district_rules,
+            "header_validator": compile_header_validator(district_rules["validation_rules"]),
+            "row_rules": compile_row_rules(district_rules["validation_rules"]),
+            "parse_engine": get_parse_engine(district_rules["validation_rules"])}
+
+
+def get_parquet_schema(df):
+    """
+    This function returns the Arrow schema used to write a dataframe, or an
+    Arrow table, to parquet. Categorical columns become dictionary columns
+    with int32 indices, so chunks with a different number of categories share
+    the same schema.
+    """
+    import pyarrow as pa
+
+    if isinstance(df, pa.Table):
+        schema = df.schema
+    else:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(pa.dictionary(
+                pa.int32(), field.type.value_type))
+        fields.append(field)
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def get_dictionary_columns(schema):
+    """
+    This function returns the columns written with parquet dictionary encoding:
+    the categorical and string columns.
+    """
+    import pyarrow as pa
+
+    return [field.name for field in schema
+            if pa.types.is_dictionary(field.type) or pa.types.is_string(field.type)
+            or pa.types.is_large_string(field.type)]
 
 
 def get_validation_rules(prefix):
@@ -78,23 +529,28 @@ def get_validation_rules(prefix):
     document_key = "/".join(re.split("/", prefix)[:-1])
     file_name = prefix.rsplit("/", 1)[-1]
 
-    response = table.get_item(Key={"document_key": document_key})
-    district_documents = response.get("Item")
-
-    valid_file = False
-    for _, district_data in district_documents["files"].items():
-        if re.match(district_data["file_name_regex"], file_name):
-            district_key = district_data["district_key"]
-            output_base_file_name = district_data["output_base_file_name"]
-            valid_file = True
-    if valid_file:
-        response = table.get_item(Key={"document_key": district_key})
-        district_rules = response.get("Item")
+    routing_index = get_rules_item(
+        document_key, compile_district_documents)
+
+    district_data, matching_files = routing_index.route(file_name)
+    if len(matching_files) > 1:
+        print(
+            f"Ambiguous file name {file_name} in {document_key}, matches: {matching_files}")
+    if district_data is not None:
+        district_key = district_data["district_key"]
+        output_base_file_name = district_data["output_base_file_name"]
+        district_rules = get_rules_item(district_key, compile_district_rules)
         return True, district_rules, output_base_file_name, file_name, document_key
-    return False, _, _, _, _
+    return False, None, None, None, None
 
 
-def get_file_extract(input_bucket_name, prefix, file_name, district_rules):
+def get_file_extract(input_bucket_name, prefix, file_name, district_rules, file_head=None):
+    """
+    This function downloads the head of a file and returns its header and first record.
+    The first range request is HEADER_PREFETCH_BYTES long and every following
+    one doubles in size until both records are complete. The downloaded bytes
+    are kept in file_head, if given, so create_dataframe_chunks can reuse them.
+    """
     extension_status = False
     encoding_status = False
     file_extension = district_rules["validation_rules"].get(
@@ -105,17 +561,10 @@ def get_file_extract(input_bucket_name, prefix, file_name, district_rules):
         )
 
     if extension_status:
-        bytes_min_range = 0
-        bytes_delta = 2500
-        bytes_max_range = bytes_delta
+        if file_head is None:
+            file_head = FileHead(s3_client, input_bucket_name, prefix)
 
-        # Create a bytes buffer to hold the first two lines of the file
-        buffer = io.BytesIO()
-
-        # Download the first two lines of the file into the buffer
-        s3_client.download_fileobj(
-            Bucket=input_bucket_name, Key=prefix, Fileobj=buffer, Config={"Range": f"bytes={bytes_min_range}-{bytes_max_range}"})
-        file_bytes = buffer.getvalue()
+        file_bytes = file_head.fetch()
         if "encoding" in district_rules["validation_rules"] and extension_status:
             encoding = district_rules["validation_rules"].get("encoding")
             encoding_status = validate_file_encoding(
@@ -123,25 +572,15 @@ def get_file_extract(input_bucket_name, prefix, file_name, district_rules):
 
     if encoding_status:
         record_delimiter = get_record_delimiter(file_extension, encoding)
-        max_iterations = 10
-        i = 0
-        while i < max_iterations:
-            buffer.seek(0)
-            file_content = buffer.read().decode(encoding)
-            if len(file_content.split(record_delimiter)) < 3:
-                i += 1
-                # Append the next bytes
-                bytes_min_range += bytes_delta
-                bytes_max_range += bytes_delta
-                buffer.seek(0, 2)  # set the pointer to the end of the buffer
-                s3_client.download_fileobj(
-                    Bucket=input_bucket_name, Key=prefix, Fileobj=buffer, Config={"Range": f"bytes={bytes_min_range}-{bytes_max_range}"})
-            else:
-                break
+        decoder = codecs.getincrementaldecoder(resolve_byte_order(file_bytes, encoding))()
+        file_content = decoder.decode(file_bytes, final=file_head.eof)
+        while file_content.count(record_delimiter) < 2 and not file_head.eof:
+            if len(file_head.content) >= HEADER_PREFETCH_MAX_BYTES:
+                raise Exception("The buffer has reached the maximum size")
+            file_content += decoder.decode(
+                file_head.fetch(), final=file_head.eof)
         if not file_content:
             raise Exception("The file is empty")
-        if buffer.tell() >= 1000000:
-            raise Exception("The buffer has reached the maximum size")
 
         file_extract = file_content.split(record_delimiter)[:2]
         return file_extract
@@ -149,91 +588,604 @@ def get_file_extract(input_bucket_name, prefix, file_name, district_rules):
         return None
 
 
-def create_dataframe(input_bucket_name, prefix, district_rules):
-    columns_details = district_rules["validation_rules"].get("columns_details")
-    encoding = district_rules["validation_rules"].get("encoding")
-    delimiter = district_rules["validation_rules"].get("delimiter")
+def get_schema_drift(file_head, district_rules, column_names):
+    """
+    This function profiles the first rows of a file and returns its drift
+    from the schema baseline of its district. The head of the file is
+    completed up to SCHEMA_PROFILE_SAMPLE_BYTES, the full read of the file
+    starts after it, so no byte is downloaded twice.
+    """
+    validation_rules = district_rules["validation_rules"]
+    while len(file_head.content) < SCHEMA_PROFILE_SAMPLE_BYTES and not file_head.eof:
+        file_head.fetch()
+    rows = get_sample_rows(file_head.content, validation_rules["encoding"],
+                           validation_rules["delimiter"], file_head.eof)
+    return find_schema_drift(column_names, rows, validation_rules["schema_baseline"])
 
-    dtypes = {}
-    for col in columns_details:
-        column_name = col["header"]
-        column_type = col["data_type"]
-        if column_type == "date":
-            dtypes[column_name] = "string"
-        else:
-            dtypes[column_name] = column_type
 
-    obj = s3_client.get_object(Bucket=input_bucket_name, Key=prefix)
-    file_content = obj["Body"].read().decode(encoding)
+def get_dtypes(columns_details):
+    """
+    This function maps the columns details of a district to pandas dtypes.
+    Date columns are read as strings and parsed afterwards by parse_date_columns.
+    """
+    return build_dtype_plan({"columns_details": columns_details}).read_dtypes
 
-    df = pd.read_csv(io.BytesIO(bytes(file_content, encoding)),
-                     dtype=dtypes, delimiter=delimiter)
 
+def parse_date_columns(df, columns_details):
+    """
+    This function parses the date columns of a dataframe with the
+    date format defined in the columns details.
+    """
     for col in columns_details:
         if col["data_type"] == "date" and "date_format" in col:
-            df[col["header"]] = pd.to_datetime(
-                df[col["header"]], format=col["date_format"])
+            df[col["header"]] = parse_dates(
+                df[col["header"]], col["date_format"])
+    return df
+
+
+def get_row_validator(district_rules):
+    """
+    This function returns a new RowValidator for a file of a district.
+    """
+    row_rules = district_rules.get("row_rules")
+    if row_rules is None:
+        row_rules = compile_row_rules(district_rules["validation_rules"])
+    return RowValidator(row_rules)
+
 
+def get_district_parse_engine(district_rules):
+    """
+    This function returns the parse engine of the delimited files of a district.
+    """
+    parse_engine = district_rules.get("parse_engine")
+    if parse_engine is None:
+        parse_engine = get_parse_engine(district_rules["validation_rules"])
+    return parse_engine
+
+
+@metrics.timed("validate")
+def validate_rows(df, row_validator, rejected_chunks):
+    """
+    This function removes the rows of a dataframe that fail the row rules.
+    The rejected rows are appended to rejected_chunks, if given.
+    """
+    df, rejected = row_validator.validate(df)
+    if rejected is not None and rejected_chunks is not None:
+        rejected_chunks.append(rejected)
     return df
 
 
+@metrics.timed("validate")
+def validate_table_rows(table, row_validator, first_row, rejected_chunks):
+    """
+    This function removes the rows of an Arrow table that fail the row rules.
+    The rejected rows are appended to rejected_chunks, if given, as a dataframe.
+    """
+    table, rejected = validate_table(table, row_validator, first_row)
+    if rejected is not None and rejected_chunks is not None:
+        rejected_chunks.append(rejected)
+    return table
+
+
+def read_whole_file(input_bucket_name, prefix, file_head=None):
+    """
+    This function downloads a whole file from S3. When file_head is given,
+    only the bytes after the ones it already downloaded are requested.
+
+    Returns:
+        bytes: The content of the file.
+    """
+    with metrics.stage("download") as stage:
+        if file_head is not None:
+            with file_head.open() as body:
+                file_bytes = body.read()
+            stage.add(bytes_read=len(file_bytes) - len(file_head.content))
+        else:
+            obj = s3_client.get_object(Bucket=input_bucket_name, Key=prefix)
+            file_bytes = obj["Body"].read()
+            stage.add(bytes_read=len(file_bytes))
+    return file_bytes
+
+
+def create_dataframe(input_bucket_name, prefix, district_rules, rejected_chunks=None, column_names=None, file_head=None):
+    import pandas as pd
+
+    columns_details = district_rules["validation_rules"].get("columns_details")
+    encoding = district_rules["validation_rules"].get("encoding")
+    delimiter = district_rules["validation_rules"].get("delimiter")
+
+    dtype_plan = build_dtype_plan(district_rules["validation_rules"])
+    dtypes = dtype_plan.read_dtypes
+
+    file_bytes = read_whole_file(input_bucket_name, prefix, file_head)
+    encoding = resolve_byte_order(file_bytes, encoding)
+    file_content = file_bytes.decode(encoding)
+
+    with metrics.stage("parse") as stage:
+        df = pd.read_csv(io.BytesIO(bytes(file_content, encoding)),
+                         dtype=dtypes, delimiter=delimiter, names=column_names, header=0)
+        stage.add(rows=len(df))
+
+    df = validate_rows(df, get_row_validator(district_rules), rejected_chunks)
+    with metrics.stage("cast"):
+        return parse_date_columns(dtype_plan.apply(df), columns_details)
+
+
+def create_dataframe_chunks(input_bucket_name, prefix, district_rules, column_names=None, chunksize=CHUNK_SIZE_ROWS, file_head=None, rejected_chunks=None):
+    """
+    This function reads a file from S3 as a stream of dataframes.
+    The S3 body is handed to pandas without being loaded in memory, and each
+    chunk of at most chunksize rows is validated with the row rules and cast
+    with the DtypePlan of the district before being yielded.
+
+    Parameters:
+        input_bucket_name (str): The name of the S3 bucket where the file is stored.
+        prefix (str): The key of the file in S3.
+        district_rules (dict): The validation rules of the district.
+        column_names (list): The normalized headers of the file. When given,
+            they replace the header line of the file.
+        chunksize (int): The maximum number of rows per chunk.
+        file_head (FileHead): The bytes already downloaded by get_file_extract,
+            only the rest of the file is downloaded.
+        rejected_chunks (list or ParquetS3Writer): If given, the rows rejected by the row rules
+            are appended to it, with their reason codes.
+
+    Returns:
+        generator of pandas.DataFrame
+    """
+    import pandas as pd
+
+    columns_details = district_rules["validation_rules"].get("columns_details")
+    encoding = district_rules["validation_rules"].get("encoding")
+    delimiter = district_rules["validation_rules"].get("delimiter")
+
+    dtype_plan = build_dtype_plan(district_rules["validation_rules"])
+    dtypes = dtype_plan.read_dtypes
+    row_validator = get_row_validator(district_rules)
+
+    if file_head is not None:
+        encoding = resolve_byte_order(file_head.content, encoding)
+        body = file_head.open()
+    else:
+        body = s3_client.get_object(
+            Bucket=input_bucket_name, Key=prefix)["Body"]
+    reader = pd.read_csv(metrics.timed_reader("download", body), dtype=dtypes,
+                         delimiter=delimiter, encoding=encoding, names=column_names,
+                         header=0, chunksize=chunksize)
+    with reader:
+        for chunk in metrics.timed_iter("parse", reader):
+            valid_chunk = validate_rows(chunk, row_validator, rejected_chunks)
+            if len(valid_chunk) == 0 and len(chunk) > 0:
+                continue
+            with metrics.stage("cast"):
+                valid_chunk = parse_date_columns(dtype_plan.apply(valid_chunk), columns_details)
+            yield valid_chunk
+
+
+def create_table(input_bucket_name, prefix, district_rules, rejected_chunks=None, column_names=None, file_head=None):
+    """
+    This function is create_dataframe for the arrow engine: the file is
+    downloaded and parsed in parallel as a single Arrow table.
+    """
+    import pyarrow as pa
+
+    columns_details = district_rules["validation_rules"].get("columns_details")
+    encoding = district_rules["validation_rules"].get("encoding")
+    delimiter = district_rules["validation_rules"].get("delimiter")
+    dtype_plan = build_dtype_plan(district_rules["validation_rules"])
+
+    file_bytes = read_whole_file(input_bucket_name, prefix, file_head)
+    encoding = resolve_byte_order(file_bytes, encoding)
+
+    with metrics.stage("parse") as stage:
+        table = read_csv_table(pa.BufferReader(file_bytes), dtype_plan, encoding, delimiter, column_names)
+        stage.add(rows=len(table))
+
+    table = validate_table_rows(table, get_row_validator(district_rules), 0, rejected_chunks)
+    with metrics.stage("cast"):
+        return parse_table_date_columns(dtype_plan.apply_table(table), columns_details)
+
+
+def create_table_chunks(input_bucket_name, prefix, district_rules, column_names=None, file_head=None, rejected_chunks=None):
+    """
+    This function is create_dataframe_chunks for the arrow engine.
+    The S3 body is parsed by the CSV reader of pyarrow in blocks of
+    ARROW_BLOCK_SIZE bytes, and each block goes through the same row rules
+    and DtypePlan as a chunk of dataframe, but stays an Arrow table.
+
+    Returns:
+        generator of pyarrow.Table
+    """
+    columns_details = district_rules["validation_rules"].get("columns_details")
+    encoding = district_rules["validation_rules"].get("encoding")
+    delimiter = district_rules["validation_rules"].get("delimiter")
+
+    dtype_plan = build_dtype_plan(district_rules["validation_rules"])
+    row_validator = get_row_validator(district_rules)
+
+    if file_head is not None:
+        encoding = resolve_byte_order(file_head.content, encoding)
+        body = file_head.open()
+    else:
+        body = s3_client.get_object(
+            Bucket=input_bucket_name, Key=prefix)["Body"]
+    tables = read_csv_tables(metrics.timed_reader("download", body), dtype_plan,
+                             encoding, delimiter, column_names)
+    rows_count = 0
+    for table in metrics.timed_iter("parse", tables):
+        valid_table = validate_table_rows(table, row_validator, rows_count, rejected_chunks)
+        rows_count += len(table)
+        if len(valid_table) == 0 and len(table) > 0:
+            continue
+        with metrics.stage("cast"):
+            valid_table = parse_table_date_columns(dtype_plan.apply_table(valid_table), columns_details)
+        yield valid_table
+
+
+def create_sheet_chunks(workbook, sheet_name, district_rules, column_names, chunksize=CHUNK_SIZE_ROWS, rejected_chunks=None):
+    """
+    This function reads a sheet of a workbook as a stream of dataframes.
+    The rows after the header are read in batches of chunksize rows, and
+    each chunk goes through the same row rules and DtypePlan as the chunks
+    of create_dataframe_chunks.
+
+    Parameters:
+        workbook: The workbook returned by spreadsheets.open_workbook.
+        sheet_name (str): The name of the sheet.
+        district_rules (dict): The validation rules of the district.
+        column_names (list): The normalized headers of the sheet.
+        chunksize (int): The maximum number of rows per chunk.
+        rejected_chunks (list or ParquetS3Writer): If given, the rows rejected by the row rules
+            are appended to it, with their reason codes.
+
+    Returns:
+        generator of pandas.DataFrame
+    """
+    import pandas as pd
+
+    columns_details = district_rules["validation_rules"].get("columns_details")
+    dtype_plan = build_dtype_plan(district_rules["validation_rules"])
+    date_columns = {col["header"] for col in columns_details if col["data_type"] == "date"}
+    row_validator = get_row_validator(district_rules)
+
+    columns_count = len(column_names)
+    rows = workbook.iter_rows(sheet_name)
+    next(rows, None)
+    rows_count = 0
+    for records in metrics.timed_iter("parse", iter_record_batches(rows, chunksize)):
+        with metrics.stage("parse"):
+            # Rows are cut to the header, and the empty trailing cells left out by openpyxl are nulls
+            chunk = pd.DataFrame.from_records(
+                [tuple(record[:columns_count]) + (None,) * (columns_count - len(record))
+                 for record in records], columns=column_names)
+            chunk.index = pd.RangeIndex(rows_count, rows_count + len(chunk))
+            rows_count += len(chunk)
+            for column_name, dtype in dtype_plan.read_dtypes.items():
+                if column_name in date_columns:
+                    chunk[column_name] = cast_sheet_dates(chunk[column_name])
+                elif column_name in chunk.columns:
+                    chunk[column_name] = chunk[column_name].astype(dtype)
+        valid_chunk = validate_rows(chunk, row_validator, rejected_chunks)
+        if len(valid_chunk) == 0:
+            continue
+        with metrics.stage("cast"):
+            valid_chunk = parse_date_columns(dtype_plan.apply(valid_chunk), columns_details)
+        yield valid_chunk
+
+
+def add_date_columns_to_chunks(chunks, date_details, file_name, output_base_file_name, add_columns=add_date_columns):
+    """
+    This function applies add_date_columns, or add_columns, to a stream of
+    dataframes. The first chunk is transformed eagerly so the output file
+    name is known before the rest of the stream is consumed.
+
+    Returns:
+        tuple: The generator of transformed chunks and the output file name.
+    """
+    add_chunk_date_columns = metrics.timed("date_enrichment")(add_columns)
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return iter(()), output_base_file_name
+    first_chunk, output_file_name = add_chunk_date_columns(
+        first_chunk, date_details, file_name, output_base_file_name)
+    other_chunks = (add_chunk_date_columns(chunk, date_details, file_name, output_base_file_name)[0]
+                    for chunk in chunks)
+    return itertools.chain([first_chunk], other_chunks), output_file_name
+
+
+def get_s3_records(event):
+    """
+    This function returns every S3 object of an event as (item_identifier, bucket, key) tuples.
+    It accepts S3 event notifications and SQS batches whose messages are
+    S3 event notifications. The item identifier of an SQS record is its
+    messageId, so it can be reported as a batch item failure.
+    """
+    s3_records = []
+    for record in event.get("Records", []):
+        if "s3" in record:
+            s3_records.append((None, record["s3"]["bucket"]["name"],
+                               unquote_plus(record["s3"]["object"]["key"])))
+        elif "body" in record:
+            body = json.loads(record["body"])
+            # s3:TestEvent messages have no Records
+            for s3_record in body.get("Records", []):
+                s3_records.append((record["messageId"],
+                                   s3_record["s3"]["bucket"]["name"],
+                                   unquote_plus(s3_record["s3"]["object"]["key"])))
+    return s3_records
+
+
+def get_batch_workers():
+    """
+    This function sizes the thread pool of a batch with the memory of the Lambda.
+    """
+    memory_size = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1024"))
+    return max(1, min(MAX_BATCH_WORKERS, memory_size // BATCH_MEMORY_PER_WORKER_MB))
+
+
+def process_batch(event):
+    """
+    This function processes every S3 object of an event.
+    The objects are grouped by document key and the rules of each document
+    are loaded once before its files are processed concurrently.
+
+    Returns:
+        list: The item identifiers of the records that failed.
+    """
+    s3_records = get_s3_records(event)
+    groups = {}
+    for s3_record in s3_records:
+        document_key = "/".join(re.split("/", s3_record[2])[:-1])
+        groups.setdefault(document_key, []).append(s3_record)
+
+    failed_records = []
+    with ThreadPoolExecutor(max_workers=get_batch_workers()) as executor:
+        futures = []
+        for document_key, group in groups.items():
+            try:
+                get_rules_item(document_key, compile_district_documents)
+            except Exception as error:
+                print(f"Could not load the rules of {document_key}: {error}")
+            for item_identifier, input_bucket_name, prefix in group:
+                futures.append((item_identifier, prefix, executor.submit(
+                    process_record, input_bucket_name, prefix)))
+        for item_identifier, prefix, future in futures:
+            try:
+                future.result()
+            except Exception:
+                failed_records.append((item_identifier, prefix))
+    return failed_records
+
+
+def process_record(input_bucket_name, prefix):
+    """
+    This function processes a file and queues its status notification.
+    """
+    try:
+        processed = process_file(input_bucket_name, prefix)
+    except Exception as error:
+        print(f"Failed to process {prefix}: {error}")
+        notifier.notify(FAILURE_TOPIC_NAME, {"bucket": input_bucket_name, "key": prefix,
+                                             "status": "failed", "reason": str(error)})
+        raise
+    if processed:
+        notifier.notify(SUCCESS_TOPIC_NAME, {"bucket": input_bucket_name, "key": prefix,
+                                             "status": "processed"})
+    else:
+        notifier.notify(FAILURE_TOPIC_NAME, {"bucket": input_bucket_name, "key": prefix,
+                                             "status": "rejected"})
+    return processed
+
+
 def lambda_handler(event, context):
+    function_name = getattr(context, "function_name", None) or os.getenv(
+        "AWS_LAMBDA_FUNCTION_NAME", "data_integration")
+    with metrics.invocation({"FunctionName": function_name},
+                            {"RequestId": getattr(context, "aws_request_id", None)}):
+        try:
+            failed_records = process_batch(event)
+        finally:
+            notifier.flush()
+    if any(item_identifier is None for item_identifier, _ in failed_records):
+        # S3 notifications have no partial batch response, the invocation is retried
+        raise Exception(
+            f"Failed to process {[prefix for _, prefix in failed_records]}")
+    item_identifiers = sorted({item_identifier for item_identifier, _ in failed_records})
+    return {"batchItemFailures": [{"itemIdentifier": item_identifier}
+                                  for item_identifier in item_identifiers]}
 
-    input_bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
-    prefix = event["Records"][0]["s3"]["object"]["key"]
-    if INPUT_RAW_BUCKET == input_bucket_name:
-        file_exist = False
-        file_extract = None
-        file_properties = False
-
-        file_exist, district_rules, output_base_file_name, file_name, document_key = get_validation_rules(
-            prefix)
-
-        if file_exist:
-            file_extract = get_file_extract(
-                input_bucket_name, prefix, file_name, district_rules)
-
-        if file_extract != None:
-            print(file_extract)
-            if "delimiter" in district_rules["validation_rules"]:
-                delimiter = district_rules["validation_rules"].get("delimiter")
-                file_extract = normalize_headers(
-                    file_extract, delimiter)
-                if "columns_count" in district_rules["validation_rules"]:
-                    number_of_columns_status = validate_file_number_of_columns(
-                        file_extract,
-                        district_rules["validation_rules"].get(
-                            "columns_count"),
-                        delimiter,
-                    )
-                if "columns_details" in district_rules["validation_rules"]:
-                    columns_names_status = validate_file_columns_names(
-                        file_extract,
-                        district_rules["validation_rules"].get(
-                            "columns_details"),
-                        delimiter,
-                    )
-                if number_of_columns_status and columns_names_status:
-                    file_properties = True
-
-        if file_properties:
-            df = create_dataframe(input_bucket_name, prefix, district_rules)
-
-            if "date_details" in district_rules["validation_rules"]:
-                date_details = district_rules["validation_rules"].get(
-                    "date_details")
-
-                df, output_file_name = add_date_columns(
-                    df, date_details, file_name, output_base_file_name)
-            else:
-                output_file_name = output_base_file_name
 
-            output_bucket_name = re.sub(
-                INPUT_RAW_BUCKET, STAGING_ZONE_BUCKET, input_bucket_name)
-            output_prefix = prefix.rsplit(
-                "/", 1)[0] + "/" + output_file_name
+def process_spreadsheet(input_bucket_name, prefix, district_rules, district_key, file_name, output_base_file_name, transitions=None):
+    """
+    This function validates a workbook of the input raw bucket and writes
+    every selected sheet to the staging zone in parquet format.
+
+    The workbook is read with range requests, and the header of every sheet
+    is validated from its first row before any rows are read. With more than
+    one sheet, each one is written to its own file, suffixed with the sheet
+    name. It returns False if the workbook failed a validation. The outcome
+    is recorded in transitions, if given.
+    """
+    validation_rules = district_rules["validation_rules"]
+    file_extension = validation_rules.get("file_extension")
+    if not validate_file_extension(file_name, file_extension):
+        if transitions is not None:
+            transitions.rejected("Invalid file extension")
+        return False
+
+    workbook = open_workbook(
+        S3SeekableFile(s3_client, input_bucket_name, prefix), file_extension)
+    try:
+        sheet_names = select_sheets(
+            workbook.sheet_names, validation_rules.get("sheets"))
+        sheet_headers = {}
+        for sheet_name in sheet_names:
+            header = next(workbook.iter_rows(sheet_name), ())
+            header = [str(value) if value is not None else "" for value in header]
+            # Trailing empty cells are formatting, not columns
+            while header and header[-1] == "":
+                header.pop()
+            header_report = district_rules["header_validator"].validate_headers(header)
+            if not header_report.valid:
+                print(f"Invalid header in sheet {sheet_name}: {header_report.errors}")
+                if transitions is not None:
+                    transitions.rejected(f"Invalid header in sheet {sheet_name}: {header_report.errors}")
+                return False
+            sheet_headers[sheet_name] = header_report.headers
+        if transitions is not None:
+            transitions.validated()
+        content_hash, is_duplicate = handle_duplicate_file(
+            input_bucket_name, prefix, district_key, transitions)
+        if is_duplicate:
+            return True
+
+        output_bucket_name = re.sub(
+            INPUT_RAW_BUCKET, STAGING_ZONE_BUCKET, input_bucket_name)
+        output_keys = []
+        for sheet_name, headers in sheet_headers.items():
+            output_file_name = get_output_file_name(validation_rules, file_name, output_base_file_name)
+            if len(sheet_names) > 1:
+                output_file_name += "_" + get_sheet_suffix(sheet_name)
+            output_prefix = get_output_prefix(
+                prefix, output_file_name, district_key, file_name, district_rules)
+            with get_rejected_rows_writer(input_bucket_name, prefix, output_file_name) as rejected_rows:
+                chunks = create_sheet_chunks(
+                    workbook, sheet_name, district_rules, headers, rejected_chunks=rejected_rows)
+                if "date_details" in validation_rules:
+                    chunks, _ = add_date_columns_to_chunks(
+                        chunks, validation_rules["date_details"], file_name, output_base_file_name)
+                metadata = get_output_metadata(input_bucket_name, prefix, district_key, content_hash)
+                if write_staging_output(chunks, output_bucket_name, output_prefix, metadata):
+                    output_keys.append(output_prefix + ".parquet")
+    finally:
+        workbook.close()
 
-            print(output_file_name)
+    if not output_keys:
+        if transitions is not None:
+            transitions.rejected("No sheet has valid rows")
+        return False
+    if transitions is not None:
+        transitions.transformed(output_keys[0])
+    if content_hash is not None:
+        dedup_index.put(district_key, content_hash, prefix, output_keys[0])
+    return True
 
-            write_df_to_s3_parquet(
-                df, output_bucket_name, output_prefix)
+
+def process_file(input_bucket_name, prefix):
+    """
+    This function validates a file of the input raw bucket and writes it to
+    the staging zone in parquet format. It returns False if the file failed
+    a validation, any other error is raised to the caller.
+
+    The file is copied to the raw zone once it passes the validations, to
+    the landing zone once it is written to the staging zone, and to the error
+    zone, with the reason, when it is rejected or fails.
+    """
+    if INPUT_RAW_BUCKET != input_bucket_name:
+        return False
+    transitions = ZoneTransitions(
+        s3_client, input_bucket_name, prefix, zone_executor,
+        raw_bucket_name=get_zone_bucket_name(input_bucket_name, RAW_ZONE_BUCKET),
+        landing_bucket_name=get_zone_bucket_name(input_bucket_name, LANDING_ZONE_BUCKET),
+        error_bucket_name=get_zone_bucket_name(input_bucket_name, ERROR_ZONE_BUCKET))
+    try:
+        processed = run_file_stages(input_bucket_name, prefix, transitions)
+    except Exception as error:
+        transitions.failed(error)
+        try:
+            transitions.wait()
+        except Exception as copy_error:
+            print(f"Could not copy {prefix} to the error zone: {copy_error}")
+        raise
+    transitions.wait()
+    return processed
+
+
+def run_file_stages(input_bucket_name, prefix, transitions):
+    """
+    This function runs the validation and transformation stages of a file
+    and records their outcome in its zone transitions.
+    """
+    file_head = FileHead(s3_client, input_bucket_name, prefix)
+
+    file_exist, district_rules, output_base_file_name, file_name, document_key = get_validation_rules(
+        prefix)
+    if not file_exist:
+        transitions.rejected("No file rules match the file name")
+        return False
+
+    district_key = district_rules.get("district_key", document_key)
+    if is_spreadsheet(file_name):
+        return process_spreadsheet(
+            input_bucket_name, prefix, district_rules, district_key,
+            file_name, output_base_file_name, transitions)
+
+    with metrics.stage("header_sniff") as stage:
+        file_extract = get_file_extract(
+            input_bucket_name, prefix, file_name, district_rules, file_head)
+        stage.add(bytes_read=len(file_head.content))
+    if file_head.file_size is not None:
+        transitions.set_source(file_head.file_size, file_head.e_tag)
+
+    if file_extract is None:
+        transitions.rejected("Invalid file extension or encoding")
+        return False
+
+    with metrics.stage("header_sniff"):
+        header_report = district_rules["header_validator"].validate(
+            "\n".join(file_extract))
+    if not header_report.valid:
+        transitions.rejected(f"Invalid header: {header_report.errors}")
+        return False
+
+    # Files whose columns changed are rejected before the full download
+    if "schema_baseline" in district_rules["validation_rules"]:
+        with metrics.stage("schema_profile"):
+            schema_drift = get_schema_drift(file_head, district_rules, header_report.headers)
+        if schema_drift:
+            transitions.rejected(f"Schema drift: {schema_drift}")
+            return False
+
+    # The copy to the raw zone runs while the file is transformed
+    transitions.validated()
+    content_hash, is_duplicate = handle_duplicate_file(
+        input_bucket_name, prefix, district_key, transitions)
+    if is_duplicate:
+        return True
+    if get_district_parse_engine(district_rules) == "arrow":
+        create_chunks, create_whole, add_columns = create_table_chunks, create_table, add_table_date_columns
+    else:
+        create_chunks, create_whole, add_columns = create_dataframe_chunks, create_dataframe, add_date_columns
+    validation_rules = district_rules["validation_rules"]
+    output_file_name = get_output_file_name(validation_rules, file_name, output_base_file_name)
+    with get_rejected_rows_writer(input_bucket_name, prefix, output_file_name) as rejected_rows:
+        if STREAMING_MODE:
+            chunks = create_chunks(
+                input_bucket_name, prefix, district_rules, header_report.headers, file_head=file_head,
+                rejected_chunks=rejected_rows)
+            if "date_details" in validation_rules:
+                chunks, _ = add_date_columns_to_chunks(
+                    chunks, validation_rules["date_details"], file_name, output_base_file_name, add_columns)
+        else:
+            df = create_whole(input_bucket_name, prefix, district_rules, rejected_rows,
+                              column_names=header_report.headers, file_head=file_head)
+            if "date_details" in validation_rules:
+                df, _ = add_columns(
+                    df, validation_rules["date_details"], file_name, output_base_file_name)
+            # Like the streaming mode, a file whose rows were all rejected has no output
+            chunks = [df] if len(df) > 0 or rejected_rows.rows_count == 0 else []
+        output_bucket_name = re.sub(
+            INPUT_RAW_BUCKET, STAGING_ZONE_BUCKET, input_bucket_name)
+        output_prefix = get_output_prefix(
+            prefix, output_file_name, district_key, file_name, district_rules)
+        written = write_staging_output(
+            chunks, output_bucket_name, output_prefix,
+            get_output_metadata(input_bucket_name, prefix, district_key, content_hash))
+    if not written:
+        transitions.rejected("Every row failed the row rules")
+        return False
+    transitions.transformed(output_prefix + ".parquet")
+    if content_hash is not None:
+        dedup_index.put(district_key, content_hash,
+                        prefix, output_prefix + ".parquet")
+    return True
@@ -0,0 +1,77 @@
+import json
+import queue
+import threading
+import uuid
+
+# SNS accepts at most 10 messages per publish_batch call
+SNS_BATCH_SIZE = 10
+
+
+class StatusNotifier:
+    """
+    Sends status notifications to SNS topics from a background thread.
+
+    notify only enqueues the message, so it never blocks the processing of a
+    file. The worker thread groups the queued messages per topic and sends
+    them with publish_batch. flush must be called before the handler returns,
+    since Lambda freezes the container, and its threads, after that.
+    """
+
+    def __init__(self, sns_client, resolve_topic_arn):
+        self.sns_client = sns_client
+        self.resolve_topic_arn = resolve_topic_arn
+        self.messages = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def notify(self, topic_name, message):
+        if topic_name is None:
+            return
+        self.start()
+        self.messages.put((topic_name, message))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        """
+        This function blocks until every queued message has been sent.
+        """
+        self.messages.join()
+
+    def run(self):
+        while True:
+            batch = [self.messages.get()]
+            # Take whatever else is already queued, without waiting for it
+            while True:
+                try:
+                    batch.append(self.messages.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.publish(batch)
+            except Exception as error:
+                print(f"Could not send status notifications: {error}")
+            finally:
+                for _ in batch:
+                    self.messages.task_done()
+
+    def publish(self, batch):
+        messages_per_topic = {}
+        for topic_name, message in batch:
+            messages_per_topic.setdefault(topic_name, []).append(message)
+        for topic_name, messages in messages_per_topic.items():
+            topic_arn = self.resolve_topic_arn(topic_name)
+            if topic_arn is None:
+                print(f"SNS topic {topic_name} not found")
+                continue
+            for i in range(0, len(messages), SNS_BATCH_SIZE):
+                entries = [{"Id": uuid.uuid4().hex, "Message": json.dumps(message, default=str)}
+                           for message in messages[i:i + SNS_BATCH_SIZE]]
+                response = self.sns_client.publish_batch(
+                    TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+                if response.get("Failed"):
+                    print(f"Failed status notifications: {response['Failed']}")
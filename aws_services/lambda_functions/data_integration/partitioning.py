@@ -0,0 +1,42 @@
+import os
+from urllib.parse import quote
+
+PARTITIONED_OUTPUT = os.getenv("PARTITIONED_OUTPUT", "false").lower() == "true"
+# Row groups and pages sized for scans, used by the partitioned output and the compaction
+PARQUET_ROW_GROUP_SIZE_ROWS = int(os.getenv("PARQUET_ROW_GROUP_SIZE_ROWS", "1000000"))
+PARQUET_DATA_PAGE_SIZE_BYTES = int(os.getenv("PARQUET_DATA_PAGE_SIZE_BYTES", str(1024 * 1024)))
+# Columns whose value is in the path of a partition instead of in its files
+PARTITION_COLUMNS = ["source_date"]
+
+
+def get_partition_prefix(base_prefix, district_key, source_date=None):
+    """
+    This function returns the Hive style partition of the output of a file:
+    base_prefix/district=<district_key>/source_date=<YYYY-MM-DD>.
+    Files without a source date are only partitioned by district.
+    """
+    partition_prefix = f"{base_prefix}/district={quote(district_key, safe='')}"
+    if source_date is not None:
+        partition_prefix += f"/source_date={source_date:%Y-%m-%d}"
+    return partition_prefix
+
+
+def is_partition_prefix(prefix):
+    """
+    This function returns True if prefix is the path of a partition written by the partitioned output.
+    """
+    return any(part.startswith("district=") for part in prefix.split("/"))
+
+
+def drop_partition_columns(chunks):
+    """
+    This function removes the partition columns from a stream of dataframes,
+    or Arrow tables. Readers take their values from the path, and most of
+    them refuse a column that is both in the path and in the files.
+    """
+    for chunk in chunks:
+        if hasattr(chunk, "column_names"):
+            yield chunk.drop([column_name for column_name in PARTITION_COLUMNS
+                              if column_name in chunk.column_names])
+        else:
+            yield chunk.drop(columns=PARTITION_COLUMNS, errors="ignore")
@@ -0,0 +1,235 @@
+import re
+
+from decimal import Decimal
+
+REJECTION_REASONS_COLUMN = "rejection_reasons"
+ROW_NUMBER_COLUMN = "row_number"
+NUMERIC_TYPES = {"int", "integer", "int8", "int16", "int32", "int64",
+                 "float", "double", "float32", "float64"}
+
+# Builders of the row rules, by name. Each builder receives the details of
+# a column and returns the rule of the column, or None if it does not apply.
+ROW_RULES = {}
+
+
+def row_rule(name):
+    """
+    This function registers a builder of row rules under the given name.
+    The reason code of the rows rejected by a rule is "<name>:<column>".
+    """
+    def register(build_rule):
+        ROW_RULES[name] = build_rule
+        return build_rule
+    return register
+
+
+def to_number(value):
+    # DynamoDB returns every number as a Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def evaluate_on_categories(series, evaluate):
+    """
+    This function evaluates a rule on the categories of a categorical column
+    and broadcasts the result to the rows, so every distinct value is checked
+    only once.
+    """
+    import numpy as np
+
+    invalid_categories = np.asarray(evaluate(series.cat.categories.to_series()), dtype=bool)
+    # The code of the nulls is -1, which takes the trailing False
+    return np.append(invalid_categories, False).take(series.cat.codes.to_numpy())
+
+
+@row_rule("not_null")
+def build_not_null_rule(col):
+    if not col.get("not_null"):
+        return None
+
+    def evaluate(series, state):
+        return series.isna().to_numpy()
+    return evaluate
+
+
+@row_rule("range")
+def build_range_rule(col):
+    if col["data_type"] not in NUMERIC_TYPES or ("min" not in col and "max" not in col):
+        return None
+    minimum = to_number(col.get("min"))
+    maximum = to_number(col.get("max"))
+
+    def evaluate(series, state):
+        invalid = series.notna()
+        out_of_range = False
+        if minimum is not None:
+            out_of_range = series < minimum
+        if maximum is not None:
+            out_of_range = out_of_range | (series > maximum)
+        return (invalid & out_of_range).to_numpy(dtype=bool)
+    return evaluate
+
+
+@row_rule("regex")
+def build_regex_rule(col):
+    if "regex" not in col:
+        return None
+    # Compiled here so an invalid regex fails when the rules are loaded
+    pattern = re.compile(col["regex"]).pattern
+
+    def check(values):
+        matches = values.astype("string").str.fullmatch(pattern)
+        return ~matches.fillna(True).astype(bool)
+
+    def evaluate(series, state):
+        if series.dtype == "category":
+            return evaluate_on_categories(series, check)
+        return check(series).to_numpy(dtype=bool)
+    return evaluate
+
+
+@row_rule("allowed_values")
+def build_allowed_values_rule(col):
+    if "allowed_values" not in col:
+        return None
+    allowed_values = [to_number(value) for value in col["allowed_values"]]
+
+    def evaluate(series, state):
+        return (series.notna() & ~series.isin(allowed_values)).to_numpy(dtype=bool)
+    return evaluate
+
+
+@row_rule("date_format")
+def build_date_format_rule(col):
+    if col["data_type"] != "date" or "date_format" not in col:
+        return None
+    date_format = col["date_format"]
+
+    def evaluate(series, state):
+        import numpy as np
+        import pandas as pd
+
+        # Date columns are read as strings, every distinct value is parsed once
+        codes, uniques = pd.factorize(series)
+        parsed = pd.to_datetime(uniques, format=date_format, errors="coerce")
+        # The code of the nulls is -1, which takes the trailing False
+        return np.append(np.asarray(pd.isna(parsed), dtype=bool), False).take(codes)
+    return evaluate
+
+
+@row_rule("unique")
+def build_unique_rule(col):
+    if not col.get("unique"):
+        return None
+    column_name = col["header"]
+
+    def evaluate(series, state):
+        import numpy as np
+
+        # The values of the previous chunks of the file are kept in the state
+        seen = state.setdefault(column_name, set())
+        values = series.dropna()
+        invalid = values.duplicated(keep="first").to_numpy()
+        # Python scalars hash much faster than numpy scalars
+        items = values.tolist()
+        if seen:
+            invalid |= np.fromiter(map(seen.__contains__, items), dtype=bool, count=len(items))
+        seen.update(items)
+        result = np.zeros(len(series), dtype=bool)
+        result[series.notna().to_numpy()] = invalid
+        return result
+    return evaluate
+
+
+def compile_row_rules(validation_rules):
+    """
+    This function builds the row rules of the columns_details of a district.
+    It returns a list of (reason code, column, rule) tuples.
+    """
+    row_rules = []
+    for col in validation_rules.get("columns_details", []):
+        for name, build_rule in ROW_RULES.items():
+            rule = build_rule(col)
+            if rule is not None:
+                row_rules.append((f"{name}:{col['header']}", col["header"], rule))
+    return row_rules
+
+
+class RowValidator:
+    """
+    Validates the rows of the chunks of a file with the row rules of its district.
+
+    Every rule is evaluated as a boolean mask over a whole column, so no
+    Python code runs per row except for the reason codes of the rejected
+    rows. The validator keeps the state shared by the chunks of a file, such
+    as the values already seen by the unique rules, so a new one must be
+    created for every file.
+    """
+
+    def __init__(self, row_rules):
+        self.row_rules = row_rules
+        self.state = {}
+        self.rejected_rows_count = 0
+
+    @property
+    def columns(self):
+        """
+        The columns checked by at least one rule, in the order of the rules.
+        """
+        return list(dict.fromkeys(column_name for _, column_name, _ in self.row_rules))
+
+    def evaluate(self, chunk):
+        """
+        This function evaluates the row rules on the columns of a chunk.
+        The chunk only needs the columns of the rules.
+
+        Returns:
+            tuple: The mask of the invalid rows and the (reason code, mask)
+                of every rule evaluated.
+        """
+        import numpy as np
+
+        masks = []
+        invalid = np.zeros(len(chunk), dtype=bool)
+        for reason_code, column_name, rule in self.row_rules:
+            if column_name not in chunk.columns:
+                continue
+            mask = rule(chunk[column_name], self.state)
+            masks.append((reason_code, mask))
+            invalid |= mask
+        return invalid, masks
+
+    def add_reasons(self, rejected, invalid, masks):
+        """
+        This function adds the reason codes of the rules they failed, joined
+        with ";", and their 1-based row number in the file to the rejected
+        rows. The index of rejected must be the 0-based row number.
+        """
+        import numpy as np
+
+        reasons = [[] for _ in range(int(invalid.sum()))]
+        for reason_code, mask in masks:
+            for position in np.flatnonzero(mask[invalid]):
+                reasons[position].append(reason_code)
+        rejected[ROW_NUMBER_COLUMN] = rejected.index + 1
+        rejected[REJECTION_REASONS_COLUMN] = [";".join(codes) for codes in reasons]
+        self.rejected_rows_count += len(rejected)
+        return rejected
+
+    def validate(self, chunk):
+        """
+        This function splits a chunk into its valid and rejected rows.
+        The rejected rows get the reason codes of the rules they failed, joined
+        with ";", and their 1-based row number in the file.
+
+        Returns:
+            tuple: The valid rows and the rejected rows, or None if every row is valid.
+        """
+        if not self.row_rules:
+            return chunk, None
+        invalid, masks = self.evaluate(chunk)
+        if not invalid.any():
+            return chunk, None
+        rejected = self.add_reasons(chunk[invalid].copy(), invalid, masks)
+        return chunk[~invalid], rejected
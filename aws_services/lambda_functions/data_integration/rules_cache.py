@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+
+    def __init__(self, value, version, expires_at):
+        self.value = value
+        self.version = version
+        self.expires_at = expires_at
+
+
+class TTLCache:
+    """
+    Size bounded LRU cache whose entries expire after ttl_seconds.
+
+    It is meant to live at module level, so it survives warm Lambda
+    invocations. Expired entries are kept until they are evicted, so the
+    caller can revalidate them with their version instead of reloading them.
+    """
+
+    def __init__(self, ttl_seconds, max_items, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_items = max_items
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        This function returns the cached value of a key,
+        or None if the key is missing or expired.
+        """
+        entry = self.get_entry(key)
+        if entry is None or entry.expires_at <= self.clock():
+            return None
+        return entry.value
+
+    def get_entry(self, key):
+        """
+        This function returns the cache entry of a key, even if it is expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, version=None):
+        with self.lock:
+            self.entries[key] = CacheEntry(
+                value, version, self.clock() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+    def touch(self, key):
+        """
+        This function extends the expiration of a key that is still valid.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.expires_at = self.clock() + self.ttl_seconds
+
+    def invalidate(self, key=None):
+        """
+        This function removes a key from the cache, or every key if none is given.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
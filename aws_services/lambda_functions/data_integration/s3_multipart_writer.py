@@ -0,0 +1,152 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import metrics
+
+# S3 rejects multipart parts smaller than 5 MiB, except for the last one.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MULTIPART_PART_SIZE = max(
+    int(os.getenv("MULTIPART_PART_SIZE_MB", "8")) * 1024 * 1024, MIN_PART_SIZE)
+MULTIPART_CONCURRENCY = int(os.getenv("MULTIPART_CONCURRENCY", "4"))
+
+
+class S3MultipartWriter:
+    """
+    Writable file object that streams its content to an S3 object.
+
+    The bytes are accumulated in a part buffer. Every time the buffer reaches
+    part_size it is handed to a thread pool that uploads it as a multipart
+    part, while the caller keeps writing into a new buffer. At most
+    concurrency parts are held in memory at once, the writer blocks until an
+    upload finishes when that limit is reached.
+
+    Outputs smaller than one part are uploaded with a single put_object call.
+    The user metadata, if given, is set on the object in both cases.
+    If an error is raised inside the with block, or the writer is aborted,
+    the multipart upload is aborted so no orphan parts are left in S3.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, part_size=MULTIPART_PART_SIZE, concurrency=MULTIPART_CONCURRENCY, metadata=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.extra_args = {"Metadata": metadata} if metadata else {}
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.concurrency = max(concurrency, 1)
+        self.upload_id = None
+        self.closed = False
+        self.position = 0
+        self._buffer = bytearray()
+        self._parts = []
+        self._futures = []
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        self._buffer += data
+        self.position += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        with metrics.stage("upload") as stage:
+            self._close()
+            stage.add(bytes_written=self.position)
+
+    def _close(self):
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer), **self.extra_args)
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                self._wait_for_parts()
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={"Parts": sorted(self._parts, key=lambda part: part["PartNumber"])})
+        except Exception:
+            self.abort()
+            raise
+        self._buffer = bytearray()
+        self._shutdown()
+        self.closed = True
+
+    def abort(self):
+        """
+        This function cancels the upload and discards the buffered bytes.
+        """
+        if self.closed:
+            return
+        self._shutdown()
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        self._buffer = bytearray()
+        self.closed = True
+
+    def _submit_part(self, part):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, **self.extra_args)
+            self.upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        part_number = len(self._futures) + 1
+        # Blocking here means the uploads are slower than the encoding
+        with metrics.stage("upload"):
+            self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload_part, part_number, part)
+        except Exception:
+            self._slots.release()
+            raise
+        self._futures.append(future)
+        # Surface upload errors as soon as possible instead of at close.
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _upload_part(self, part_number, part):
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number, Body=part)
+            self._parts.append(
+                {"PartNumber": part_number, "ETag": response["ETag"]})
+        finally:
+            self._slots.release()
+
+    def _wait_for_parts(self):
+        for future in self._futures:
+            future.result()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,268 @@
+"""
+Sampled schema profile of a delimited file, and its drift from the baseline
+of its district.
+
+The profile is taken on the first rows of the file, from the head already
+downloaded to validate its header, so a file whose columns changed type,
+date format or null rate is rejected before the rest of it is downloaded.
+The baseline is stored in the validation rules of the district, under
+"schema_baseline", and is built by running this module on a known good
+file from the data_integration directory:
+
+    python schema_profile.py --bucket <input raw bucket> --key <file key> [--save]
+
+A baseline looks like:
+
+    {"columns": {"frame": {"type": "integer", "null_rate": 0.0},
+                 "fecha": {"type": "date", "date_format": "%Y%m%d", "null_rate": 0.0}},
+     "max_mismatch_rate": 0.01, "max_null_rate_increase": 0.1}
+
+The thresholds are optional, SCHEMA_DRIFT_MAX_MISMATCH_RATE and
+SCHEMA_DRIFT_MAX_NULL_RATE_INCREASE apply to the baselines without them.
+"""
+import argparse
+import codecs
+import csv
+import io
+import json
+import os
+import re
+from datetime import datetime
+from decimal import Decimal
+
+SCHEMA_PROFILE_SAMPLE_BYTES = int(os.getenv("SCHEMA_PROFILE_SAMPLE_BYTES", str(256 * 1024)))
+SCHEMA_PROFILE_MAX_ROWS = int(os.getenv("SCHEMA_PROFILE_MAX_ROWS", "1000"))
+SCHEMA_DRIFT_MAX_MISMATCH_RATE = float(os.getenv("SCHEMA_DRIFT_MAX_MISMATCH_RATE", "0.01"))
+SCHEMA_DRIFT_MAX_NULL_RATE_INCREASE = float(os.getenv("SCHEMA_DRIFT_MAX_NULL_RATE_INCREASE", "0.1"))
+# Null rates of fewer rows are too noisy to be compared
+SCHEMA_DRIFT_MIN_ROWS = int(os.getenv("SCHEMA_DRIFT_MIN_ROWS", "50"))
+# Values read as nulls by read_csv
+NULL_VALUES = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+               "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "n/a", "nan", "null"}
+# Date formats tried by the profile, in order of preference
+DATE_FORMATS = ["%Y-%m-%d", "%Y%m%d", "%d/%m/%Y", "%m/%d/%Y", "%Y/%m/%d", "%d-%m-%Y",
+                "%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S"]
+INTEGER_PATTERN = re.compile(r"[+-]?\d+")
+EXAMPLES_COUNT = 3
+
+
+def is_null(value):
+    return value.strip() in NULL_VALUES
+
+
+def is_integer(value):
+    return INTEGER_PATTERN.fullmatch(value.strip()) is not None
+
+
+def is_float(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def is_date(value, date_format):
+    try:
+        datetime.strptime(value.strip(), date_format)
+    except ValueError:
+        return False
+    return True
+
+
+def get_sample_rows(content, encoding, delimiter, eof=False, max_rows=SCHEMA_PROFILE_MAX_ROWS):
+    """
+    This function parses the rows of the head of a file, without its header.
+    Unless the head is the whole file, its last record may be cut and is left
+    out. It is the last parsed row, not the text after the last line break,
+    which may be inside a quoted value.
+
+    Parameters:
+        content (bytes): The first bytes of the file.
+        encoding (str): The encoding of the file.
+        delimiter (str): The field delimiter of the file.
+        eof (bool): True if content is the whole file.
+        max_rows (int): The maximum number of rows returned.
+
+    Returns:
+        list: The fields of every row.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    text = decoder.decode(bytes(content), final=eof)
+    rows = csv.reader(io.StringIO(text, newline=""), delimiter=delimiter)
+    next(rows, None)
+    sample = []
+    for row in rows:
+        if len(sample) >= max_rows:
+            return sample
+        if row:
+            sample.append(row)
+    if not eof and sample:
+        sample.pop()
+    return sample
+
+
+def profile_column(values, date_format=None):
+    """
+    This function infers the type of a column from a sample of its values:
+    integer, float, date (with its date format) or string. A column with
+    only nulls has no type. The date format declared for the column, if
+    given, is tried first: "%Y%m%d" dates are also integers.
+
+    Returns:
+        dict: The type, date format and null rate of the column.
+    """
+    not_null = [value for value in values if not is_null(value)]
+    profile = {"null_rate": round(1 - len(not_null) / len(values), 4) if values else 0.0}
+    if not not_null:
+        profile["type"] = None
+    elif date_format is not None and all(is_date(value, date_format) for value in not_null):
+        profile.update(type="date", date_format=date_format)
+    elif all(map(is_integer, not_null)):
+        profile["type"] = "integer"
+    elif all(map(is_float, not_null)):
+        profile["type"] = "float"
+    else:
+        profile["type"] = "string"
+        for date_format in DATE_FORMATS:
+            if all(is_date(value, date_format) for value in not_null):
+                profile.update(type="date", date_format=date_format)
+                break
+    return profile
+
+
+def profile_rows(column_names, rows, columns_details=None):
+    """
+    This function profiles every column of a sample of rows, with the date
+    formats of the columns details of the district, if given.
+
+    Returns:
+        dict: The number of rows of the sample and the profile of every column.
+    """
+    date_formats = {col["header"]: col["date_format"] for col in columns_details or []
+                    if col["data_type"] == "date" and "date_format" in col}
+    columns = {}
+    for i, column_name in enumerate(column_names):
+        columns[column_name] = profile_column(
+            [row[i] if i < len(row) else "" for row in rows], date_formats.get(column_name))
+    return {"rows": len(rows), "columns": columns}
+
+
+def conforms(value, column_baseline):
+    """
+    This function returns True if a value that is not null has the type of the baseline of its column.
+    """
+    column_type = column_baseline.get("type")
+    if column_type == "integer":
+        return is_integer(value)
+    if column_type == "float":
+        return is_float(value)
+    if column_type == "date":
+        return is_date(value, column_baseline["date_format"])
+    return True
+
+
+def find_schema_drift(column_names, rows, baseline):
+    """
+    This function compares a sample of rows to the baseline of its district.
+    A column drifts when more than max_mismatch_rate of its values do not
+    have the type, or date format, of the baseline, or when its null rate
+    grew by more than max_null_rate_increase. Null rates are only compared
+    on samples of SCHEMA_DRIFT_MIN_ROWS rows or more.
+
+    Returns:
+        list: One dict per drift, empty if the sample matches the baseline.
+    """
+    max_mismatch_rate = float(baseline.get("max_mismatch_rate", SCHEMA_DRIFT_MAX_MISMATCH_RATE))
+    max_null_rate_increase = float(baseline.get(
+        "max_null_rate_increase", SCHEMA_DRIFT_MAX_NULL_RATE_INCREASE))
+    positions = {column_name: i for i, column_name in enumerate(column_names)}
+    drift = []
+    for column_name, column_baseline in baseline.get("columns", {}).items():
+        if column_name not in positions:
+            drift.append({"check": "missing_column", "column": column_name})
+            continue
+        i = positions[column_name]
+        values = [row[i] if i < len(row) else "" for row in rows]
+        not_null = [value for value in values if not is_null(value)]
+
+        mismatches = [value for value in not_null if not conforms(value, column_baseline)]
+        if not_null and len(mismatches) / len(not_null) > max_mismatch_rate:
+            expected = column_baseline["type"]
+            if expected == "date":
+                expected += " " + column_baseline["date_format"]
+            drift.append({"check": "type", "column": column_name, "expected": expected,
+                          "mismatch_rate": round(len(mismatches) / len(not_null), 4),
+                          "examples": mismatches[:EXAMPLES_COUNT]})
+
+        if len(values) >= SCHEMA_DRIFT_MIN_ROWS:
+            null_rate = 1 - len(not_null) / len(values)
+            baseline_null_rate = float(column_baseline.get("null_rate", 0))
+            if null_rate - baseline_null_rate > max_null_rate_increase:
+                drift.append({"check": "null_rate", "column": column_name,
+                              "expected": baseline_null_rate, "found": round(null_rate, 4)})
+    return drift
+
+
+def build_baseline(profile, max_mismatch_rate=None, max_null_rate_increase=None):
+    """
+    This function builds the baseline of a district from the profile of a
+    known good file. Columns without a type, only nulls in the sample, are
+    left out.
+    """
+    columns = {}
+    for column_name, column_profile in profile["columns"].items():
+        if column_profile["type"] is not None:
+            columns[column_name] = column_profile
+    baseline = {"columns": columns}
+    if max_mismatch_rate is not None:
+        baseline["max_mismatch_rate"] = max_mismatch_rate
+    if max_null_rate_increase is not None:
+        baseline["max_null_rate_increase"] = max_null_rate_increase
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--bucket", default=os.getenv("INPUT_RAW_BUCKET"),
+                        help="bucket of the file, INPUT_RAW_BUCKET by default")
+    parser.add_argument("--key", required=True, help="key of a known good file of the district")
+    parser.add_argument("--sample-bytes", type=int, default=SCHEMA_PROFILE_SAMPLE_BYTES)
+    parser.add_argument("--max-mismatch-rate", type=float)
+    parser.add_argument("--max-null-rate-increase", type=float)
+    parser.add_argument("--save", action="store_true",
+                        help="store the baseline in the validation rules of the district")
+    args = parser.parse_args()
+
+    import main_data_integration
+    from file_head import FileHead
+
+    file_exist, district_rules, _, _, _ = main_data_integration.get_validation_rules(args.key)
+    if not file_exist:
+        parser.error(f"No file rules match {args.key}")
+    validation_rules = district_rules["validation_rules"]
+    file_head = FileHead(main_data_integration.s3_client, args.bucket, args.key)
+    while len(file_head.content) < args.sample_bytes and not file_head.eof:
+        file_head.fetch()
+    rows = get_sample_rows(file_head.content, validation_rules["encoding"],
+                           validation_rules["delimiter"], file_head.eof)
+    header = file_head.content.decode(validation_rules["encoding"], errors="replace")
+    header_report = district_rules["header_validator"].validate(header)
+    profile = profile_rows(header_report.headers, rows, validation_rules.get("columns_details"))
+    baseline = build_baseline(profile, args.max_mismatch_rate, args.max_null_rate_increase)
+    print(json.dumps({"rows": profile["rows"], "schema_baseline": baseline}, indent=2))
+
+    if args.save:
+        district_key = district_rules["document_key"]
+        # The version bump makes the warm Lambdas reload the rules from their cache
+        main_data_integration.table.update_item(
+            Key={"document_key": district_key},
+            UpdateExpression="SET validation_rules.schema_baseline = :baseline ADD #version :one",
+            ExpressionAttributeNames={"#version": "version"},
+            ExpressionAttributeValues={":baseline": json.loads(json.dumps(baseline), parse_float=Decimal),
+                                       ":one": 1})
+        print(f"Saved the baseline of {district_key}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import io
+import os
+import re
+
+SPREADSHEET_EXTENSIONS = {"xls", "xlsx", "xlsm", "xlsb"}
+# Size of the range requests of the zip based formats
+SPREADSHEET_READ_BUFFER_BYTES = int(os.getenv("SPREADSHEET_READ_BUFFER_BYTES", str(4 * 1024 * 1024)))
+
+# Packages of the spreadsheet formats (openpyxl, pyxlsb and xlrd) are
+# imported by the workbook that needs them, like pandas in the other modules.
+
+
+def is_spreadsheet(file_name):
+    return file_name.rsplit(".", 1)[-1].lower() in SPREADSHEET_EXTENSIONS
+
+
+class OpenpyxlWorkbook:
+    """
+    xlsx and xlsm workbook read with openpyxl in read-only mode.
+    Rows are parsed from the sheet XML as they are iterated, so only the
+    shared strings of the workbook are held in memory.
+    """
+
+    def __init__(self, file_object):
+        import openpyxl
+
+        self.workbook = openpyxl.load_workbook(
+            file_object, read_only=True, data_only=True, keep_links=False)
+
+    @property
+    def sheet_names(self):
+        return self.workbook.sheetnames
+
+    def iter_rows(self, sheet_name):
+        worksheet = self.workbook[sheet_name]
+        # The dimensions saved by some writers are wrong and would cut the rows
+        worksheet.reset_dimensions()
+        return worksheet.iter_rows(values_only=True)
+
+    def close(self):
+        self.workbook.close()
+
+
+class PyxlsbWorkbook:
+    """
+    xlsb workbook read with pyxlsb, which parses the binary sheet records as
+    they are iterated. Dates are returned as Excel serial numbers.
+    """
+
+    def __init__(self, file_object):
+        import pyxlsb
+
+        self.workbook = pyxlsb.open_workbook(file_object)
+
+    @property
+    def sheet_names(self):
+        return self.workbook.sheets
+
+    def iter_rows(self, sheet_name):
+        with self.workbook.get_sheet(sheet_name) as sheet:
+            for row in sheet.rows():
+                yield tuple(cell.v for cell in row)
+
+    def close(self):
+        self.workbook.close()
+
+
+class XlrdWorkbook:
+    """
+    xls workbook read with xlrd. The BIFF format has no index of its sheets,
+    so the whole file is downloaded, but the sheets are only parsed when
+    they are used (on_demand). Dates are returned as Excel serial numbers.
+    """
+
+    def __init__(self, file_object):
+        import xlrd
+
+        self.workbook = xlrd.open_workbook(
+            file_contents=file_object.read(), on_demand=True)
+
+    @property
+    def sheet_names(self):
+        return self.workbook.sheet_names()
+
+    def iter_rows(self, sheet_name):
+        import xlrd
+
+        sheet = self.workbook.sheet_by_name(sheet_name)
+        for row in sheet.get_rows():
+            yield tuple(None if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK) else cell.value
+                        for cell in row)
+
+    def close(self):
+        self.workbook.release_resources()
+
+
+WORKBOOK_READERS = {"xlsx": OpenpyxlWorkbook, "xlsm": OpenpyxlWorkbook,
+                    "xlsb": PyxlsbWorkbook, "xls": XlrdWorkbook}
+
+
+def open_workbook(raw_file, extension, buffer_size=SPREADSHEET_READ_BUFFER_BYTES):
+    """
+    This function opens a workbook from a seekable raw binary stream,
+    usually an S3SeekableFile, with the reader of its extension.
+    """
+    file_object = io.BufferedReader(raw_file, buffer_size=buffer_size)
+    return WORKBOOK_READERS[extension.lower()](file_object)
+
+
+def select_sheets(sheet_names, sheets=None):
+    """
+    This function returns the sheets of a workbook to process, in workbook order.
+    sheets is the "sheets" validation rule: a list of sheet names, "*" for
+    every sheet, or None for the first sheet only. Missing sheets raise a
+    ValueError.
+    """
+    if sheets is None:
+        return sheet_names[:1]
+    if sheets == "*":
+        return list(sheet_names)
+    missing_sheets = [sheet for sheet in sheets if sheet not in sheet_names]
+    if missing_sheets:
+        raise ValueError(f"Missing sheets {missing_sheets} in workbook with {sheet_names}")
+    return [sheet for sheet in sheet_names if sheet in sheets]
+
+
+def get_sheet_suffix(sheet_name):
+    """
+    This function turns a sheet name into a suffix for the output file name.
+    """
+    return re.sub(r"[^a-z0-9]+", "_", sheet_name.lower()).strip("_")
+
+
+def iter_record_batches(rows, batch_size):
+    """
+    This function groups the rows of a sheet in lists of at most batch_size
+    rows. Empty rows are skipped, writers often leave them at the end of a sheet.
+    """
+    batch = []
+    for row in rows:
+        if all(value is None or value == "" for value in row):
+            continue
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def cast_sheet_dates(values):
+    """
+    This function converts the dates of a sheet column to datetimes.
+    Cells formatted as dates are already datetimes with openpyxl, while xls
+    and xlsb readers return Excel serial numbers; strings are left for the
+    date_format of the column.
+    """
+    import pandas as pd
+
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_datetime(values, unit="D", origin="1899-12-30")
+    return values.astype("string")
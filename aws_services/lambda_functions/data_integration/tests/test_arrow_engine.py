@@ -0,0 +1,103 @@
+import io
+import unittest
+
+import pyarrow as pa
+
+from arrow_engine import (add_table_date_columns, get_parse_engine, parse_table_date_columns,
+                          read_csv_tables, validate_table)
+from dtype_plan import build_dtype_plan
+from row_rules import RowValidator, compile_row_rules
+
+validation_rules = {
+    "columns_details": [
+        {"header": "zona", "data_type": "string", "categorical": True},
+        {"header": "ing", "data_type": "string", "not_null": True},
+        {"header": "frame", "data_type": "int64", "min": 0, "max": 200},
+        {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+    ],
+}
+
+
+class TestArrowEngine(unittest.TestCase):
+
+    def test_get_parse_engine(self):
+        self.assertEqual(get_parse_engine({}), "pandas")
+        self.assertEqual(get_parse_engine({"parse_engine": "arrow"}), "arrow")
+        with self.assertRaises(ValueError):
+            get_parse_engine({"parse_engine": "polars"})
+
+    def test_read_csv_tables(self):
+        data = "ZONA;ING;FRAME;FECHA\n" + "".join(
+            f"A;ñ{i};{i};2023011{i % 10}\n" for i in range(40))
+        dtype_plan = build_dtype_plan(validation_rules)
+        tables = list(read_csv_tables(
+            io.BytesIO(data.encode("latin-1")), dtype_plan, "latin-1", ";",
+            column_names=["zona", "ing", "frame", "fecha"], block_size=256))
+
+        self.assertGreater(len(tables), 1)
+        self.assertEqual(sum(len(table) for table in tables), 40)
+        schema = tables[0].schema
+        self.assertEqual(schema.field("zona").type, pa.dictionary(pa.int32(), pa.string()))
+        self.assertEqual(schema.field("frame").type, pa.int64())
+        self.assertEqual(schema.field("fecha").type, pa.string())
+        self.assertEqual(tables[0]["ing"][0].as_py(), "ñ0")
+
+        table = parse_table_date_columns(dtype_plan.apply_table(tables[0]),
+                                         validation_rules["columns_details"])
+        self.assertEqual(table.schema.field("frame").type, pa.uint8())
+        self.assertEqual(table.schema.field("fecha").type, pa.timestamp("ns"))
+
+    def test_read_csv_tables_quoted_line_breaks(self):
+        data = 'ZONA;ING;FRAME;FECHA\n' + "".join(
+            f'A;"line {i}\nnext";{i};20230110\n' for i in range(40))
+        tables = list(read_csv_tables(
+            io.BytesIO(data.encode("utf-8")), build_dtype_plan(validation_rules), "utf-8", ";",
+            column_names=["zona", "ing", "frame", "fecha"], block_size=256))
+
+        self.assertGreater(len(tables), 1)
+        self.assertEqual(sum(len(table) for table in tables), 40)
+        self.assertEqual(tables[0]["ing"][1].as_py(), "line 1\nnext")
+
+    def test_validate_table(self):
+        validator = RowValidator(compile_row_rules(validation_rules))
+        table = pa.table({"zona": ["A", "B", "C"], "ing": ["x", None, "z"],
+                          "frame": [1, 2, 300], "fecha": ["20230110", "20230111", "2023"]})
+
+        valid, rejected = validate_table(table, validator, first_row=10)
+
+        self.assertEqual(valid["zona"].to_pylist(), ["A"])
+        self.assertEqual(rejected["zona"].tolist(), ["B", "C"])
+        self.assertEqual(rejected["row_number"].tolist(), [12, 13])
+        self.assertEqual(rejected["rejection_reasons"].tolist(),
+                         ["not_null:ing", "range:frame;date_format:fecha"])
+        self.assertIs(validate_table(valid, validator)[0], valid)
+
+    def test_auto_categorical_columns(self):
+        dtype_plan = build_dtype_plan({
+            "columns_details": [{"header": "ing", "data_type": "string"}],
+            "dtype_plan": {"auto_categorical_ratio": 0.5},
+        })
+        table = dtype_plan.apply_table(pa.table({"ing": ["a", "a", "a", "b"]}))
+        self.assertTrue(pa.types.is_dictionary(table.schema.field("ing").type))
+        # The decision of the first table holds for the next ones
+        table = dtype_plan.apply_table(pa.table({"ing": ["c", "d"]}))
+        self.assertTrue(pa.types.is_dictionary(table.schema.field("ing").type))
+
+    def test_add_table_date_columns(self):
+        table = pa.table({"fecha": ["2023-01-10", None]})
+        date_details = {
+            "parameter_date": "fecha",
+            "source_date": {"date_regex": r"\d{8}", "date_format": "%Y%m%d"},
+        }
+        table, output_file_name = add_table_date_columns(
+            table, date_details, "20210101_test_file.csv", "test_file")
+
+        self.assertEqual(output_file_name, "20210101_test_file")
+        self.assertEqual(table.column_names, ["fecha", "parameter_date", "source_date"])
+        self.assertEqual(table.schema.field("source_date").type, pa.timestamp("ns"))
+        self.assertEqual(str(table["source_date"][1].as_py()), "2021-01-01 00:00:00")
+        self.assertIsNone(table["parameter_date"][1].as_py())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from unittest import mock
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import backfill
+import main_data_integration
+
+
+def get_file(key, e_tag='"e"', size=10):
+    return {"Key": key, "ETag": e_tag, "Size": size}
+
+
+class TestBackfill(unittest.TestCase):
+
+    def test_list_input_files(self):
+        s3_client = mock.Mock()
+        s3_client.get_paginator.return_value.paginate.return_value = [
+            {"Contents": [get_file("doc/a/"), get_file("doc/a/1.csv")]},
+            {"Contents": [get_file("doc/b/2.csv")]},
+            {},
+        ]
+        files = backfill.list_input_files(s3_client, "input", "doc/")
+        self.assertEqual([s3_object["Key"] for s3_object in files], ["doc/a/1.csv", "doc/b/2.csv"])
+
+    def test_plan_tasks(self):
+        files = [get_file(f"doc/a/{i}.csv") for i in range(5)] + [get_file("doc/b/0.csv")]
+        done = {"doc/a/0.csv": ('"e"', "district_a", 2), "doc/a/1.csv": ('"old"', "district_a", 2),
+                "doc/b/0.csv": ('"e"', "district_b", 1)}
+        # The rules of district_b changed since doc/b/0.csv was processed
+        tasks = backfill.plan_tasks(files, done, files_per_task=2,
+                                    versions={"district_a": 2, "district_b": 2})
+        self.assertEqual([(document_key, [s3_object["Key"] for s3_object in task_files])
+                          for document_key, task_files in tasks],
+                         [("doc/a", ["doc/a/1.csv", "doc/a/2.csv"]),
+                          ("doc/a", ["doc/a/3.csv", "doc/a/4.csv"]),
+                          ("doc/b", ["doc/b/0.csv"])])
+
+    def test_read_progress(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            progress_path = os.path.join(tmp_dir, "progress.jsonl")
+            self.assertEqual(backfill.read_progress(progress_path), {})
+            with open(progress_path, "w") as progress_file:
+                for key, etag, status in [("a", '"1"', "processed"), ("b", '"2"', "rejected"),
+                                          ("c", '"3"', "failed"), ("a", '"1"', "failed")]:
+                    progress_file.write(json.dumps({"key": key, "etag": etag, "district_key": "district",
+                                                    "version": 3, "status": status}) + "\n")
+                progress_file.write('{"key": "d", "et')
+            self.assertEqual(backfill.read_progress(progress_path), {"b": ('"2"', "district", 3)})
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = backfill.RateLimiter(2, clock=lambda: now[0], sleep=sleep)
+        for _ in range(4):
+            limiter.acquire()
+        # The first two requests use the burst, the next ones wait half a second each
+        self.assertEqual(sleeps, [0.5, 0.5])
+        now[0] += 10
+        limiter.acquire()
+        self.assertEqual(len(sleeps), 2)
+
+    def test_run_tasks(self):
+        def process_file(input_bucket_name, prefix):
+            if prefix.endswith("bad.csv"):
+                raise ValueError("Broken file")
+            return not prefix.endswith("rejected.csv")
+
+        tasks = backfill.plan_tasks(
+            [get_file("doc/a/ok.csv"), get_file("doc/a/rejected.csv"), get_file("doc/b/bad.csv")],
+            files_per_task=1)
+        results = []
+        with mock.patch.object(main_data_integration, "get_rules_item") as get_rules_item, \
+                mock.patch.object(main_data_integration, "process_file", side_effect=process_file), \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            get_rules_item.return_value.route.return_value = ({"district_key": "district"}, ["file"])
+            backfill.run_tasks(executor, "input", tasks, 1, results.extend)
+
+        statuses = {result["key"]: result["status"] for result in results}
+        self.assertEqual(statuses, {"doc/a/ok.csv": "processed", "doc/a/rejected.csv": "rejected",
+                                    "doc/b/bad.csv": "failed"})
+        self.assertEqual([result["error"] for result in results if "error" in result], ["Broken file"])
+        # The rules of the document, then of the district of every file
+        self.assertEqual(get_rules_item.call_count, 6)
+
+    def test_process_task_records_the_version_of_the_district(self):
+        routing_index = mock.Mock()
+        routing_index.route.side_effect = lambda file_name: (
+            ({"district_key": "district"}, [file_name]) if file_name == "ok.csv" else (None, []))
+        main_data_integration.rules_cache.invalidate()
+        try:
+            main_data_integration.rules_cache.set("district", {}, version=Decimal("7"))
+            with mock.patch.object(main_data_integration, "get_rules_item", return_value=routing_index), \
+                    mock.patch.object(main_data_integration, "process_file", return_value=True):
+                results = backfill.process_task("input", "doc/a", [get_file("doc/a/ok.csv"),
+                                                                   get_file("doc/a/unknown.csv")])
+        finally:
+            main_data_integration.rules_cache.invalidate()
+        self.assertEqual([(result["district_key"], result["version"]) for result in results],
+                         [("district", 7), (None, None)])
+
+    def test_get_rules_version(self):
+        table = mock.Mock()
+        table.get_item.return_value = {"Item": {"version": Decimal("4")}}
+        self.assertEqual(backfill.get_rules_version(table, "doc/a"), 4)
+        table.get_item.return_value = {}
+        self.assertIsNone(backfill.get_rules_version(table, "doc/b"))
+
+    def test_main_rejects_other_buckets(self):
+        with mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch("sys.argv", ["backfill.py", "--bucket", "other-bucket"]), \
+                mock.patch("sys.stderr"), \
+                mock.patch.object(backfill, "list_input_files") as list_input_files:
+            with self.assertRaises(SystemExit):
+                backfill.main()
+        list_input_files.assert_not_called()
+
+    def test_progress(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            progress_path = os.path.join(tmp_dir, "progress.jsonl")
+            progress = backfill.Progress(progress_path, 2)
+            progress.record([{"key": "a", "etag": '"1"', "size": 10, "status": "processed"},
+                             {"key": "b", "etag": '"2"', "size": 5, "status": "failed", "error": "x"}])
+            progress.close()
+            self.assertEqual(progress.get_summary()["statuses"], {"processed": 1, "failed": 1})
+            self.assertEqual(backfill.read_progress(progress_path), {"a": ('"1"', None, None)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import io
+import json
+import os
+import unittest
+from datetime import datetime
+from unittest import mock
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import botocore.exceptions
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import compaction
+import main_data_integration
+from dedup_index import InMemoryDedupIndex
+from partitioning import get_partition_prefix, is_partition_prefix
+from zones import get_output_metadata, get_stage_metadata
+
+
+def get_parquet_bytes(df):
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.getvalue()
+
+
+class TestCompaction(unittest.TestCase):
+
+    def test_get_partition_prefix(self):
+        self.assertEqual(get_partition_prefix("doc/a", "coahuila/sabinas", datetime(2023, 1, 15)),
+                         "doc/a/district=coahuila%2Fsabinas/source_date=2023-01-15")
+        self.assertEqual(get_partition_prefix("doc/a", "sabinas"), "doc/a/district=sabinas")
+        self.assertTrue(is_partition_prefix("doc/a/district=sabinas/source_date=2023-01-15"))
+        self.assertFalse(is_partition_prefix("doc/a"))
+
+    def test_plan_compaction(self):
+        files = [{"Key": "p/a.parquet", "Size": 40},
+                 {"Key": "p/b.parquet", "Size": 500},
+                 {"Key": "p/c.parquet", "Size": 40},
+                 {"Key": "p/d.parquet", "Size": 30},
+                 {"Key": "p/e.parquet", "Size": 90}]
+        self.assertEqual(
+            compaction.plan_compaction(files, target_size=100, small_file_size=100, min_files=2),
+            [["p/a.parquet", "p/c.parquet"]])
+        # Compacted files have no source metadata, they are never compacted again
+        files = [{"Key": "p/compacted_20230101000000_abcd1234.parquet", "Size": 10},
+                 {"Key": "p/f.parquet", "Size": 10}]
+        self.assertEqual(compaction.plan_compaction(files, min_files=2), [])
+
+    def test_compact_files_without_enough_eligible_files(self):
+        objects = {"p/1.parquet": get_parquet_bytes(pd.DataFrame({"frame": [1]})),
+                   "p/2.parquet": get_parquet_bytes(pd.DataFrame({"frame": [2]}))}
+        metadata = {"p/1.parquet": get_output_metadata("input-raw-zone", "doc/a/1.csv", "sabinas")}
+
+        def get_object(Bucket, Key):
+            return {"Body": io.BytesIO(objects[Key]), "Metadata": metadata.get(Key, {})}
+
+        s3_client = main_data_integration.s3_client
+        with mock.patch.object(s3_client, "get_object", side_effect=get_object), \
+                mock.patch.object(s3_client, "put_object") as put_object, \
+                mock.patch.object(s3_client, "delete_objects") as delete_objects:
+            self.assertEqual(compaction.compact_files("staging-zone", "p", sorted(objects)), [])
+        put_object.assert_not_called()
+        delete_objects.assert_not_called()
+
+    def test_lambda_handler(self):
+        partition = "doc/a/district=sabinas/source_date=2023-01-15"
+        objects = {
+            f"{partition}/1.parquet": get_parquet_bytes(pd.DataFrame({"frame": [1, 2]})),
+            f"{partition}/2.parquet": get_parquet_bytes(pd.DataFrame({"frame": [3]})),
+            f"{partition}/3.parquet": get_parquet_bytes(pd.DataFrame({"frame": ["x"]})),
+            f"{partition}/4.parquet": get_parquet_bytes(pd.DataFrame({"frame": [5]})),
+            "doc/a/other.parquet": get_parquet_bytes(pd.DataFrame({"frame": [4]})),
+        }
+        metadata = {key: get_output_metadata("input-raw-zone", f"doc/a/{i}.csv", "sabinas", f"md5:{i}")
+                    for i, key in enumerate(sorted(objects), 1) if not key.endswith("4.parquet")}
+        paginator = mock.Mock()
+        paginator.paginate.return_value = [{"Contents": [
+            {"Key": key, "Size": len(body)} for key, body in sorted(objects.items())]}]
+        # The first file has a duplicate, and its input file and the duplicate are in the landing zone
+        index = InMemoryDedupIndex()
+        index.put("sabinas", "md5:1", "doc/a/1.csv", f"{partition}/1.parquet")
+        index.add_duplicates("sabinas", f"{partition}/1.parquet", ["doc/a/9.csv.duplicate.json"])
+        objects["doc/a/9.csv.duplicate.json"] = json.dumps({
+            "source_key": "doc/a/9.csv", "content_hash": "md5:1",
+            "duplicate_of": {"source_key": "doc/a/1.csv", "output_key": f"{partition}/1.parquet"},
+        }).encode("utf-8")
+        landing = {key: get_stage_metadata("transformation", "transformed", "input-raw-zone", key,
+                                           output_key=f"{partition}/1.parquet")
+                   for key in ["doc/a/1.csv", "doc/a/9.csv"]}
+
+        def get_object(Bucket, Key):
+            return {"Body": io.BytesIO(objects[Key]), "Metadata": metadata.get(Key, {})}
+
+        def put_object(Bucket, Key, Body, **kwargs):
+            objects[Key] = Body
+
+        def head_object(Bucket, Key):
+            if Key not in landing:
+                raise botocore.exceptions.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+            return {"ContentLength": 10, "ETag": '"e"', "Metadata": landing[Key]}
+
+        def copy_object(Bucket, Key, CopySource, Metadata, **kwargs):
+            self.assertEqual((CopySource["Bucket"], CopySource["Key"]), (Bucket, Key))
+            landing[Key] = Metadata
+
+        def delete_objects(Bucket, Delete):
+            for s3_object in Delete["Objects"]:
+                del objects[s3_object["Key"]]
+            return {}
+
+        s3_client = main_data_integration.s3_client
+        with mock.patch.object(s3_client, "get_paginator", return_value=paginator), \
+                mock.patch.object(s3_client, "get_object", side_effect=get_object), \
+                mock.patch.object(s3_client, "put_object", side_effect=put_object), \
+                mock.patch.object(s3_client, "head_object", side_effect=head_object), \
+                mock.patch.object(s3_client, "copy_object", side_effect=copy_object), \
+                mock.patch.object(s3_client, "delete_objects", side_effect=delete_objects), \
+                mock.patch.object(main_data_integration, "dedup_index", index), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "LANDING_ZONE_BUCKET", "landing-zone"):
+            response = compaction.lambda_handler({"bucket": "staging-zone"}, None)
+
+        self.assertEqual(response, {"partitions": 1, "compacted_files": 2})
+        compacted_keys = [key for key in objects if "/compacted_" in key]
+        self.assertEqual(len(compacted_keys), 1)
+        compacted_key = compacted_keys[0]
+        self.assertTrue(compacted_key.startswith(partition + "/"))
+        self.assertEqual(pq.read_table(io.BytesIO(objects[compacted_key]))["frame"].to_pylist(),
+                         [1, 2, 3])
+        # The file with another schema, and the file without source metadata, are left as is
+        self.assertIn(f"{partition}/3.parquet", objects)
+        self.assertIn(f"{partition}/4.parquet", objects)
+        self.assertNotIn(f"{partition}/1.parquet", objects)
+
+        # Every reference to the merged files points to the compacted file
+        self.assertEqual(index.get("sabinas", "md5:1")["output_key"], compacted_key)
+        self.assertEqual(index.get_duplicates("sabinas", compacted_key), ["doc/a/9.csv.duplicate.json"])
+        self.assertEqual(index.get_duplicates("sabinas", f"{partition}/1.parquet"), [])
+        pointer = json.loads(objects["doc/a/9.csv.duplicate.json"])
+        self.assertEqual(pointer["duplicate_of"]["output_key"], compacted_key)
+        for key in ["doc/a/1.csv", "doc/a/9.csv"]:
+            self.assertEqual(landing[key]["diavs-output-key"], compacted_key)
@@ -1,6 +1,8 @@
+import codecs
 import string
 import random
 from aux_data_integration import *
+import pandas as pd
 import unittest
 
 
@@ -32,8 +34,7 @@ class TestDataIntegration(unittest.TestCase):
         expected_extension = "csv"
         self.assertFalse(validate_file_extension(
             file_name, expected_extension))
-    """
-    # This test is commented because i cound not generate a byte object with the desire encoing to test.
+
     def test_validate_file_encoding(self):
         test_bytes_1 = generate_random_string(100000, "utf-8")
         # Test a file with UTF-8 encoding
@@ -45,11 +46,44 @@ class TestDataIntegration(unittest.TestCase):
         self.assertTrue(validate_file_encoding(
             test_bytes_2, "iso-8859-1"))
 
-        # Test a file with a different encoding than expected
+        # ASCII content is valid in any ASCII compatible encoding
         test_bytes_3 = generate_random_string(100000, "utf-8")
         self.assertTrue(validate_file_encoding(
-            test_bytes_3, "iso-8859-1")) 
-    """
+            test_bytes_3, "iso-8859-1"))
+
+        # Test encoding aliases and BOMs
+        text = "ZONA|DISTRIBUCIÓN\nMORELOS_MONCLOVA|ñ\n"
+        self.assertTrue(validate_file_encoding(
+            text.encode("utf-8-sig"), "utf-8"))
+        self.assertTrue(validate_file_encoding(
+            text.encode("windows-1252"), "WINDOWS-1252"))
+        self.assertTrue(validate_file_encoding(
+            text.encode("utf-16"), "utf-16"))
+
+        # utf-16 and utf-32 files without a BOM, or ASCII files, are rejected
+        for data in [text.encode("utf-16-le"), text.encode("utf-16-be"), b"ZONA|FRAME\nA|1\n"]:
+            self.assertFalse(validate_file_encoding(data, "utf-16"))
+            self.assertFalse(validate_file_encoding(data, "utf-32"))
+
+        # Test a file with a different encoding than expected
+        self.assertFalse(validate_file_encoding(
+            text.encode("utf-8"), "windows-1252"))
+        self.assertFalse(validate_file_encoding(
+            text.encode("windows-1252"), "utf-8"))
+
+    def test_resolve_byte_order(self):
+        text = "ZONA|FECHA\n"
+        self.assertEqual(resolve_byte_order(text.encode("utf-16"), "utf-16"), "utf-16")
+        self.assertEqual(resolve_byte_order(codecs.BOM_UTF16_BE + text.encode("utf-16-be"), "UTF-16"), "UTF-16")
+        self.assertEqual(resolve_byte_order(text.encode("utf-16-le"), "utf-16"), "utf-16-le")
+        self.assertEqual(resolve_byte_order(text.encode("utf-32-le"), "utf-32"), "utf-32-le")
+        self.assertEqual(resolve_byte_order(text.encode("utf-8"), "utf-8"), "utf-8")
+
+    def test_detect_encoding(self):
+        # A truncated multibyte character at the end of the sample is allowed
+        sample = "DISTRIBUCIÓN".encode("utf-8")[:-2]
+        self.assertEqual(detect_encoding(sample, "utf-8"), ("utf-8", 1.0))
+        self.assertEqual(detect_encoding(b"abc", "UTF-8"), ("ascii", 1.0))
 
     def test_normalize_headers(self):
         # Test a file with headers containing special characters
@@ -171,8 +205,50 @@ class TestDataIntegration(unittest.TestCase):
         self.assertEqual(
             output_file_name, f"20210101_test_file_{now}")
 
+    def test_parse_dates(self):
+        values = pd.Series(["20230110", None, "20230110", "20230111"], index=[3, 4, 5, 6])
+        dates = parse_dates(values, "%Y%m%d")
+        self.assertEqual(dates.dtype, "datetime64[ns]")
+        self.assertEqual(list(dates.index), [3, 4, 5, 6])
+        self.assertEqual(dates[3], pd.Timestamp("2023-01-10"))
+        self.assertTrue(pd.isna(dates[4]))
+        self.assertEqual(dates[6], pd.Timestamp("2023-01-11"))
+
+        dates = parse_dates(pd.Series([None, None], dtype=object), "%Y%m%d")
+        self.assertEqual(dates.dtype, "datetime64[ns]")
+        self.assertTrue(dates.isna().all())
+        self.assertEqual(len(parse_dates(pd.Series([], dtype=object), "%Y%m%d")), 0)
+
     def test_get_record_delimiter(self):
         file_extension = 'csv'
         encoding = 'utf-8'
         result = get_record_delimiter(file_extension, encoding)
         self.assertEqual(result, '\n')
+        # The fields of a tsv file are split on tabs, its records on line feeds
+        self.assertEqual(get_record_delimiter('tsv', encoding), '\n')
+
+    def test_header_validator(self):
+        validation_rules = {
+            "delimiter": "|",
+            "columns_count": 3,
+            "columns_details": [{"header": "zona"},
+                                {"header": "id_caja_etiqueta"},
+                                {"header": "fecha"}],
+        }
+        validator = compile_header_validator(validation_rules)
+
+        report = validator.validate(
+            'ZONA|"ID CAJA (ETIQUETA)"|FECHA\r\nA|1|20230110')
+        self.assertTrue(report.valid)
+        self.assertEqual(report.headers, ["zona", "id_caja_etiqueta", "fecha"])
+
+        report = validator.validate("zona|id_caja_etiqueta|fecha \nA|1|20230110")
+        self.assertTrue(report.valid)
+        self.assertEqual(report.headers, ["zona", "id_caja_etiqueta", "fecha"])
+
+        report = validator.validate("ZONA|FRAME\nA|1")
+        self.assertFalse(report.valid)
+        self.assertEqual(report.errors, [
+            {"check": "columns_count", "expected": 3, "found": 2},
+            {"check": "columns_names", "unexpected": ["frame"]},
+        ])
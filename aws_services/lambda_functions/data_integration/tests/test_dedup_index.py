@@ -0,0 +1,63 @@
+import hashlib
+import io
+import unittest
+from unittest import mock
+
+from dedup_index import InMemoryDedupIndex, get_content_hash
+
+
+class TestDedupIndex(unittest.TestCase):
+
+    def test_get_content_hash_from_metadata(self):
+        s3_client = mock.Mock()
+        s3_client.head_object.return_value = {"ETag": '"abc-2"', "ChecksumSHA256": "c2hh"}
+        self.assertEqual(get_content_hash(s3_client, "bucket", "key"), "sha256:c2hh")
+
+        s3_client.head_object.return_value = {"ETag": '"abc"'}
+        self.assertEqual(get_content_hash(s3_client, "bucket", "key"), "md5:abc")
+
+        s3_client.head_object.return_value = {"ETag": '"abc-2"'}
+        self.assertEqual(get_content_hash(s3_client, "bucket", "key"), "etag:abc-2")
+        s3_client.get_object.assert_not_called()
+
+    def test_get_content_hash_streaming(self):
+        s3_client = mock.Mock()
+        s3_client.head_object.return_value = {"ETag": '"abc-2"'}
+        s3_client.get_object.return_value = {"Body": io.BytesIO(b"a|b\n1|2\n")}
+        self.assertEqual(get_content_hash(s3_client, "bucket", "key", stream_hash=True),
+                         "sha256-hex:" + hashlib.sha256(b"a|b\n1|2\n").hexdigest())
+        s3_client.get_object.assert_called_once_with(
+            Bucket="bucket", Key="key", IfMatch='"abc-2"')
+
+    def test_in_memory_dedup_index(self):
+        now = [0]
+        index = InMemoryDedupIndex(retention_days=1, max_items=2, clock=lambda: now[0])
+        self.assertTrue(index.put("district", "md5:a", "doc/a.csv", "doc/a.parquet"))
+        self.assertFalse(index.put("district", "md5:a", "doc/b.csv", "doc/b.parquet"))
+        self.assertEqual(index.get("district", "md5:a")["output_key"], "doc/a.parquet")
+        self.assertIsNone(index.get("other_district", "md5:a"))
+
+        # Retention
+        now[0] = 24 * 3600
+        self.assertIsNone(index.get("district", "md5:a"))
+        self.assertTrue(index.put("district", "md5:a", "doc/b.csv", "doc/b.parquet"))
+
+        # Size bound
+        index.put("district", "md5:b", "doc/c.csv", "doc/c.parquet")
+        index.put("district", "md5:c", "doc/d.csv", "doc/d.parquet")
+        self.assertIsNone(index.get("district", "md5:a"))
+        self.assertEqual(len(index.items), 2)
+
+    def test_in_memory_dedup_index_references(self):
+        index = InMemoryDedupIndex()
+        index.put("district", "md5:a", "doc/a.csv", "doc/a.parquet")
+        self.assertFalse(index.replace_output_key("district", "md5:a", "doc/b.parquet", "doc/c.parquet"))
+        self.assertTrue(index.replace_output_key("district", "md5:a", "doc/a.parquet", "doc/c.parquet"))
+        self.assertEqual(index.get("district", "md5:a")["output_key"], "doc/c.parquet")
+
+        index.add_duplicates("district", "doc/c.parquet", ["doc/x.csv.duplicate.json"])
+        index.add_duplicates("district", "doc/c.parquet", ["doc/b.csv.duplicate.json"])
+        self.assertEqual(index.get_duplicates("district", "doc/c.parquet"),
+                         ["doc/b.csv.duplicate.json", "doc/x.csv.duplicate.json"])
+        index.delete_duplicates("district", "doc/c.parquet")
+        self.assertEqual(index.get_duplicates("district", "doc/c.parquet"), [])
@@ -0,0 +1,63 @@
+import unittest
+from decimal import Decimal
+
+import pandas as pd
+
+from dtype_plan import build_dtype_plan, get_smallest_integer_type
+
+
+class TestDtypePlan(unittest.TestCase):
+
+    def test_read_dtypes(self):
+        validation_rules = {
+            "columns_details": [
+                {"header": "zona", "data_type": "string", "categorical": True},
+                {"header": "ing", "data_type": "string"},
+                {"header": "frame", "data_type": "int64", "min": Decimal("0"), "max": Decimal("200")},
+                {"header": "slot", "data_type": "int", "min": -1, "max": 40000},
+                {"header": "latitud", "data_type": "float", "downcast": True},
+                {"header": "longitud", "data_type": "float64"},
+                {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+            ],
+            "dtype_plan": {"string_storage": "python"},
+        }
+        plan = build_dtype_plan(validation_rules)
+        self.assertEqual(plan.read_dtypes, {
+            "zona": "category",
+            "ing": "string[python]",
+            "frame": "int64",
+            "slot": "int64",
+            "latitud": "float32",
+            "longitud": "float64",
+            "fecha": "string",
+        })
+        self.assertEqual(plan.downcast_dtypes, {"frame": "uint8", "slot": "int32"})
+
+        chunk = plan.apply(pd.DataFrame({"frame": pd.Series([0, 200], dtype="int64")}))
+        self.assertEqual(chunk["frame"].dtype, "uint8")
+        self.assertEqual(chunk["frame"].tolist(), [0, 200])
+
+    def test_get_smallest_integer_type(self):
+        self.assertEqual(get_smallest_integer_type(0, 255), "uint8")
+        self.assertEqual(get_smallest_integer_type(-129, 0), "int16")
+        self.assertEqual(get_smallest_integer_type(-1, 2 ** 40), "int64")
+
+    def test_auto_categorical_columns(self):
+        validation_rules = {
+            "columns_details": [
+                {"header": "zona", "data_type": "string"},
+                {"header": "ing", "data_type": "string"},
+            ],
+            "dtype_plan": {"auto_categorical_ratio": Decimal("0.5")},
+        }
+        plan = build_dtype_plan(validation_rules)
+        first_chunk = plan.apply(pd.DataFrame({"zona": ["A", "A", "A", "B"],
+                                               "ing": ["1", "2", "3", "4"]}))
+        self.assertEqual(first_chunk["zona"].dtype, "category")
+        self.assertEqual(first_chunk["ing"].dtype, "object")
+
+        # The decision of the first chunk applies to the next ones
+        second_chunk = plan.apply(pd.DataFrame({"zona": ["C", "D"],
+                                                "ing": ["5", "5"]}))
+        self.assertEqual(second_chunk["zona"].dtype, "category")
+        self.assertEqual(second_chunk["ing"].dtype, "object")
@@ -0,0 +1,68 @@
+import io
+import unittest
+
+from file_head import FileHead, S3SeekableFile
+
+
+class FakeS3Client:
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+        self.objects = {}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        self.ranges.append(Range)
+        start, end = Range.replace("bytes=", "").split("-")
+        end = int(end) + 1 if end else len(self.data)
+        body = self.data[int(start):end]
+        return {"Body": io.BytesIO(body), "ETag": '"etag"',
+                "ContentRange": f"bytes {start}-{end - 1}/{len(self.data)}"}
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.data), "ETag": '"etag"'}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+
+
+class TestFileHead(unittest.TestCase):
+
+    def test_fetch_grows_geometrically(self):
+        s3_client = FakeS3Client(b"x" * 100)
+        file_head = FileHead(s3_client, "bucket", "key", first_range_size=10)
+        self.assertEqual(file_head.fetch(), b"x" * 10)
+        file_head.fetch()
+        file_head.fetch()
+        self.assertEqual(s3_client.ranges,
+                         ["bytes=0-9", "bytes=10-29", "bytes=30-69"])
+        self.assertFalse(file_head.eof)
+        file_head.fetch()
+        self.assertTrue(file_head.eof)
+        self.assertEqual(file_head.fetch(), b"")
+
+    def test_open_reuses_prefetched_bytes(self):
+        data = bytes(range(256)) * 4
+        s3_client = FakeS3Client(data)
+        file_head = FileHead(s3_client, "bucket", "key", first_range_size=100)
+        file_head.fetch()
+        self.assertEqual(file_head.open().read(), data)
+        self.assertEqual(s3_client.ranges, ["bytes=0-99", "bytes=100-"])
+
+    def test_open_small_file_downloads_once(self):
+        s3_client = FakeS3Client(b"a|b\n1|2\n")
+        file_head = FileHead(s3_client, "bucket", "key")
+        file_head.fetch()
+        self.assertEqual(file_head.open().read(), b"a|b\n1|2\n")
+        self.assertEqual(len(s3_client.ranges), 1)
+
+    def test_seekable_file(self):
+        s3_client = FakeS3Client(bytes(range(100)))
+        file_object = io.BufferedReader(S3SeekableFile(s3_client, "bucket", "key"), buffer_size=16)
+
+        file_object.seek(-10, io.SEEK_END)
+        self.assertEqual(file_object.read(), bytes(range(90, 100)))
+        file_object.seek(5)
+        self.assertEqual(file_object.read(3), bytes([5, 6, 7]))
+        self.assertEqual(file_object.read(2), bytes([8, 9]))
+        self.assertEqual(s3_client.ranges, ["bytes=90-99", "bytes=5-20"])
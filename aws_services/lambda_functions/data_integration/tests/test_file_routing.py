@@ -0,0 +1,51 @@
+import unittest
+
+from file_routing import FileRoutingIndex, get_literal_prefix, get_literal_suffix, get_required_literal
+
+
+class TestFileRouting(unittest.TestCase):
+
+    def test_get_literal_prefix(self):
+        self.assertEqual(get_literal_prefix(r"^sabinas_inventory(.*)\.csv$"),
+                         "sabinas_inventory")
+        self.assertEqual(get_literal_prefix(r"^(.*)sabinas\.csv$"), "")
+        self.assertEqual(get_literal_prefix(r"inv\.ab*c"), "inv.a")
+        self.assertEqual(get_literal_prefix(r"^\d{8}_a"), "")
+        self.assertEqual(get_literal_prefix(r"^a_x|^b_y"), "")
+
+    def test_get_literal_suffix(self):
+        self.assertEqual(get_literal_suffix(r"^(.*)sabinas_inventory(.*)\.csv$"),
+                         ".csv")
+        self.assertEqual(get_literal_suffix(r"^(.*)_\d$"), "")
+        self.assertEqual(get_literal_suffix(r"^(.*)\.csv"), "")
+        self.assertEqual(get_literal_suffix(r"^(.*)\.csv?$"), "")
+
+    def test_get_required_literal(self):
+        self.assertEqual(get_required_literal(r"^(.*)([0-9]{8})_acereros_inventory(.*)\.csv$"),
+                         "_acereros_inventory")
+        self.assertEqual(get_required_literal(r"ab\d+xyz\.t"), "xyz.t")
+        self.assertEqual(get_required_literal(r"^x(abc)?yz"), "yz")
+
+    def test_route(self):
+        files = {
+            "acereros": {"file_name_regex": r"^(.*)([0-9]{8})_acereros_inventory(.*)\.csv$",
+                         "district_key": "acereros"},
+            "sabinas": {"file_name_regex": r"^(.*)sabinas_inventory(.*)\.csv$",
+                        "district_key": "sabinas"},
+            "sabinas_txt": {"file_name_regex": r"^sabinas_inventory(.*)\.txt$",
+                            "district_key": "sabinas_txt"},
+            "all": {"file_name_regex": r"^sabinas", "district_key": "all"},
+        }
+        index = FileRoutingIndex(files)
+
+        district_data, matches = index.route("20230115_acereros_inventory.csv")
+        self.assertEqual(district_data["district_key"], "acereros")
+        self.assertEqual(matches, ["acereros"])
+
+        district_data, matches = index.route("sabinas_inventory_1.txt")
+        self.assertEqual(district_data["district_key"], "all")
+        self.assertEqual(matches, ["all", "sabinas_txt"])
+
+        district_data, matches = index.route("unknown.csv")
+        self.assertIsNone(district_data)
+        self.assertEqual(matches, [])
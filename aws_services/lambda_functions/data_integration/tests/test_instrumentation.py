@@ -0,0 +1,147 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import instrumentation
+from instrumentation import NULL_STAGE, InvocationMetrics
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.lines = []
+        self.metrics = InvocationMetrics(enabled=True, namespace="Test",
+                                         clock=self.clock, emit=self.lines.append)
+
+    def test_disabled_metrics_are_no_ops(self):
+        metrics = InvocationMetrics(enabled=False, emit=self.lines.append)
+        chunks = [[1], [2]]
+        body = io.BytesIO(b"a")
+        self.assertIs(metrics.stage("parse"), NULL_STAGE)
+        self.assertIs(metrics.timed_iter("parse", chunks), chunks)
+        self.assertIs(metrics.timed_reader("download", body), body)
+        with metrics.invocation({"FunctionName": "function"}):
+            with metrics.stage("parse") as stage:
+                stage.add(rows=1)
+        self.assertEqual(self.lines, [])
+
+    def test_nested_stages_are_exclusive(self):
+        with self.metrics.invocation({"FunctionName": "function"}, {"RequestId": "id"}):
+            with self.metrics.stage("encode") as stage:
+                self.clock.now += 1
+                with self.metrics.stage("parse"):
+                    self.clock.now += 2
+                self.clock.now += 0.5
+                stage.add(rows=10, bytes_written=100)
+
+        document = json.loads(self.lines[0])
+        self.assertEqual(document["encode_ms"], 1500)
+        self.assertEqual(document["parse_ms"], 2000)
+        self.assertEqual(document["invocation_ms"], 3500)
+        self.assertEqual(document["encode_rows"], 10)
+        self.assertEqual(document["encode_bytes_written"], 100)
+        self.assertNotIn("parse_rows", document)
+        self.assertEqual(document["FunctionName"], "function")
+        self.assertEqual(document["RequestId"], "id")
+        self.assertEqual(document["stage_calls"], {"encode": 1, "parse": 1})
+
+        metric_directive = document["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(metric_directive["Namespace"], "Test")
+        self.assertEqual(metric_directive["Dimensions"], [["FunctionName"]])
+        units = {metric["Name"]: metric["Unit"] for metric in metric_directive["Metrics"]}
+        self.assertEqual(units["encode_ms"], "Milliseconds")
+        self.assertEqual(units["encode_bytes_written"], "Bytes")
+        self.assertEqual(units["parse_max_rss_mb"], "Megabytes")
+        # Every metric of the directive is a field of the document
+        self.assertTrue(all(name in document for name in units))
+
+    def test_timed_iter_and_reader(self):
+        def chunks():
+            for size in [2, 3]:
+                self.clock.now += 1
+                yield list(range(size))
+
+        with self.metrics.invocation():
+            self.assertEqual(list(self.metrics.timed_iter("parse", chunks())), [[0, 1], [0, 1, 2]])
+            reader = self.metrics.timed_reader("download", io.BytesIO(b"abcdef"))
+            self.assertEqual(reader.read(4), b"abcd")
+            self.assertEqual(reader.read(), b"ef")
+
+        document = json.loads(self.lines[0])
+        self.assertEqual(document["parse_rows"], 5)
+        self.assertEqual(document["parse_ms"], 2000)
+        self.assertEqual(document["download_bytes_read"], 6)
+        # One call per item and one for the end of the iterable
+        self.assertEqual(document["stage_calls"], {"parse": 3, "download": 2})
+
+    def test_timed_decorator_and_threads(self):
+        @self.metrics.timed("invoke")
+        def invoke(value):
+            return value * 2
+
+        with self.metrics.invocation():
+            threads = [threading.Thread(target=invoke, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(invoke(2), 4)
+
+        document = json.loads(self.lines[0])
+        self.assertEqual(document["stage_calls"], {"invoke": 5})
+
+    def test_metrics_are_emitted_when_the_handler_raises(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.invocation():
+                with self.metrics.stage("parse"):
+                    raise ValueError("bad file")
+        self.assertEqual(json.loads(self.lines[0])["stage_calls"], {"parse": 1})
+
+        # Every invocation starts from zero
+        with self.metrics.invocation():
+            pass
+        self.assertEqual(json.loads(self.lines[1])["stage_calls"], {})
+
+    def test_max_rss_is_reset_per_invocation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clear_refs = os.path.join(directory, "clear_refs")
+            status = os.path.join(directory, "status")
+            with open(status, "w") as file:
+                file.write("VmPeak:\t 900000 kB\nVmHWM:\t  204800 kB\nVmRSS:\t  102400 kB\n")
+            with mock.patch.object(instrumentation, "PROC_CLEAR_REFS", clear_refs), \
+                    mock.patch.object(instrumentation, "PROC_STATUS", status):
+                with self.metrics.invocation():
+                    with self.metrics.stage("parse"):
+                        pass
+                with open(clear_refs) as file:
+                    self.assertEqual(file.read(), "5")
+
+            document = json.loads(self.lines[0])
+            self.assertEqual(document["invocation_max_rss_mb"], 200)
+            self.assertEqual(document["parse_max_rss_mb"], 200)
+            self.assertEqual(document["max_rss_scope"], "invocation")
+
+            # Without /proc the peak is the one of the process
+            missing = os.path.join(directory, "missing", "clear_refs")
+            with mock.patch.object(instrumentation, "PROC_CLEAR_REFS", missing):
+                with self.metrics.invocation():
+                    pass
+            self.assertEqual(json.loads(self.lines[1])["max_rss_scope"], "process")
+
+
+if __name__ == "__main__":
+    unittest.main()
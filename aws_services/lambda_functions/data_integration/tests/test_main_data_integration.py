@@ -0,0 +1,631 @@
+import io
+import json
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import pandas as pd
+import pyarrow.parquet as pq
+from botocore.response import StreamingBody
+
+import main_data_integration
+from dedup_index import InMemoryDedupIndex
+from file_head import FileHead
+from tests.test_file_head import FakeS3Client
+from tests.test_spreadsheets import get_xlsx_bytes
+
+
+district_rules = {
+    "validation_rules": {
+        "encoding": "utf-8",
+        "delimiter": "|",
+        "columns_details": [
+            {"header": "zona", "data_type": "string"},
+            {"header": "frame", "data_type": "int64"},
+            {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+        ],
+    }
+}
+
+
+def get_streaming_body(data):
+    return {"Body": StreamingBody(io.BytesIO(data), len(data))}
+
+
+class TestMainDataIntegration(unittest.TestCase):
+
+    def test_create_dataframe_chunks(self):
+        data = b"ZONA|FRAME|FECHA\nA|1|20230110\nB|2|20230111\nC|3|20230112\n"
+        with mock.patch.object(main_data_integration.s3_client, "get_object",
+                               return_value=get_streaming_body(data)):
+            chunks = list(main_data_integration.create_dataframe_chunks(
+                "bucket", "prefix", district_rules,
+                column_names=["zona", "frame", "fecha"], chunksize=2))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(list(chunks[0].columns), ["zona", "frame", "fecha"])
+        self.assertEqual(chunks[0]["frame"].dtype, "int64")
+        self.assertEqual(chunks[1]["fecha"].dtype, "datetime64[ns]")
+        self.assertEqual(chunks[1].iloc[0]["fecha"],
+                         pd.to_datetime("2023-01-12"))
+
+    def test_create_dataframe_chunks_null_dates(self):
+        data = b"ZONA|FRAME|FECHA\nA|1|\nB|2|\n"
+        with mock.patch.object(main_data_integration.s3_client, "get_object",
+                               return_value=get_streaming_body(data)):
+            chunks = list(main_data_integration.create_dataframe_chunks(
+                "bucket", "prefix", district_rules, column_names=["zona", "frame", "fecha"]))
+
+        self.assertEqual(chunks[0]["fecha"].dtype, "datetime64[ns]")
+        self.assertTrue(chunks[0]["fecha"].isna().all())
+
+    def test_create_dataframe_chunks_rejected_rows(self):
+        rules = {"validation_rules": {
+            **district_rules["validation_rules"],
+            "columns_details": [
+                {"header": "zona", "data_type": "string", "allowed_values": ["A", "B"]},
+                {"header": "frame", "data_type": "int64", "min": 0, "max": 200, "unique": True},
+                {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+            ],
+        }}
+        data = b"ZONA|FRAME|FECHA\nA|1|20230110\nX|300|20230111\nB|1|2023\nB|2|20230112\n"
+        rejected_chunks = []
+        with mock.patch.object(main_data_integration.s3_client, "get_object",
+                               return_value=get_streaming_body(data)):
+            chunks = list(main_data_integration.create_dataframe_chunks(
+                "bucket", "prefix", rules, column_names=["zona", "frame", "fecha"],
+                chunksize=2, rejected_chunks=rejected_chunks))
+
+        df = pd.concat(chunks)
+        self.assertEqual(df["frame"].tolist(), [1, 2])
+        self.assertEqual(df["frame"].dtype, "uint8")
+        rejected = pd.concat(rejected_chunks)
+        self.assertEqual(rejected["row_number"].tolist(), [2, 3])
+        self.assertEqual(rejected["rejection_reasons"].tolist(),
+                         ["allowed_values:zona;range:frame", "unique:frame;date_format:fecha"])
+
+    def test_create_table_chunks_matches_pandas(self):
+        rules = {"validation_rules": {
+            **district_rules["validation_rules"],
+            "columns_details": [
+                {"header": "zona", "data_type": "string", "allowed_values": ["A", "B"]},
+                {"header": "frame", "data_type": "int64", "min": 0, "max": 200, "unique": True},
+                {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+            ],
+        }}
+        data = b"ZONA|FRAME|FECHA\nA|1|20230110\nX|300|20230111\nB|1|2023\nB|2|20230112\n"
+        results = {}
+        for create_chunks in [main_data_integration.create_dataframe_chunks,
+                              main_data_integration.create_table_chunks]:
+            rejected_chunks = []
+            with mock.patch.object(main_data_integration.s3_client, "get_object",
+                                   return_value=get_streaming_body(data)):
+                chunks = list(create_chunks(
+                    "bucket", "prefix", rules, column_names=["zona", "frame", "fecha"],
+                    rejected_chunks=rejected_chunks))
+            results[create_chunks.__name__] = (chunks, pd.concat(rejected_chunks))
+
+        with mock.patch.object(main_data_integration.s3_client, "get_object",
+                               return_value=get_streaming_body(data.replace(b"ZONA|FRAME|FECHA", b"zona|frame|fecha"))):
+            # Like create_dataframe, the header of the file names the columns
+            whole_table = main_data_integration.create_table("bucket", "prefix", rules)
+        self.assertEqual(whole_table["frame"].to_pylist(), [1, 2])
+
+        tables, rejected = results["create_table_chunks"]
+        df, pandas_rejected = results["create_dataframe_chunks"]
+        table = tables[0]
+        self.assertEqual(str(table.schema.field("frame").type), "uint8")
+        self.assertEqual(str(table.schema.field("fecha").type), "timestamp[ns]")
+        pd.testing.assert_frame_equal(table.to_pandas(), pd.concat(df).reset_index(drop=True),
+                                      check_dtype=False)
+        self.assertEqual(rejected["row_number"].tolist(), pandas_rejected["row_number"].tolist())
+        self.assertEqual(rejected["rejection_reasons"].tolist(),
+                         pandas_rejected["rejection_reasons"].tolist())
+
+    def test_process_file_parse_engine(self):
+        rules = main_data_integration.compile_district_rules({
+            "district_key": "district",
+            "validation_rules": {**district_rules["validation_rules"], "parse_engine": "arrow",
+                                 "date_details": {"source_date": {"date_regex": r"\d{8}",
+                                                                  "date_format": "%Y%m%d"}}},
+        })
+        self.assertEqual(rules["parse_engine"], "arrow")
+        s3_client = FakeS3Client(b"ZONA|FRAME|FECHA\nA|1|20230110\nB|2|20230111\n")
+        with mock.patch.object(main_data_integration, "s3_client", s3_client), \
+                mock.patch.object(main_data_integration, "dedup_index", None), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "STAGING_ZONE_BUCKET", "staging-zone"), \
+                mock.patch.object(main_data_integration, "get_validation_rules",
+                                  return_value=(True, rules, "out", "20230102_file.csv", "doc/a")), \
+                mock.patch.object(main_data_integration, "get_file_extract",
+                                  return_value=["ZONA|FRAME|FECHA", "A|1|20230110"]):
+            self.assertTrue(main_data_integration.process_file(
+                "input-raw-zone", "doc/a/20230102_file.csv"))
+
+        df = pq.read_table(io.BytesIO(
+            s3_client.objects[("staging-zone", "doc/a/20230102_out.parquet")])).to_pandas()
+        self.assertEqual(list(df.columns), ["zona", "frame", "fecha", "source_date"])
+        self.assertEqual(df["fecha"].tolist(), [pd.Timestamp("2023-01-10"), pd.Timestamp("2023-01-11")])
+        self.assertEqual(df["source_date"].tolist(), [pd.Timestamp("2023-01-02")] * 2)
+
+        with self.assertRaises(ValueError):
+            main_data_integration.compile_district_rules(
+                {"validation_rules": {"parse_engine": "polars"}})
+
+    def test_write_chunks_to_s3_parquet(self):
+        chunks = [pd.DataFrame({"col1": [1, 2]}),
+                  pd.DataFrame({"col1": [3]})]
+        uploaded = {}
+
+        def put_object(Bucket, Key, Body):
+            parquet_file = pq.ParquetFile(io.BytesIO(Body))
+            uploaded["key"] = Key
+            uploaded["row_groups"] = parquet_file.num_row_groups
+            uploaded["df"] = parquet_file.read().to_pandas()
+
+        with mock.patch.object(main_data_integration.s3_client, "put_object",
+                               side_effect=put_object):
+            rows_count = main_data_integration.write_chunks_to_s3_parquet(
+                iter(chunks), "bucket", "district/output")
+
+        self.assertEqual(rows_count, 3)
+        self.assertEqual(uploaded["key"], "district/output.parquet")
+        self.assertEqual(uploaded["row_groups"], 2)
+        self.assertEqual(uploaded["df"]["col1"].tolist(), [1, 2, 3])
+
+    def test_write_chunks_to_s3_parquet_row_group_size(self):
+        chunks = [pd.DataFrame({"col1": [1, 2]}), pd.DataFrame({"col1": [3]}),
+                  pd.DataFrame({"col1": [4, 5, 6]})]
+        uploaded = {}
+
+        def put_object(Bucket, Key, Body):
+            uploaded["metadata"] = pq.ParquetFile(io.BytesIO(Body)).metadata
+
+        with mock.patch.object(main_data_integration.s3_client, "put_object",
+                               side_effect=put_object):
+            main_data_integration.write_chunks_to_s3_parquet(
+                iter(chunks), "bucket", "district/output", row_group_size=3)
+
+        metadata = uploaded["metadata"]
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)],
+                         [3, 3])
+        statistics = metadata.row_group(1).column(0).statistics
+        self.assertEqual((statistics.min, statistics.max), (4, 6))
+
+    def test_rejected_rows_writer(self):
+        s3_client = FakeS3Client(b"")
+        with mock.patch.object(main_data_integration, "s3_client", s3_client), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "ERROR_ZONE_BUCKET", "error-zone"):
+            with main_data_integration.get_rejected_rows_writer(
+                    "input-raw-zone", "doc/a/file.csv", "out") as rejected_rows:
+                pass
+            self.assertEqual(s3_client.objects, {})
+
+            # The rows are written chunk by chunk, a column null in the first chunk is a string
+            with main_data_integration.get_rejected_rows_writer(
+                    "input-raw-zone", "doc/a/file.csv", "out") as rejected_rows:
+                rejected_rows.append(pd.DataFrame({"zona": [None], "row_number": [1]}))
+                rejected_rows.append(pd.DataFrame({"zona": ["B"], "row_number": [5]}))
+
+        self.assertEqual(rejected_rows.rows_count, 2)
+        parquet_file = pq.ParquetFile(io.BytesIO(
+            s3_client.objects[("error-zone", "doc/a/out_rejected.parquet")]))
+        self.assertEqual(parquet_file.num_row_groups, 2)
+        df = parquet_file.read().to_pandas()
+        self.assertEqual(df["zona"].tolist(), [None, "B"])
+        self.assertEqual(df["row_number"].tolist(), [1, 5])
+
+    def test_get_output_prefix_partitioned(self):
+        rules = {"validation_rules": {"date_details": {
+            "source_date": {"date_regex": r"\d{8}", "date_format": "%Y%m%d"}}}}
+        with mock.patch.object(main_data_integration, "PARTITIONED_OUTPUT", True):
+            output_prefix = main_data_integration.get_output_prefix(
+                "doc/a/20230115_file.csv", "20230115_out", "sabinas", "20230115_file.csv", rules)
+        self.assertEqual(output_prefix,
+                         "doc/a/district=sabinas/source_date=2023-01-15/20230115_out")
+
+    def test_add_date_columns_to_chunks(self):
+        chunks = iter([pd.DataFrame({"col1": [1, 2]}),
+                       pd.DataFrame({"col1": [3]})])
+        date_details = {"source_date": {
+            "date_regex": r"\d{8}", "date_format": "%Y%m%d"}}
+        chunks, output_file_name = main_data_integration.add_date_columns_to_chunks(
+            chunks, date_details, "20210101_test_file.csv", "test_file")
+        chunks = list(chunks)
+
+        self.assertEqual(output_file_name, "20210101_test_file")
+        self.assertTrue(all("source_date" in chunk.columns for chunk in chunks))
+
+    def test_get_validation_rules_uses_cache(self):
+        items = {
+            "Inventory_Per_District/Coahuila": {
+                "document_key": "Inventory_Per_District/Coahuila",
+                "version": 1,
+                "files": {
+                    "acereros": {
+                        "district_key": "Inventory_Per_District_Coahuila_Acereros",
+                        "file_name_regex": "^(.*)([0-9]{8})_acereros_inventory(.*)\\.csv$",
+                        "output_base_file_name": "acereros_inventory",
+                    },
+                },
+            },
+            "Inventory_Per_District_Coahuila_Acereros": district_rules,
+        }
+
+        def get_item(Key, **kwargs):
+            return {"Item": items[Key["document_key"]]}
+
+        main_data_integration.rules_cache.invalidate()
+        with mock.patch.object(main_data_integration.table, "get_item",
+                               side_effect=get_item) as table_get_item:
+            for _ in range(3):
+                file_exist, rules, output_base_file_name, file_name, document_key = main_data_integration.get_validation_rules(
+                    "Inventory_Per_District/Coahuila/20230115_acereros_inventory.csv")
+            self.assertTrue(file_exist)
+            self.assertEqual(rules["validation_rules"], district_rules["validation_rules"])
+            self.assertIn("header_validator", rules)
+            self.assertEqual(output_base_file_name, "acereros_inventory")
+            self.assertEqual(table_get_item.call_count, 2)
+
+            # Expired entries are revalidated with their version only
+            for entry in main_data_integration.rules_cache.entries.values():
+                entry.expires_at = 0
+            main_data_integration.get_validation_rules(
+                "Inventory_Per_District/Coahuila/20230116_acereros_inventory.csv")
+            self.assertEqual(table_get_item.call_count, 4)
+            self.assertIn("ProjectionExpression",
+                          table_get_item.call_args_list[2].kwargs)
+
+            file_exist, *_ = main_data_integration.get_validation_rules(
+                "Inventory_Per_District/Coahuila/unknown.csv")
+            self.assertFalse(file_exist)
+        main_data_integration.rules_cache.invalidate()
+
+    def test_get_file_extract_without_byte_order_mark(self):
+        rules = {"validation_rules": {**district_rules["validation_rules"],
+                                      "encoding": "utf-16", "file_extension": "csv"}}
+        data = "ZONA|FRAME|FECHA\nA|1|20230110\n".encode("utf-16-le")
+        file_head = FileHead(FakeS3Client(data), "bucket", "key")
+
+        with mock.patch.object(main_data_integration, "validate_file_encoding", return_value=True):
+            file_extract = main_data_integration.get_file_extract(
+                "bucket", "key", "file.csv", rules, file_head)
+            chunks = list(main_data_integration.create_dataframe_chunks(
+                "bucket", "key", rules, column_names=["zona", "frame", "fecha"], file_head=file_head))
+
+        self.assertEqual(file_extract, ["ZONA|FRAME|FECHA", "A|1|20230110"])
+        self.assertEqual(chunks[0]["zona"].tolist(), ["A"])
+
+        # Without the mock, the file is rejected instead of failing
+        self.assertIsNone(main_data_integration.get_file_extract(
+            "bucket", "key", "file.csv", rules, FileHead(FakeS3Client(data), "bucket", "key")))
+
+    def test_get_file_extract_wide_header(self):
+        rules = {"validation_rules": {**district_rules["validation_rules"],
+                                      "file_extension": "csv"}}
+        header = "|".join(f"column_{i}" for i in range(20000))
+        record = "|".join(str(i) for i in range(20000))
+        data = f"{header}\n{record}\n{record}\n".encode("utf-8")
+        s3_client = FakeS3Client(data)
+        file_head = FileHead(s3_client, "bucket", "key")
+
+        with mock.patch.object(main_data_integration, "validate_file_encoding", return_value=True):
+            file_extract = main_data_integration.get_file_extract(
+                "bucket", "key", "file.csv", rules, file_head)
+
+        self.assertEqual(file_extract, [header, record])
+        self.assertEqual(len(s3_client.ranges), 3)
+
+        with mock.patch.object(main_data_integration.s3_client, "get_object",
+                               side_effect=s3_client.get_object):
+            chunks = list(main_data_integration.create_dataframe_chunks(
+                "bucket", "key", {"validation_rules": {"columns_details": [], "encoding": "utf-8", "delimiter": "|"}},
+                file_head=file_head))
+        self.assertEqual(len(chunks[0]), 2)
+        self.assertEqual(s3_client.ranges[-1], f"bytes={len(file_head.content)}-")
+
+    def test_lambda_handler_reports_batch_item_failures(self):
+        def s3_event(key):
+            return {"s3": {"bucket": {"name": "input-raw-zone"}, "object": {"key": key}}}
+
+        event = {"Records": [
+            {"messageId": "1", "body": json.dumps({"Records": [s3_event("doc/a/file+1.csv")]})},
+            {"messageId": "2", "body": json.dumps({"Records": [s3_event("doc/a/file_2.csv")]})},
+            {"messageId": "3", "body": json.dumps({"Records": [s3_event("doc/b/file_3.csv")]})},
+            {"messageId": "4", "body": json.dumps({"Event": "s3:TestEvent"})},
+        ]}
+
+        def process_file(input_bucket_name, prefix):
+            if prefix == "doc/a/file_2.csv":
+                raise ValueError("Broken file")
+
+        with mock.patch.object(main_data_integration, "get_rules_item") as get_rules_item, \
+                mock.patch.object(main_data_integration, "process_file", side_effect=process_file) as process_file_mock:
+            response = main_data_integration.lambda_handler(event, None)
+
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "2"}]})
+        self.assertEqual(sorted(call.args[0] for call in get_rules_item.call_args_list),
+                         ["doc/a", "doc/b"])
+        self.assertIn(mock.call("input-raw-zone", "doc/a/file 1.csv"),
+                      process_file_mock.call_args_list)
+
+        with mock.patch.object(main_data_integration, "get_rules_item"), \
+                mock.patch.object(main_data_integration, "process_file", side_effect=ValueError("Broken file")):
+            with self.assertRaises(Exception):
+                main_data_integration.lambda_handler(
+                    {"Records": [s3_event("doc/a/file.csv")]}, None)
+
+    def test_process_file_skips_duplicate_files(self):
+        index = InMemoryDedupIndex()
+        index.put("district", "md5:abc", "doc/a/20230101_file.csv", "doc/a/20230101_out.parquet")
+        rules = main_data_integration.compile_district_rules({**district_rules, "district_key": "district"})
+
+        with mock.patch.object(main_data_integration, "dedup_index", index), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "STAGING_ZONE_BUCKET", "staging-zone"), \
+                mock.patch.object(main_data_integration, "RAW_ZONE_BUCKET", "raw-zone"), \
+                mock.patch.object(main_data_integration, "LANDING_ZONE_BUCKET", "landing-zone"), \
+                mock.patch.object(main_data_integration, "get_validation_rules",
+                                  return_value=(True, rules, "out", "20230102_file.csv", "doc/a")), \
+                mock.patch.object(main_data_integration, "get_file_extract",
+                                  return_value=["ZONA|FRAME|FECHA", "A|1|20230110"]), \
+                mock.patch.object(main_data_integration, "create_dataframe_chunks") as create_dataframe_chunks, \
+                mock.patch.object(main_data_integration.s3_client, "head_object",
+                                  return_value={"ContentLength": 10, "ETag": '"abc"'}), \
+                mock.patch.object(main_data_integration.s3_client, "copy_object") as copy_object, \
+                mock.patch.object(main_data_integration.s3_client, "put_object") as put_object:
+            processed = main_data_integration.process_file(
+                "input-raw-zone", "doc/a/20230102_file.csv")
+
+        self.assertTrue(processed)
+        create_dataframe_chunks.assert_not_called()
+        pointer = put_object.call_args.kwargs
+        self.assertEqual(pointer["Bucket"], "staging-zone")
+        self.assertEqual(pointer["Key"], "doc/a/20230102_file.csv.duplicate.json")
+        self.assertEqual(json.loads(pointer["Body"])["duplicate_of"],
+                         {"source_key": "doc/a/20230101_file.csv",
+                          "output_key": "doc/a/20230101_out.parquet"})
+        self.assertEqual(index.get_duplicates("district", "doc/a/20230101_out.parquet"),
+                         ["doc/a/20230102_file.csv.duplicate.json"])
+        # A duplicate is validated, and lands with the output of the first file
+        copies = {call.kwargs["Bucket"]: call.kwargs["Metadata"] for call in copy_object.call_args_list}
+        self.assertEqual(copies["raw-zone"]["diavs-status"], "validated")
+        self.assertEqual(copies["landing-zone"]["diavs-status"], "transformed")
+        self.assertEqual(copies["landing-zone"]["diavs-output-key"], "doc/a/20230101_out.parquet")
+
+        # Files failing the validations are rejected before the lookup
+        with mock.patch.object(main_data_integration, "dedup_index", index), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "get_validation_rules",
+                                  return_value=(True, rules, "out", "20230102_file.csv", "doc/a")), \
+                mock.patch.object(main_data_integration, "get_file_extract",
+                                  return_value=["ZONA|FRAME|OTRA", "A|1|2"]), \
+                mock.patch.object(main_data_integration, "find_duplicate_file",
+                                  return_value=(None, None)) as find_duplicate_file, \
+                mock.patch.object(main_data_integration.s3_client, "head_object",
+                                  return_value={"ContentLength": 10, "ETag": '"abc"'}):
+            self.assertFalse(main_data_integration.process_file(
+                "input-raw-zone", "doc/a/20230102_file.csv"))
+        find_duplicate_file.assert_not_called()
+
+    def test_process_file_zone_transitions(self):
+        rules = main_data_integration.compile_district_rules(
+            {**district_rules, "district_key": "district"})
+        with mock.patch.object(main_data_integration, "dedup_index", None), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "RAW_ZONE_BUCKET", "raw-zone"), \
+                mock.patch.object(main_data_integration, "ERROR_ZONE_BUCKET", "error-zone"), \
+                mock.patch.object(main_data_integration, "LANDING_ZONE_BUCKET", None), \
+                mock.patch.object(main_data_integration, "get_validation_rules",
+                                  return_value=(True, rules, "out", "20230102_file.csv", "doc/a")), \
+                mock.patch.object(main_data_integration.s3_client, "head_object",
+                                  return_value={"ContentLength": 10, "ETag": '"abc"'}), \
+                mock.patch.object(main_data_integration.s3_client, "copy_object") as copy_object:
+            with mock.patch.object(main_data_integration, "get_file_extract", return_value=None):
+                self.assertFalse(main_data_integration.process_file(
+                    "input-raw-zone", "doc/a/20230102_file.csv"))
+            copy = copy_object.call_args.kwargs
+            self.assertEqual((copy["Bucket"], copy["Key"]), ("error-zone", "doc/a/20230102_file.csv"))
+            self.assertEqual(copy["Metadata"]["diavs-status"], "rejected")
+            self.assertEqual(copy["Metadata"]["diavs-reason"], "Invalid file extension or encoding")
+
+            # A file that fails after the validations is in the raw zone and in the error zone
+            with mock.patch.object(main_data_integration, "get_file_extract",
+                                   return_value=["zona|frame|fecha", "A|1|20230110"]), \
+                    mock.patch.object(main_data_integration, "create_dataframe_chunks",
+                                      side_effect=ValueError("Broken file")):
+                with self.assertRaises(ValueError):
+                    main_data_integration.process_file(
+                        "input-raw-zone", "doc/a/20230102_file.csv")
+            copies = {call.kwargs["Bucket"]: call.kwargs["Metadata"]
+                      for call in copy_object.call_args_list[1:]}
+            self.assertEqual(copies["raw-zone"]["diavs-status"], "validated")
+            self.assertEqual(copies["error-zone"]["diavs-status"], "failed")
+            self.assertEqual(copies["error-zone"]["diavs-stage"], "transformation")
+            self.assertEqual(copies["error-zone"]["diavs-reason"], "Broken file")
+
+    def test_process_file_rejects_schema_drift(self):
+        rules = main_data_integration.compile_district_rules({
+            "district_key": "district",
+            "validation_rules": {
+                **district_rules["validation_rules"],
+                "file_extension": "csv",
+                "schema_baseline": {"columns": {
+                    "frame": {"type": "integer", "null_rate": 0},
+                    "fecha": {"type": "date", "date_format": "%Y%m%d", "null_rate": 0},
+                }},
+            },
+        })
+        rows = "".join(f"A|{i}|2023-01-{i % 28 + 1:02d}\n" for i in range(5000))
+        s3_client = FakeS3Client(("ZONA|FRAME|FECHA\n" + rows).encode("utf-8"))
+        with mock.patch.object(main_data_integration, "s3_client", s3_client), \
+                mock.patch.object(main_data_integration, "dedup_index", None), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "SCHEMA_PROFILE_SAMPLE_BYTES", 1024), \
+                mock.patch.object(main_data_integration, "get_validation_rules",
+                                  return_value=(True, rules, "out", "20230102_file.csv", "doc/a")), \
+                mock.patch("zones.ZoneTransitions.rejected") as rejected:
+            self.assertFalse(main_data_integration.process_file(
+                "input-raw-zone", "doc/a/20230102_file.csv"))
+
+        self.assertTrue(rejected.call_args.args[0].startswith(
+            "Schema drift: [{'check': 'type', 'column': 'fecha', 'expected': 'date %Y%m%d'"))
+        # Only the head of the file was downloaded
+        self.assertTrue(all(not byte_range.endswith("-") for byte_range in s3_client.ranges))
+        self.assertEqual(s3_client.objects, {})
+
+    def test_process_file_rejects_files_without_valid_rows(self):
+        rules = main_data_integration.compile_district_rules({
+            "district_key": "district",
+            "validation_rules": {
+                **district_rules["validation_rules"],
+                "file_extension": "csv",
+                "columns_details": [
+                    {"header": "zona", "data_type": "string"},
+                    {"header": "frame", "data_type": "int64", "min": 0, "max": 10},
+                    {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+                ],
+            },
+        })
+        s3_client = FakeS3Client(b"ZONA|FRAME|FECHA\nA|100|20230110\nB|200|20230111\n")
+        index = InMemoryDedupIndex()
+        for streaming_mode in [True, False]:
+            s3_client.ranges = []
+            with self.subTest(streaming_mode=streaming_mode), \
+                    mock.patch.object(main_data_integration, "s3_client", s3_client), \
+                    mock.patch.object(main_data_integration, "dedup_index", index), \
+                    mock.patch.object(main_data_integration, "get_content_hash", return_value="md5:abc"), \
+                    mock.patch.object(main_data_integration, "STREAMING_MODE", streaming_mode), \
+                    mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                    mock.patch.object(main_data_integration, "STAGING_ZONE_BUCKET", "staging-zone"), \
+                    mock.patch.object(main_data_integration, "ERROR_ZONE_BUCKET", "error-zone"), \
+                    mock.patch.object(main_data_integration, "get_validation_rules",
+                                      return_value=(True, rules, "out", "20230102_file.csv", "doc/a")), \
+                    mock.patch("zones.ZoneTransitions.transformed") as transformed, \
+                    mock.patch("zones.ZoneTransitions.rejected") as rejected:
+                self.assertFalse(main_data_integration.process_file(
+                    "input-raw-zone", "doc/a/20230102_file.csv"))
+
+                transformed.assert_not_called()
+                rejected.assert_called_once_with("Every row failed the row rules")
+                self.assertEqual(index.items, {})
+                self.assertNotIn(("staging-zone", "doc/a/out.parquet"), s3_client.objects)
+                self.assertIn(("error-zone", "doc/a/out_rejected.parquet"), s3_client.objects)
+                # The file is downloaded once, by the head of the header checks
+                self.assertEqual(len(s3_client.ranges), 1)
+
+    def test_process_spreadsheet(self):
+        rules = {"validation_rules": {
+            **district_rules["validation_rules"],
+            "file_extension": "xlsx",
+            "sheets": "*",
+        }}
+        rules = main_data_integration.compile_district_rules(rules)
+        data = get_xlsx_bytes({
+            "Mayo": [["ZONA", "FRAME", "FECHA", None], ["A", 1, "20230110"], ["B", 2, "20230111"]],
+            "Junio": [["ZONA", "FRAME", "FECHA"], ["C", 3, "20230112"]],
+            # Every row leaves its last cell empty
+            "Julio": [["ZONA", "FRAME", "FECHA"], ["D", 4], ["E", 5]],
+        })
+        s3_client = FakeS3Client(data)
+
+        with mock.patch.object(main_data_integration, "s3_client", s3_client), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "STAGING_ZONE_BUCKET", "staging-zone"):
+            processed = main_data_integration.process_spreadsheet(
+                "input-raw-zone", "doc/a/inventory.xlsx", rules, "district",
+                "inventory.xlsx", "out")
+
+        self.assertTrue(processed)
+        self.assertEqual(sorted(s3_client.objects), [("staging-zone", "doc/a/out_julio.parquet"),
+                                                     ("staging-zone", "doc/a/out_junio.parquet"),
+                                                     ("staging-zone", "doc/a/out_mayo.parquet")])
+        df = pq.read_table(io.BytesIO(
+            s3_client.objects[("staging-zone", "doc/a/out_mayo.parquet")])).to_pandas()
+        self.assertEqual(list(df.columns), ["zona", "frame", "fecha"])
+        self.assertEqual(df["frame"].tolist(), [1, 2])
+        self.assertEqual(df["fecha"].tolist(), [pd.Timestamp("2023-01-10"), pd.Timestamp("2023-01-11")])
+        df = pq.read_table(io.BytesIO(
+            s3_client.objects[("staging-zone", "doc/a/out_julio.parquet")])).to_pandas()
+        self.assertEqual(df["zona"].tolist(), ["D", "E"])
+        self.assertTrue(df["fecha"].isna().all())
+
+    def test_process_spreadsheet_without_valid_rows(self):
+        rules = main_data_integration.compile_district_rules({"validation_rules": {
+            **district_rules["validation_rules"],
+            "file_extension": "xlsx",
+            "columns_details": [
+                {"header": "zona", "data_type": "string"},
+                {"header": "frame", "data_type": "int64", "min": 0, "max": 10},
+                {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+            ],
+        }})
+        s3_client = FakeS3Client(get_xlsx_bytes({
+            "Mayo": [["ZONA", "FRAME", "FECHA"], ["A", 100, "20230110"]],
+        }))
+        transitions = mock.Mock()
+
+        with mock.patch.object(main_data_integration, "s3_client", s3_client), \
+                mock.patch.object(main_data_integration, "INPUT_RAW_BUCKET", "input-raw-zone"), \
+                mock.patch.object(main_data_integration, "STAGING_ZONE_BUCKET", "staging-zone"), \
+                mock.patch.object(main_data_integration, "ERROR_ZONE_BUCKET", "error-zone"):
+            processed = main_data_integration.process_spreadsheet(
+                "input-raw-zone", "doc/a/inventory.xlsx", rules, "district",
+                "inventory.xlsx", "out", transitions=transitions)
+
+        self.assertFalse(processed)
+        transitions.transformed.assert_not_called()
+        transitions.rejected.assert_called_once_with("No sheet has valid rows")
+        self.assertEqual(list(s3_client.objects), [("error-zone", "doc/a/out_rejected.parquet")])
+
+    def test_get_topic_arn_is_cached(self):
+        pages = [
+            {"Topics": [{"TopicArn": "arn:aws:sns:us-east-1:123:a"}], "NextToken": "1"},
+            {"Topics": [{"TopicArn": "arn:aws:sns:us-east-1:123:b"}], "NextToken": "2"},
+            {"Topics": [{"TopicArn": "arn:aws:sns:us-east-1:123:c"}]},
+        ]
+
+        def list_topics(NextToken=None):
+            return pages[int(NextToken or 0)]
+
+        with mock.patch.dict(main_data_integration.topic_arns, clear=True), \
+                mock.patch.object(main_data_integration.sns, "list_topics", side_effect=list_topics) as sns_list_topics:
+            self.assertEqual(main_data_integration.get_topic_arn("b"),
+                             "arn:aws:sns:us-east-1:123:b")
+            self.assertEqual(sns_list_topics.call_count, 2)
+            self.assertEqual(main_data_integration.get_topic_arn("a"),
+                             "arn:aws:sns:us-east-1:123:a")
+            self.assertEqual(sns_list_topics.call_count, 2)
+            self.assertIsNone(main_data_integration.get_topic_arn("d"))
+
+    def test_write_chunks_to_s3_parquet_dictionary_columns(self):
+        chunks = [pd.DataFrame({"zona": pd.Categorical(["A", "B"]),
+                                "ing": pd.Series(["x", "y"], dtype="string[pyarrow]"),
+                                "frame": pd.Series([1, 2], dtype="uint8")}),
+                  pd.DataFrame({"zona": pd.Categorical(["C"] * 300 + [str(i) for i in range(300)]),
+                                "ing": pd.Series(["z"] * 600, dtype="string[pyarrow]"),
+                                "frame": pd.Series([3] * 600, dtype="uint8")})]
+        uploaded = {}
+
+        def put_object(Bucket, Key, Body):
+            uploaded["parquet_file"] = pq.ParquetFile(io.BytesIO(Body))
+
+        with mock.patch.object(main_data_integration.s3_client, "put_object",
+                               side_effect=put_object):
+            main_data_integration.write_chunks_to_s3_parquet(
+                iter(chunks), "bucket", "district/output")
+
+        parquet_file = uploaded["parquet_file"]
+        df = parquet_file.read().to_pandas()
+        self.assertEqual(df["zona"].dtype, "category")
+        self.assertEqual(df["frame"].dtype, "uint8")
+        self.assertEqual(len(df), 602)
+        columns = [parquet_file.metadata.row_group(0).column(i)
+                   for i in range(parquet_file.metadata.num_columns)]
+        encodings = {column.path_in_schema: column.encodings for column in columns}
+        self.assertIn("RLE_DICTIONARY", encodings["zona"])
+        self.assertIn("RLE_DICTIONARY", encodings["ing"])
+        self.assertNotIn("RLE_DICTIONARY", encodings["frame"])
@@ -0,0 +1,35 @@
+import json
+import unittest
+
+from notifications import StatusNotifier
+
+
+class FakeSNSClient:
+
+    def __init__(self):
+        self.batches = []
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append((TopicArn, [json.loads(entry["Message"])
+                                        for entry in PublishBatchRequestEntries]))
+        return {"Successful": [], "Failed": []}
+
+
+class TestStatusNotifier(unittest.TestCase):
+
+    def test_notifications_are_batched_per_topic(self):
+        sns_client = FakeSNSClient()
+        topic_arns = {"success": "arn:aws:sns:us-east-1:123:success"}
+        notifier = StatusNotifier(sns_client, topic_arns.get)
+        for i in range(12):
+            notifier.notify("success", {"key": i})
+        notifier.notify("unknown", {"key": "lost"})
+        notifier.notify(None, {"key": "disabled"})
+        notifier.flush()
+
+        self.assertTrue(all(topic_arn == topic_arns["success"]
+                            for topic_arn, _ in sns_client.batches))
+        self.assertTrue(all(len(messages) <= 10
+                            for _, messages in sns_client.batches))
+        self.assertEqual([message["key"] for _, messages in sns_client.batches for message in messages],
+                         list(range(12)))
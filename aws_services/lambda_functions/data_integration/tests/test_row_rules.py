@@ -0,0 +1,59 @@
+import unittest
+from decimal import Decimal
+
+import pandas as pd
+
+from row_rules import RowValidator, compile_row_rules
+
+
+class TestRowRules(unittest.TestCase):
+
+    def test_compile_row_rules(self):
+        validation_rules = {"columns_details": [
+            {"header": "zona", "data_type": "string", "not_null": True, "regex": "[A-Z_]+"},
+            {"header": "frame", "data_type": "int64", "min": Decimal("0"), "max": Decimal("200")},
+            {"header": "ing", "data_type": "string"},
+        ]}
+        reason_codes = [reason_code for reason_code, _, _ in compile_row_rules(validation_rules)]
+        self.assertEqual(reason_codes, ["not_null:zona", "regex:zona", "range:frame"])
+
+    def test_validate(self):
+        validation_rules = {"columns_details": [
+            {"header": "zona", "data_type": "string", "categorical": True,
+             "not_null": True, "regex": "[A-Z_]+"},
+            {"header": "ing", "data_type": "string", "allowed_values": ["ING1", "ING2"]},
+            {"header": "frame", "data_type": "int64", "min": Decimal("0"), "unique": True},
+        ]}
+        validator = RowValidator(compile_row_rules(validation_rules))
+        chunk = pd.DataFrame({
+            "zona": pd.Categorical(["MORELOS", "rio", None, "MORELOS"]),
+            "ing": pd.Series(["ING1", "ING3", None, "ING2"], dtype="string"),
+            "frame": [1, 2, -1, 1],
+        })
+        valid, rejected = validator.validate(chunk)
+
+        self.assertEqual(valid.index.tolist(), [0])
+        self.assertEqual(rejected["row_number"].tolist(), [2, 3, 4])
+        self.assertEqual(rejected["rejection_reasons"].tolist(), [
+            "regex:zona;allowed_values:ing",
+            "not_null:zona;range:frame",
+            "unique:frame",
+        ])
+
+    def test_unique_across_chunks(self):
+        validation_rules = {"columns_details": [
+            {"header": "id", "data_type": "string", "unique": True}]}
+        validator = RowValidator(compile_row_rules(validation_rules))
+        validator.validate(pd.DataFrame({"id": ["a", "b", None]}))
+        valid, rejected = validator.validate(
+            pd.DataFrame({"id": ["c", "a", None]}, index=[3, 4, 5]))
+
+        self.assertEqual(valid["id"].tolist(), ["c", None])
+        self.assertEqual(rejected["row_number"].tolist(), [5])
+        self.assertEqual(validator.rejected_rows_count, 1)
+
+    def test_validate_without_rules(self):
+        chunk = pd.DataFrame({"id": [1]})
+        valid, rejected = RowValidator([]).validate(chunk)
+        self.assertIs(valid, chunk)
+        self.assertIsNone(rejected)
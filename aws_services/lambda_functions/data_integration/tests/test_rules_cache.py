@@ -0,0 +1,43 @@
+import unittest
+
+from rules_cache import TTLCache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = TTLCache(10, 5, clock=clock)
+        cache.set("key", "value", version=1)
+        self.assertEqual(cache.get("key"), "value")
+
+        clock.now = 10
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.get_entry("key").version, 1)
+
+        cache.touch("key")
+        self.assertEqual(cache.get("key"), "value")
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(10, 2, clock=FakeClock())
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        cache.invalidate()
+        self.assertIsNone(cache.get("c"))
@@ -0,0 +1,60 @@
+import unittest
+
+from s3_multipart_writer import S3MultipartWriter, MIN_PART_SIZE
+
+
+class FakeS3Client:
+
+    def __init__(self, fail_on_part=None):
+        self.fail_on_part = fail_on_part
+        self.objects = {}
+        self.parts = {}
+        self.aborted = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_on_part:
+            raise IOError("Part upload failed")
+        self.parts[PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        body = b"".join(self.parts[part["PartNumber"]]
+                        for part in MultipartUpload["Parts"])
+        self.objects[(Bucket, Key)] = body
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+class TestS3MultipartWriter(unittest.TestCase):
+
+    def test_small_output_uses_put_object(self):
+        s3_client = FakeS3Client()
+        with S3MultipartWriter(s3_client, "bucket", "key") as output_file:
+            output_file.write(b"abc")
+        self.assertEqual(s3_client.objects[("bucket", "key")], b"abc")
+        self.assertEqual(s3_client.parts, {})
+
+    def test_large_output_uses_multipart_upload(self):
+        s3_client = FakeS3Client()
+        data = bytes(range(256)) * (MIN_PART_SIZE // 256) * 3 + b"tail"
+        with S3MultipartWriter(s3_client, "bucket", "key", part_size=MIN_PART_SIZE, concurrency=2) as output_file:
+            for i in range(0, len(data), 1000000):
+                output_file.write(data[i:i + 1000000])
+            self.assertEqual(output_file.tell(), len(data))
+        self.assertEqual(len(s3_client.parts), 4)
+        self.assertEqual(s3_client.objects[("bucket", "key")], data)
+
+    def test_failed_upload_is_aborted(self):
+        s3_client = FakeS3Client(fail_on_part=2)
+        with self.assertRaises(IOError):
+            with S3MultipartWriter(s3_client, "bucket", "key", part_size=MIN_PART_SIZE) as output_file:
+                output_file.write(b"0" * MIN_PART_SIZE * 3)
+        self.assertEqual(s3_client.aborted, ["upload-1"])
+        self.assertNotIn(("bucket", "key"), s3_client.objects)
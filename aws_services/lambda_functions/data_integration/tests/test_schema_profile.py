@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+import schema_profile
+from schema_profile import (build_baseline, find_schema_drift, get_sample_rows, profile_column,
+                            profile_rows)
+
+columns_details = [
+    {"header": "zona", "data_type": "string"},
+    {"header": "frame", "data_type": "int64"},
+    {"header": "fecha", "data_type": "date", "date_format": "%Y%m%d"},
+]
+
+
+class TestSchemaProfile(unittest.TestCase):
+
+    def test_get_sample_rows(self):
+        content = "ZONA|FRAME|FECHA\r\nA|1|20230110\r\n\"B|C\"|2|20230111\r\nC|3|2023".encode("utf-16")
+        rows = get_sample_rows(content, "utf-16", "|")
+        # The last record is cut, it is left out
+        self.assertEqual(rows, [["A", "1", "20230110"], ["B|C", "2", "20230111"]])
+        self.assertEqual(len(get_sample_rows(content, "utf-16", "|", eof=True)), 3)
+        self.assertEqual(len(get_sample_rows(content, "utf-16", "|", max_rows=1)), 1)
+
+        # The head is cut inside a quoted value with a line break
+        content = b'ZONA|FRAME|FECHA\nA|1|20230110\n"B\nC|2|2023'
+        self.assertEqual(get_sample_rows(content, "utf-8", "|"), [["A", "1", "20230110"]])
+
+    def test_profile_column(self):
+        self.assertEqual(profile_column(["1", "-2", "NA", "3"]), {"null_rate": 0.25, "type": "integer"})
+        self.assertEqual(profile_column(["1.5", "2"])["type"], "float")
+        self.assertEqual(profile_column(["2023-01-10", "2023-02-28"]),
+                         {"null_rate": 0.0, "type": "date", "date_format": "%Y-%m-%d"})
+        self.assertEqual(profile_column(["20230110"])["type"], "integer")
+        self.assertEqual(profile_column(["20230110"], "%Y%m%d")["date_format"], "%Y%m%d")
+        self.assertEqual(profile_column(["a", "1"])["type"], "string")
+        self.assertEqual(profile_column(["", ""]), {"null_rate": 1.0, "type": None})
+
+    def test_find_schema_drift(self):
+        rows = [["A", str(i), "20230110"] for i in range(60)]
+        baseline = build_baseline(profile_rows(["zona", "frame", "fecha"], rows, columns_details))
+        self.assertEqual(baseline["columns"]["fecha"]["type"], "date")
+        self.assertEqual(find_schema_drift(["zona", "frame", "fecha"], rows, baseline), [])
+
+        drifted = [["A", "", "2023-01-10"] for _ in range(30)] + rows[:30]
+        drift = find_schema_drift(["zona", "frame"], drifted, {**baseline, "max_null_rate_increase": 0.4})
+        self.assertEqual(drift, [{"check": "null_rate", "column": "frame", "expected": 0.0, "found": 0.5},
+                                 {"check": "missing_column", "column": "fecha"}])
+        drift = find_schema_drift(["zona", "frame", "fecha"], drifted, baseline)
+        self.assertEqual([(item["check"], item["column"]) for item in drift],
+                         [("null_rate", "frame"), ("type", "fecha")])
+        self.assertEqual(drift[1]["expected"], "date %Y%m%d")
+        self.assertEqual(drift[1]["examples"], ["2023-01-10"] * 3)
+
+    def test_null_rate_needs_enough_rows(self):
+        baseline = {"columns": {"frame": {"type": "integer", "null_rate": 0}}}
+        with mock.patch.object(schema_profile, "SCHEMA_DRIFT_MIN_ROWS", 10):
+            self.assertEqual(find_schema_drift(["frame"], [[""]] * 9, baseline), [])
+            self.assertEqual(len(find_schema_drift(["frame"], [[""]] * 10, baseline)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
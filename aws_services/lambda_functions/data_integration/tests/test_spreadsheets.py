@@ -0,0 +1,51 @@
+import io
+import unittest
+from datetime import datetime
+
+import openpyxl
+import pandas as pd
+
+from spreadsheets import (cast_sheet_dates, get_sheet_suffix, iter_record_batches, open_workbook,
+                          select_sheets)
+
+
+def get_xlsx_bytes(sheets):
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for sheet_name, rows in sheets.items():
+        worksheet = workbook.create_sheet(sheet_name)
+        for row in rows:
+            worksheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+class TestSpreadsheets(unittest.TestCase):
+
+    def test_open_workbook(self):
+        data = get_xlsx_bytes({"Inventario": [["ZONA", "FRAME"], ["A", 1], [None, None], ["B", 2]],
+                               "Notas": [["NOTA"]]})
+        workbook = open_workbook(io.BytesIO(data), "xlsx")
+        self.assertEqual(workbook.sheet_names, ["Inventario", "Notas"])
+        rows = workbook.iter_rows("Inventario")
+        self.assertEqual(next(rows), ("ZONA", "FRAME"))
+        self.assertEqual(list(iter_record_batches(rows, 1)), [[("A", 1)], [("B", 2)]])
+        workbook.close()
+
+    def test_select_sheets(self):
+        sheet_names = ["Inventario", "Notas", "Resumen"]
+        self.assertEqual(select_sheets(sheet_names), ["Inventario"])
+        self.assertEqual(select_sheets(sheet_names, "*"), sheet_names)
+        self.assertEqual(select_sheets(sheet_names, ["Resumen", "Inventario"]),
+                         ["Inventario", "Resumen"])
+        with self.assertRaises(ValueError):
+            select_sheets(sheet_names, ["Otra"])
+        self.assertEqual(get_sheet_suffix("Inventario Mayo-2023"), "inventario_mayo_2023")
+
+    def test_cast_sheet_dates(self):
+        self.assertEqual(cast_sheet_dates(pd.Series([44941.0])).tolist(),
+                         [pd.Timestamp("2023-01-15")])
+        dates = pd.Series([datetime(2023, 1, 15)])
+        self.assertIs(cast_sheet_dates(dates), dates)
+        self.assertEqual(cast_sheet_dates(pd.Series(["20230115"])).dtype, "string")
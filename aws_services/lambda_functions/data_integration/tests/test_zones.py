@@ -0,0 +1,142 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import botocore.exceptions
+
+from zones import (ZoneTransitions, copy_s3_object, get_last_zone, get_output_metadata, get_stage_metadata,
+                   read_output_metadata, read_stage_metadata)
+
+
+def get_client_error(code):
+    return botocore.exceptions.ClientError({"Error": {"Code": code}}, "HeadObject")
+
+
+class TestZones(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_get_stage_metadata(self):
+        metadata = get_stage_metadata("validation", "rejected", "input", "doc/año.csv",
+                                      reason="Invalid header:\n missing 'fecha'" + "x" * 1000)
+        self.assertEqual(metadata["diavs-stage"], "validation")
+        self.assertEqual(metadata["diavs-source-key"], "doc/a\\xf1o.csv")
+        self.assertEqual(len(metadata["diavs-reason"]), 512)
+        self.assertTrue(metadata["diavs-reason"].startswith("Invalid header: missing 'fecha'"))
+        self.assertTrue(all(value.isascii() for value in metadata.values()))
+        self.assertEqual(read_stage_metadata({**metadata, "other": "value"})["status"], "rejected")
+
+    def test_output_metadata(self):
+        metadata = get_output_metadata("input", "doc/año\\1.csv", "coahuila/peñón", "md5:a")
+        self.assertTrue(all(value.isascii() for value in metadata.values()))
+        self.assertEqual(read_output_metadata(metadata),
+                         {"source-bucket": "input", "source-key": "doc/año\\1.csv",
+                          "district-key": "coahuila/peñón", "content-hash": "md5:a"})
+        self.assertIsNone(read_output_metadata({}))
+
+    def test_copy_s3_object(self):
+        s3_client = mock.Mock()
+        copy_s3_object(s3_client, "input", "doc/a.csv", "raw", "doc/a.csv",
+                       {"diavs-status": "validated"}, size=100, e_tag='"abc"')
+        s3_client.copy_object.assert_called_once_with(
+            Bucket="raw", Key="doc/a.csv", CopySource={"Bucket": "input", "Key": "doc/a.csv"},
+            Metadata={"diavs-status": "validated"}, MetadataDirective="REPLACE",
+            CopySourceIfMatch='"abc"')
+        s3_client.create_multipart_upload.assert_not_called()
+
+    def test_multipart_copy(self):
+        s3_client = mock.Mock()
+        s3_client.create_multipart_upload.return_value = {"UploadId": "upload"}
+        s3_client.upload_part_copy.side_effect = lambda **kwargs: {
+            "CopyPartResult": {"ETag": f'"{kwargs["PartNumber"]}"'}}
+        size = 2 * 1024 * 1024 * 1024 + 1
+        part_size = 1024 * 1024 * 1024
+
+        copy_s3_object(s3_client, "input", "doc/a.csv", "raw", "doc/a.csv",
+                       {"diavs-status": "validated"}, size=size, part_size=part_size)
+
+        s3_client.copy_object.assert_not_called()
+        ranges = sorted(call.kwargs["CopySourceRange"]
+                        for call in s3_client.upload_part_copy.call_args_list)
+        self.assertEqual(ranges, [f"bytes=0-{part_size - 1}",
+                                  f"bytes={part_size}-{2 * part_size - 1}",
+                                  f"bytes={2 * part_size}-{size - 1}"])
+        parts = s3_client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"]
+        self.assertEqual(parts, [{"PartNumber": i, "ETag": f'"{i}"'} for i in [1, 2, 3]])
+
+    def test_multipart_copy_is_aborted_on_error(self):
+        s3_client = mock.Mock()
+        s3_client.create_multipart_upload.return_value = {"UploadId": "upload"}
+        s3_client.upload_part_copy.side_effect = get_client_error("PreconditionFailed")
+        with self.assertRaises(botocore.exceptions.ClientError):
+            copy_s3_object(s3_client, "input", "key", "raw", "key", {},
+                           size=6 * 1024 * 1024 * 1024, e_tag='"abc"')
+        s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="raw", Key="key", UploadId="upload")
+
+    def test_zone_transitions(self):
+        s3_client = mock.Mock()
+        s3_client.head_object.return_value = {"ContentLength": 10, "ETag": '"abc"'}
+        transitions = ZoneTransitions(s3_client, "input", "doc/a.csv", self.executor,
+                                      raw_bucket_name="raw", landing_bucket_name=None,
+                                      error_bucket_name="error")
+        transitions.validated()
+        transitions.transformed("doc/out.parquet")
+        transitions.wait()
+
+        # The landing zone has no bucket, only the raw zone copy is made
+        s3_client.head_object.assert_called_once()
+        copy = s3_client.copy_object.call_args.kwargs
+        self.assertEqual(copy["Bucket"], "raw")
+        self.assertEqual(copy["CopySourceIfMatch"], '"abc"')
+        self.assertEqual(copy["Metadata"]["diavs-stage"], "validation")
+        self.assertEqual(copy["Metadata"]["diavs-status"], "validated")
+
+        transitions.failed(ValueError("Broken row"))
+        transitions.wait()
+        copy = s3_client.copy_object.call_args.kwargs
+        self.assertEqual(copy["Bucket"], "error")
+        self.assertEqual(copy["Metadata"]["diavs-stage"], "transformation")
+        self.assertEqual(copy["Metadata"]["diavs-status"], "failed")
+        self.assertEqual(copy["Metadata"]["diavs-reason"], "Broken row")
+
+    def test_zone_transitions_wait_raises_copy_errors(self):
+        s3_client = mock.Mock()
+        s3_client.copy_object.side_effect = get_client_error("AccessDenied")
+        transitions = ZoneTransitions(s3_client, "input", "key", self.executor,
+                                      error_bucket_name="error")
+        transitions.set_source(10, '"abc"')
+        transitions.rejected("Invalid header")
+        with self.assertRaises(botocore.exceptions.ClientError):
+            transitions.wait()
+        s3_client.head_object.assert_not_called()
+
+    def test_get_last_zone(self):
+        objects = {
+            ("raw", "key"): {"Metadata": get_stage_metadata("validation", "validated", "input", "key")},
+        }
+
+        def head_object(Bucket, Key):
+            if (Bucket, Key) not in objects:
+                raise get_client_error("404")
+            return objects[(Bucket, Key)]
+
+        s3_client = mock.Mock()
+        s3_client.head_object.side_effect = head_object
+        bucket_name, stage_metadata = get_last_zone(s3_client, "key", ["raw", "landing"])
+        self.assertEqual(bucket_name, "raw")
+        self.assertEqual(stage_metadata["status"], "validated")
+
+        objects[("landing", "key")] = {"Metadata": get_stage_metadata(
+            "transformation", "transformed", "input", "key", output_key="out.parquet")}
+        self.assertEqual(get_last_zone(s3_client, "key", ["raw", "landing"])[1]["output-key"],
+                         "out.parquet")
+        self.assertEqual(get_last_zone(s3_client, "other", ["raw", "landing"]), (None, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
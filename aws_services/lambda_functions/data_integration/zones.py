@@ -0,0 +1,235 @@
+"""
+Transitions of the input files between the zones of the data flow.
+
+A file of the input raw zone is copied to the raw zone once it passes the
+validations, to the landing zone once it is transformed, and to the error
+zone when it is rejected or fails. The copies are server side, the bytes
+never go through the Lambda, and each one carries the outcome of its stage
+as object metadata, so a reprocess can start from the last zone a file
+reached.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+
+import botocore.exceptions
+
+from instrumentation import metrics
+from s3_multipart_writer import MIN_PART_SIZE, MULTIPART_CONCURRENCY
+
+# copy_object copies objects of up to 5 GB, bigger objects need a multipart copy
+MAX_COPY_OBJECT_BYTES = 5 * 1024 * 1024 * 1024
+MULTIPART_COPY_THRESHOLD = min(
+    int(os.getenv("MULTIPART_COPY_THRESHOLD_MB", "1024")) * 1024 * 1024, MAX_COPY_OBJECT_BYTES)
+MULTIPART_COPY_PART_SIZE = max(
+    int(os.getenv("MULTIPART_COPY_PART_SIZE_MB", "256")) * 1024 * 1024, MIN_PART_SIZE)
+# S3 limits the user metadata of an object to 2 KB
+MAX_REASON_LENGTH = 512
+METADATA_PREFIX = "diavs-"
+
+STAGE_VALIDATION = "validation"
+STAGE_TRANSFORMATION = "transformation"
+STATUS_VALIDATED = "validated"
+STATUS_TRANSFORMED = "transformed"
+STATUS_REJECTED = "rejected"
+STATUS_FAILED = "failed"
+
+
+def to_ascii(value):
+    return value.encode("ascii", "backslashreplace").decode("ascii")
+
+
+def get_stage_metadata(stage, status, source_bucket_name, source_key, reason=None, output_key=None):
+    """
+    This function returns the S3 user metadata of the outcome of a stage.
+    Metadata travels in HTTP headers, so the reason is reduced to one line of ASCII.
+    """
+    metadata = {
+        "stage": stage,
+        "status": status,
+        "source-bucket": source_bucket_name,
+        "source-key": to_ascii(source_key),
+        "processed-at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+    if reason is not None:
+        reason = " ".join(str(reason).split())
+        metadata["reason"] = to_ascii(reason)[:MAX_REASON_LENGTH]
+    if output_key is not None:
+        metadata["output-key"] = to_ascii(output_key)
+    return {METADATA_PREFIX + name: value for name, value in metadata.items()}
+
+
+def get_output_metadata(source_bucket_name, source_key, district_key, content_hash=None):
+    """
+    This function returns the S3 user metadata of an output of the staging
+    zone: the input file it comes from and its deduplication key, so the
+    references to the output can be found when it is compacted. Unlike the
+    stage metadata, the values are percent encoded so they can be read back
+    exactly with read_output_metadata.
+    """
+    metadata = {
+        "source-bucket": source_bucket_name,
+        "source-key": source_key,
+        "district-key": district_key,
+    }
+    if content_hash is not None:
+        metadata["content-hash"] = content_hash
+    return {METADATA_PREFIX + name: quote(value, safe="/") for name, value in metadata.items()}
+
+
+def read_output_metadata(metadata):
+    """
+    This function returns the source of an output of the staging zone, or
+    None if it was written without get_output_metadata.
+    """
+    output_metadata = {name: unquote(value) for name, value in read_stage_metadata(metadata).items()
+                       if name in ("source-bucket", "source-key", "district-key", "content-hash")}
+    if "source-key" not in output_metadata:
+        return None
+    return output_metadata
+
+
+def read_stage_metadata(metadata):
+    """
+    This function returns the stage outcome of the metadata of an object, without the prefix.
+    """
+    return {name[len(METADATA_PREFIX):]: value for name, value in metadata.items()
+            if name.startswith(METADATA_PREFIX)}
+
+
+def copy_s3_object(s3_client, source_bucket_name, source_key, bucket_name, key, metadata, size, e_tag=None, part_size=MULTIPART_COPY_PART_SIZE, concurrency=MULTIPART_CONCURRENCY):
+    """
+    This function copies an S3 object server side and replaces its metadata.
+    Objects bigger than MULTIPART_COPY_THRESHOLD are copied in parts of
+    part_size bytes, concurrently. With e_tag, the copy fails if the source
+    changed since it was read.
+    """
+    copy_source = {"Bucket": source_bucket_name, "Key": source_key}
+    extra_args = {"CopySourceIfMatch": e_tag} if e_tag else {}
+    if size <= MULTIPART_COPY_THRESHOLD:
+        s3_client.copy_object(
+            Bucket=bucket_name, Key=key, CopySource=copy_source,
+            Metadata=metadata, MetadataDirective="REPLACE", **extra_args)
+        return
+
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket_name, Key=key, Metadata=metadata)["UploadId"]
+
+    def copy_part(part_number):
+        start = (part_number - 1) * part_size
+        end = min(start + part_size, size) - 1
+        response = s3_client.upload_part_copy(
+            Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=part_number,
+            CopySource=copy_source, CopySourceRange=f"bytes={start}-{end}", **extra_args)
+        return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    try:
+        parts_count = (size + part_size - 1) // part_size
+        with ThreadPoolExecutor(max_workers=max(min(concurrency, parts_count), 1)) as executor:
+            parts = list(executor.map(copy_part, range(1, parts_count + 1)))
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        raise
+
+
+class ZoneTransitions:
+    """
+    Zone copies of one input file. Every transition is submitted to executor,
+    so the copy to the raw zone runs while the file is transformed, and wait
+    must be called before the handler returns. A zone without a bucket
+    (None) is skipped.
+
+    The source size and ETag are read once, from set_source or a head_object
+    call, and every copy is pinned to that version of the file.
+    """
+
+    def __init__(self, s3_client, input_bucket_name, key, executor, raw_bucket_name=None, landing_bucket_name=None, error_bucket_name=None):
+        self.s3_client = s3_client
+        self.input_bucket_name = input_bucket_name
+        self.key = key
+        self.executor = executor
+        self.raw_bucket_name = raw_bucket_name
+        self.landing_bucket_name = landing_bucket_name
+        self.error_bucket_name = error_bucket_name
+        self.stage = STAGE_VALIDATION
+        self.size = None
+        self.e_tag = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def set_source(self, size, e_tag):
+        with self.lock:
+            self.size, self.e_tag = size, e_tag
+
+    def get_source(self):
+        with self.lock:
+            if self.size is None:
+                response = self.s3_client.head_object(Bucket=self.input_bucket_name, Key=self.key)
+                self.size, self.e_tag = response["ContentLength"], response.get("ETag")
+            return self.size, self.e_tag
+
+    def submit(self, bucket_name, status, reason=None, output_key=None):
+        if bucket_name is None:
+            return
+        metadata = get_stage_metadata(
+            self.stage, status, self.input_bucket_name, self.key, reason, output_key)
+        self.futures.append(self.executor.submit(self.copy, bucket_name, metadata))
+
+    @metrics.timed("zone_copy")
+    def copy(self, bucket_name, metadata):
+        size, e_tag = self.get_source()
+        copy_s3_object(self.s3_client, self.input_bucket_name, self.key,
+                       bucket_name, self.key, metadata, size, e_tag)
+
+    def validated(self):
+        self.submit(self.raw_bucket_name, STATUS_VALIDATED)
+        self.stage = STAGE_TRANSFORMATION
+
+    def transformed(self, output_key):
+        self.submit(self.landing_bucket_name, STATUS_TRANSFORMED, output_key=output_key)
+
+    def rejected(self, reason):
+        print(f"Rejected {self.key} in {self.stage}: {reason}")
+        self.submit(self.error_bucket_name, STATUS_REJECTED, reason)
+
+    def failed(self, reason):
+        self.submit(self.error_bucket_name, STATUS_FAILED, reason)
+
+    def wait(self):
+        """
+        This function waits for every submitted copy and raises the first error.
+        """
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+
+def get_last_zone(s3_client, key, zone_bucket_names):
+    """
+    This function returns the last zone a file reached, so a reprocess can
+    start from it. zone_bucket_names lists the buckets of the successful
+    zones in data flow order, e.g. raw and then landing.
+
+    Returns:
+        tuple: The bucket of the zone and its stage metadata, or (None, None)
+            if the file never passed the validations.
+    """
+    for bucket_name in reversed(zone_bucket_names):
+        if bucket_name is None:
+            continue
+        try:
+            response = s3_client.head_object(Bucket=bucket_name, Key=key)
+        except botocore.exceptions.ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                continue
+            raise
+        stage_metadata = read_stage_metadata(response.get("Metadata", {}))
+        if stage_metadata.get("status") in (STATUS_VALIDATED, STATUS_TRANSFORMED):
+            return bucket_name, stage_metadata
+    return None, None
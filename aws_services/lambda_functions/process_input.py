@@ -1,81 +1,394 @@
 import csv
 import json
-import pandas as pd
 import boto3
+import botocore.config
 import botocore.response
 
-import re
 import os
-import io
-from datetime import datetime
-import tempfile
+from urllib.parse import unquote_plus
+import math
+import codecs
+from concurrent.futures import ThreadPoolExecutor
 
-# Packages from layers
-import cchardet
-import pandas as pd
+# Packages from layers (pandas) are imported in the functions that use them
+
+from checkpoints import DynamoDBCheckpointStore, get_job_id
+from data_integration.instrumentation import metrics
 
 MINIMUN_REMAINING_TIME_MS = 500
 ROWS_PER_LAMBDA = 2500
+# Files bigger than PARALLEL_MIN_BYTES are split in byte ranges processed by parallel workers
+PARALLEL_MIN_BYTES = int(os.getenv("PARALLEL_MIN_BYTES", str(64 * 1024 * 1024)))
+BYTES_PER_WORKER = int(os.getenv("BYTES_PER_WORKER", str(128 * 1024 * 1024)))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "16"))
+DELIMITER_PROBE_BYTES = 64 * 1024
+READ_SIZE_BYTES = int(os.getenv("READ_SIZE_BYTES", str(1024 * 1024)))
+
+# Clients are created once per Lambda container and reused by warm invocations
+client_config = botocore.config.Config(
+    max_pool_connections=MAX_WORKERS + 4,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+)
+s3_resource = boto3.resource('s3', config=client_config)
+lambda_client = boto3.client('lambda', config=client_config)
+checkpoint_store = None
+
+
+def get_function_name(context):
+    # The benchmarks invoke the handler without a context
+    return getattr(context, "function_name", None) or os.getenv(
+        "AWS_LAMBDA_FUNCTION_NAME", "process_input")
 
 
 def lambda_handler(event, context, offset=0, fieldnames=None, encoding='utf-8', delimiter=','):
-    input_bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
-    prefix = event["Records"][0]["s3"]["object"]["key"]
-    s3_resource = boto3.resource('s3')
+    with metrics.invocation({"FunctionName": get_function_name(context)},
+                            {"RequestId": getattr(context, "aws_request_id", None),
+                             "offset": event.get("offset")}):
+        return process_event(event, context, offset, fieldnames, encoding, delimiter)
+
+
+def process_event(event, context, offset=0, fieldnames=None, encoding='utf-8', delimiter=','):
+    s3_records = get_s3_records(event)
+    # Every record of a batched event is processed by its own invocation
+    if len(s3_records) > 1:
+        failed_records = dispatch_records(get_function_name(context), s3_records)
+        if any(item_identifier is None for item_identifier in failed_records):
+            # S3 notifications have no partial batch response, the invocation is retried
+            raise Exception(f"Failed to dispatch {len(failed_records)} records")
+        return {"batchItemFailures": [{"itemIdentifier": item_identifier}
+                                      for item_identifier in sorted(set(failed_records))]}
+    if not s3_records:
+        return
+    _, record = s3_records[0]
+    input_bucket_name = record["s3"]["bucket"]["name"]
+    prefix = unquote_plus(record["s3"]["object"]["key"])
+    offset = event.get("offset", offset)
+    end_offset = event.get("end_offset")
+    fieldnames = event.get("fieldnames", fieldnames)
+    encoding = event.get("encoding", encoding)
+    delimiter = event.get("delimiter", delimiter)
     s3_object = s3_resource.Object(bucket_name=input_bucket_name, key=prefix)
-    bodylines = get_object_bodylines(s3_object, offset, encoding)
+    # The events of the workers and of the next invocations carry the resolved codec
+    encoding = get_file_encoding(s3_object, encoding)
+
+    # Coordinator mode: the first invocation of a big file fans out to workers
+    if "offset" not in event and s3_object.content_length >= PARALLEL_MIN_BYTES:
+        fieldnames, data_offset = get_header(s3_object, encoding, delimiter)
+        workers = min(MAX_WORKERS, math.ceil(
+            (s3_object.content_length - data_offset) / BYTES_PER_WORKER))
+        byte_ranges = get_byte_ranges(
+            s3_object, data_offset, s3_object.content_length, workers, encoding)
+        dispatch_workers(get_function_name(context), event, byte_ranges,
+                         fieldnames, encoding, delimiter)
+        return
+
+    if end_offset is None:
+        end_offset = s3_object.content_length
+    if fieldnames is None:
+        fieldnames, data_offset = get_header(s3_object, encoding, delimiter)
+        offset = max(offset, data_offset)
+
+    # Resume from the last committed batch, a previous invocation of the
+    # same job may have gone further than the offset of this event
+    store = get_checkpoint_store()
+    job_id = get_job_id(input_bucket_name, prefix,
+                        s3_object.e_tag, end_offset)
+    with metrics.stage("checkpoint"):
+        committed_offset = store.get_committed_offset(job_id)
+    if committed_offset is not None and committed_offset > offset:
+        offset = committed_offset
+    if offset >= end_offset:
+        return
+
+    bodylines = ObjectLineReader(s3_object, offset, encoding, end_offset)
     csv_reader = csv.DictReader(
-        bodylines[0], fieldnames=fieldnames, delimiter=delimiter)
+        bodylines, fieldnames=fieldnames, delimiter=delimiter)
     rows = []
-    for row in csv_reader:
-        rows.append(row)
-        if len(rows) >= ROWS_PER_LAMBDA or context.get_remaining_time_in_millis() < MINIMUN_REMAINING_TIME_MS:
-            print(
-                f"Start Time per lambda: {context.get_remaining_time_in_millis()}")
-            df = pd.DataFrame(rows)
-            print(df.head(3))
-            # process df here
-            print(
-                f"Snd Time per lambda: {context.get_remaining_time_in_millis()}")
-            rows = []
-    new_offset = offset + bodylines[1]
-    if new_offset < s3_object.content_length:
+    batch_offset = offset
+    # The time of the batches and checkpoints is counted in their own stages
+    with metrics.stage("read") as read_stage:
+        for row in csv_reader:
+            rows.append(row)
+            time_is_low = context.get_remaining_time_in_millis() < MINIMUN_REMAINING_TIME_MS
+            if len(rows) >= ROWS_PER_LAMBDA or time_is_low:
+                batch_end_offset = offset + bodylines.offset
+                read_stage.add(rows=len(rows), bytes_read=batch_end_offset - batch_offset)
+                process_batch(rows, context)
+                if not commit_batch(store, job_id, batch_offset, batch_end_offset, len(rows)):
+                    # Another invocation of this job already committed the batch
+                    return
+                rows = []
+                batch_offset = batch_end_offset
+                if time_is_low:
+                    break
+        else:
+            if rows:
+                batch_end_offset = offset + bodylines.offset
+                read_stage.add(rows=len(rows), bytes_read=batch_end_offset - batch_offset)
+                process_batch(rows, context)
+                if not commit_batch(store, job_id, batch_offset, batch_end_offset, len(rows)):
+                    return
+
+    new_offset = offset + bodylines.offset
+    if new_offset < end_offset:
         new_event = {
             **event,
             "offset": new_offset,
+            "end_offset": end_offset,
             "fieldnames": fieldnames,
             "encoding": encoding,
             "delimiter": delimiter
         }
-        invoke_lambda(context.function_name, new_event)
+        invoke_lambda(get_function_name(context), new_event)
     return
 
 
+@metrics.timed("process_batch")
+def process_batch(rows, context):
+    """
+    This function processes a batch of rows.
+    Batches are committed to the checkpoint store after this function returns,
+    so any output must be keyed by the batch offset to be safe to retry.
+    Its duration is reported in the process_batch metrics of the invocation.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(rows)
+    # process df here
+
+
+@metrics.timed("checkpoint")
+def commit_batch(store, job_id, batch_offset, batch_end_offset, rows_count):
+    return store.commit_batch(job_id, batch_offset, batch_end_offset, rows_count)
+
+
+def get_checkpoint_store():
+    """
+    This function returns the checkpoint store, created once per Lambda container.
+    """
+    global checkpoint_store
+    if checkpoint_store is None:
+        checkpoint_store = DynamoDBCheckpointStore()
+    return checkpoint_store
+
+
+@metrics.timed("invoke")
 def invoke_lambda(function_name, event):
     payload = json.dumps(event).encode('utf-8')
-    client = boto3.client('lambda')
-    response = client.invoke(
+    response = lambda_client.invoke(
         FunctionName=function_name,
         InvocationType='Event',
         Payload=payload
     )
 
 
-def get_object_bodylines(s3_object, offset, encoding):
-    resp = s3_object.get(Range=f'bytes={offset}-')
-    body: botocore.response.StreamingBody = resp['Body']
-    offset = 0
-    lines = []
-    pending = b''
-    for chunk in body.iter_chunks(1024):
-        lines_in_chunk = (pending + chunk).splitlines(True)
-        lines += map(lambda x: x.decode(encoding), lines_in_chunk[:-1])
-        offset += sum(map(lambda x: len(x), lines_in_chunk[:-1]))
-        pending = lines_in_chunk[-1]
-    if pending:
-        lines.append(pending.decode(encoding))
-        offset += len(pending)
-    return (lines, offset)
+class ObjectLineReader:
+    """
+    Lazy line iterator over a byte range of an S3 object.
+
+    The body is read in blocks of read_size bytes, split on the record
+    delimiter of the encoding and every line is decoded with an incremental
+    decoder, so multibyte encodings such as utf-16 are safe across block
+    boundaries. Only one block and the pending partial line are held in memory.
+
+    offset is the number of bytes, relative to the start of the range, of the
+    lines already yielded. When the iterator feeds csv.DictReader it is the
+    end of the last fully consumed record.
+    """
+
+    def __init__(self, s3_object, offset, encoding, end_offset=None, read_size=READ_SIZE_BYTES):
+        self.s3_object = s3_object
+        self.start_offset = offset
+        self.end_offset = end_offset
+        self.encoding = encoding
+        self.read_size = read_size
+        self.newline = get_newline_bytes(encoding)
+        self.offset = 0
+
+    def __iter__(self):
+        if self.end_offset is None:
+            resp = self.s3_object.get(Range=f'bytes={self.start_offset}-')
+        else:
+            resp = self.s3_object.get(
+                Range=f'bytes={self.start_offset}-{self.end_offset - 1}')
+        body: botocore.response.StreamingBody = resp['Body']
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        newline_size = len(self.newline)
+        pending = bytearray()
+        for chunk in body.iter_chunks(self.read_size):
+            search_start = max(len(pending) - newline_size + 1, 0)
+            pending += chunk
+            line_start = 0
+            index = pending.find(self.newline, search_start)
+            while index != -1:
+                if (index - line_start) % newline_size:
+                    index = pending.find(self.newline, index + 1)
+                    continue
+                line_end = index + newline_size
+                line = decoder.decode(pending[line_start:line_end])
+                self.offset += line_end - line_start
+                line_start = line_end
+                yield line
+                index = pending.find(self.newline, line_start)
+            del pending[:line_start]
+        if pending:
+            line = decoder.decode(pending, final=True)
+            self.offset += len(pending)
+            yield line
+
+
+def get_newline_bytes(encoding):
+    """
+    This function returns the bytes of a record delimiter in the given encoding,
+    without the byte order mark that some codecs prepend.
+    """
+    one_newline = "\n".encode(encoding)
+    two_newlines = "\n\n".encode(encoding)
+    return two_newlines[len(one_newline):]
+
+
+@metrics.timed("header")
+def get_file_encoding(s3_object, encoding):
+    """
+    This function resolves the byte order of a utf-16 or utf-32 file.
+    Only the start of the file has a byte order mark, so it is read once and
+    the returned codec, e.g. utf-16-be, decodes and splits every byte range.
+    A file without a mark is little endian. Other encodings are returned as is.
+    """
+    name = codecs.lookup(encoding).name
+    if name not in ("utf-16", "utf-32"):
+        return encoding
+    byte_order_mark = "\ufeff".encode(name + "-be")
+    resp = s3_object.get(Range=f'bytes=0-{len(byte_order_mark) - 1}')
+    if resp['Body'].read() == byte_order_mark:
+        return name + "-be"
+    return name + "-le"
+
+
+def find_next_record_start(s3_object, position, end_offset, encoding):
+    """
+    This function returns the offset of the first record that starts at or after position.
+    It downloads small ranges from position until it finds a record delimiter
+    aligned to the code unit size of the encoding. If no delimiter is found
+    before end_offset, end_offset is returned.
+    Records with quoted line breaks are not supported, as in ObjectLineReader.
+    """
+    if position == 0:
+        return 0
+    newline = get_newline_bytes(encoding)
+    # The record must start right after a delimiter, so the search starts one delimiter back
+    search_position = max(position - len(newline), 0)
+    while search_position < end_offset:
+        range_end = min(search_position + DELIMITER_PROBE_BYTES, end_offset)
+        resp = s3_object.get(Range=f'bytes={search_position}-{range_end - 1}')
+        probe = resp['Body'].read()
+        index = probe.find(newline)
+        while index != -1:
+            if (search_position + index) % len(newline) == 0:
+                return search_position + index + len(newline)
+            index = probe.find(newline, index + 1)
+        # Keep the last bytes in case a delimiter is split between two probes
+        search_position = max(range_end - len(newline) + 1, search_position + 1)
+        if range_end == end_offset:
+            break
+    return end_offset
+
+
+def get_byte_ranges(s3_object, start_offset, end_offset, workers, encoding):
+    """
+    This function splits [start_offset, end_offset) in at most workers byte ranges.
+    Every boundary is snapped to the start of the next record, so no record is
+    split between two ranges. Empty ranges are dropped.
+    """
+    workers = max(workers, 1)
+    step = (end_offset - start_offset) / workers
+    boundaries = [start_offset]
+    for i in range(1, workers):
+        boundary = find_next_record_start(
+            s3_object, max(int(start_offset + i * step), boundaries[-1]), end_offset, encoding)
+        boundaries.append(boundary)
+    boundaries.append(end_offset)
+    return [(range_start, range_end) for range_start, range_end in zip(boundaries, boundaries[1:])
+            if range_start < range_end]
+
+
+@metrics.timed("header")
+def get_header(s3_object, encoding, delimiter):
+    """
+    This function reads the header record of a file.
+    It returns the field names and the offset of the first data record.
+    The encoding of a utf-16 or utf-32 file is the one of get_file_encoding.
+    """
+    data_offset = find_next_record_start(
+        s3_object, 1, s3_object.content_length, encoding)
+    resp = s3_object.get(Range=f'bytes=0-{data_offset - 1}')
+    # The byte order mark is not part of the first field name
+    header = resp['Body'].read().decode(encoding).lstrip("\ufeff")
+    fieldnames = next(csv.reader([header.strip("\r\n")], delimiter=delimiter))
+    return fieldnames, data_offset
+
+
+def get_s3_records(event):
+    """
+    This function returns the S3 records of an event as (item_identifier, s3_record) tuples.
+    SQS records are unwrapped, their body is an S3 event notification, and
+    their messageId is the item identifier reported as a batch item failure.
+    """
+    s3_records = []
+    for record in event.get("Records", []):
+        if "body" in record:
+            # s3:TestEvent messages have no Records
+            s3_records += [(record["messageId"], s3_record)
+                           for s3_record in json.loads(record["body"]).get("Records", [])]
+        else:
+            s3_records.append((None, record))
+    return s3_records
+
+
+def dispatch_record(function_name, s3_record):
+    """
+    This function invokes a Lambda for one S3 record.
+
+    Returns:
+        bool: True if the invocation was queued.
+    """
+    try:
+        invoke_lambda(function_name, {"Records": [s3_record]})
+    except Exception as error:
+        print(f"Could not dispatch {s3_record['s3']['object']['key']}: {error}")
+        return False
+    return True
+
+
+def dispatch_records(function_name, s3_records):
+    """
+    This function invokes one Lambda per S3 record in parallel.
+
+    Returns:
+        list: The item identifiers of the records that could not be dispatched.
+    """
+    with ThreadPoolExecutor(max_workers=max(min(len(s3_records), MAX_WORKERS), 1)) as executor:
+        dispatched = list(executor.map(lambda s3_record: dispatch_record(
+            function_name, s3_record[1]), s3_records))
+    return [item_identifier for (item_identifier, _), queued in zip(s3_records, dispatched)
+            if not queued]
+
+
+def dispatch_workers(function_name, event, byte_ranges, fieldnames, encoding, delimiter):
+    """
+    This function invokes one worker per byte range in parallel.
+    """
+    events = [{
+        **event,
+        "offset": range_start,
+        "end_offset": range_end,
+        "fieldnames": fieldnames,
+        "encoding": encoding,
+        "delimiter": delimiter
+    } for range_start, range_end in byte_ranges]
+    with ThreadPoolExecutor(max_workers=max(len(events), 1)) as executor:
+        list(executor.map(lambda worker_event: invoke_lambda(
+            function_name, worker_event), events))
 
 
 def importedModuleCheck():
@@ -0,0 +1,248 @@
+import codecs
+import io
+import os
+import unittest
+from unittest import mock
+
+from botocore.response import StreamingBody
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import process_input
+from checkpoints import InMemoryCheckpointStore
+
+
+class FakeS3Object:
+
+    def __init__(self, data):
+        self.data = data
+        self.content_length = len(data)
+        self.e_tag = '"etag"'
+        self.ranges = []
+
+    def get(self, Range):
+        self.ranges.append(Range)
+        start, end = Range.replace("bytes=", "").split("-")
+        end = int(end) + 1 if end else len(self.data)
+        body = self.data[int(start):end]
+        return {"Body": StreamingBody(io.BytesIO(body), len(body))}
+
+
+class FakeS3Resource:
+
+    def __init__(self, s3_object):
+        self.s3_object = s3_object
+
+    def Object(self, bucket_name, key):
+        return self.s3_object
+
+
+class FakeContext:
+
+    function_name = "process_input"
+
+    def __init__(self, remaining_times):
+        self.remaining_times = iter(remaining_times)
+
+    def get_remaining_time_in_millis(self):
+        return next(self.remaining_times, 60000)
+
+
+def get_event(**kwargs):
+    return {"Records": [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": "key.csv"}}}], **kwargs}
+
+
+class TestProcessInput(unittest.TestCase):
+
+    def run_handler(self, data, event, context, store):
+        processed = []
+        with mock.patch.object(process_input, "s3_resource", FakeS3Resource(FakeS3Object(data))), \
+                mock.patch.object(process_input, "checkpoint_store", store), \
+                mock.patch.object(process_input, "process_batch", side_effect=lambda rows, context: processed.append(list(rows))), \
+                mock.patch.object(process_input, "invoke_lambda") as invoke_lambda:
+            process_input.lambda_handler(event, context, delimiter="|")
+        return processed, invoke_lambda
+
+    def test_handler_hands_off_when_time_is_low(self):
+        data = b"a|b\n" + b"".join(f"{i}|x\n".encode() for i in range(10))
+        store = InMemoryCheckpointStore()
+        # The remaining time drops under the limit while reading the fourth row
+        processed, invoke_lambda = self.run_handler(
+            data, get_event(), FakeContext([60000, 60000, 60000, 100]), store)
+
+        self.assertEqual([len(rows) for rows in processed], [4])
+        new_event = invoke_lambda.call_args.args[1]
+        self.assertEqual(new_event["offset"], 4 + 4 * 4)
+        self.assertEqual(new_event["fieldnames"], ["a", "b"])
+
+        processed, invoke_lambda = self.run_handler(
+            data, new_event, FakeContext([]), store)
+        self.assertEqual([row["a"] for row in processed[0]],
+                         [str(i) for i in range(4, 10)])
+        invoke_lambda.assert_not_called()
+        job_id = process_input.get_job_id("bucket", "key.csv", '"etag"', len(data))
+        self.assertEqual(store.items[job_id],
+                         {"committed_offset": len(data), "rows_count": 10})
+
+    def test_handler_duplicate_invocation_is_skipped(self):
+        data = b"a|b\n1|x\n2|y\n"
+        store = InMemoryCheckpointStore()
+        processed, _ = self.run_handler(data, get_event(), FakeContext([]), store)
+        self.assertEqual(len(processed), 1)
+
+        processed, invoke_lambda = self.run_handler(
+            data, get_event(offset=0), FakeContext([]), store)
+        self.assertEqual(processed, [])
+        invoke_lambda.assert_not_called()
+
+
+    def test_get_newline_bytes(self):
+        self.assertEqual(process_input.get_newline_bytes("utf-8"), b"\n")
+        self.assertEqual(process_input.get_newline_bytes("utf-16"), b"\n\x00")
+        self.assertEqual(process_input.get_newline_bytes("utf-16-be"), b"\x00\n")
+
+    def test_get_file_encoding(self):
+        text = "a|b\n1|ñ\n"
+        for data, expected in [(codecs.BOM_UTF16_BE + text.encode("utf-16-be"), "utf-16-be"),
+                               (codecs.BOM_UTF16_LE + text.encode("utf-16-le"), "utf-16-le"),
+                               (text.encode("utf-16-le"), "utf-16-le"),
+                               (codecs.BOM_UTF32_BE + text.encode("utf-32-be"), "utf-32-be")]:
+            s3_object = FakeS3Object(data)
+            encoding = process_input.get_file_encoding(s3_object, expected[:6])
+            self.assertEqual(encoding, expected)
+            self.assertEqual(len(s3_object.ranges), 1)
+        s3_object = FakeS3Object(b"a|b\n")
+        self.assertEqual(process_input.get_file_encoding(s3_object, "utf-8"), "utf-8")
+        self.assertEqual(s3_object.ranges, [])
+
+    def test_get_byte_ranges(self):
+        lines = ["a|b\n"] + [f"{i}|value_{i}\n" for i in range(100)]
+        data = "".join(lines).encode("utf-8")
+        s3_object = FakeS3Object(data)
+
+        fieldnames, data_offset = process_input.get_header(
+            s3_object, "utf-8", "|")
+        self.assertEqual(fieldnames, ["a", "b"])
+        self.assertEqual(data_offset, 4)
+
+        byte_ranges = process_input.get_byte_ranges(
+            s3_object, data_offset, len(data), 4, "utf-8")
+        self.assertEqual(len(byte_ranges), 4)
+        self.assertEqual(byte_ranges[0][0], data_offset)
+        self.assertEqual(byte_ranges[-1][1], len(data))
+        chunks = [data[start:end].decode("utf-8") for start, end in byte_ranges]
+        self.assertEqual("".join(chunks), "".join(lines[1:]))
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith("\n"))
+
+    def test_get_byte_ranges_utf16(self):
+        text = "a|b\n" + "".join(f"{i}|ñ_{i}\n" for i in range(50))
+        for byte_order in ["le", "be"]:
+            data = codecs.BOM_UTF16_LE if byte_order == "le" else codecs.BOM_UTF16_BE
+            data += text.encode("utf-16-" + byte_order)
+            s3_object = FakeS3Object(data)
+
+            encoding = process_input.get_file_encoding(s3_object, "utf-16")
+            fieldnames, data_offset = process_input.get_header(s3_object, encoding, "|")
+            self.assertEqual(fieldnames, ["a", "b"])
+            byte_ranges = process_input.get_byte_ranges(
+                s3_object, data_offset, len(data), 3, encoding)
+            self.assertEqual(len(byte_ranges), 3)
+            for start, end in byte_ranges:
+                self.assertEqual(start % 2, 0)
+                self.assertTrue(data[start:end].decode(encoding).endswith("\n"))
+
+    def test_object_line_reader_range(self):
+        s3_object = FakeS3Object(b"a\nb\nc\n")
+        lines = process_input.ObjectLineReader(s3_object, 2, "utf-8", 4)
+        self.assertEqual(list(lines), ["b\n"])
+        self.assertEqual(lines.offset, 2)
+        self.assertEqual(s3_object.ranges, ["bytes=2-3"])
+
+    def test_object_line_reader_multibyte(self):
+        text = "a|b\r\n" + "".join(f"{i}|ñ€_{i}\r\n" for i in range(30)) + "last|ñ"
+        for encoding in ["utf-8", "utf-16"]:
+            data = text.encode(encoding)
+            lines = process_input.ObjectLineReader(
+                FakeS3Object(data), 0, encoding, read_size=3)
+            self.assertEqual("".join(lines), text)
+            self.assertEqual(lines.offset, len(data))
+
+    def test_object_line_reader_utf16_range(self):
+        text = "a|b\r\n1|ñ\r\n2|€\r\n"
+        for data in [text.encode("utf-16"), codecs.BOM_UTF16_BE + text.encode("utf-16-be")]:
+            s3_object = FakeS3Object(data)
+            encoding = process_input.get_file_encoding(s3_object, "utf-16")
+            _, data_offset = process_input.get_header(s3_object, encoding, "|")
+            lines = process_input.ObjectLineReader(s3_object, data_offset, encoding)
+            self.assertEqual(list(lines), ["1|ñ\r\n", "2|€\r\n"])
+
+    def test_object_line_reader_utf16_byte_ranges(self):
+        lines = [f"{i}|ñ€_{i}\n" for i in range(40)]
+        text = "a|b\n" + "".join(lines)
+        for byte_order in ["le", "be"]:
+            data = codecs.BOM_UTF16_LE if byte_order == "le" else codecs.BOM_UTF16_BE
+            data += text.encode("utf-16-" + byte_order)
+            s3_object = FakeS3Object(data)
+            encoding = process_input.get_file_encoding(s3_object, "utf-16")
+            _, data_offset = process_input.get_header(s3_object, encoding, "|")
+            byte_ranges = process_input.get_byte_ranges(
+                s3_object, data_offset, len(data), 3, encoding)
+
+            # Odd read sizes split the code units of every range across blocks
+            decoded = []
+            for start, end in byte_ranges:
+                decoded += process_input.ObjectLineReader(
+                    s3_object, start, encoding, end, read_size=5)
+            self.assertEqual(decoded, lines)
+
+    def test_object_line_reader_offset(self):
+        data = b"a|b\n1|x\n2|y\n3|z\n"
+        lines = process_input.ObjectLineReader(
+            FakeS3Object(data), 0, "utf-8", read_size=5)
+        csv_reader = process_input.csv.DictReader(lines, delimiter="|")
+        self.assertEqual(next(csv_reader), {"a": "1", "b": "x"})
+        self.assertEqual(lines.offset, 8)
+        self.assertEqual(data[lines.offset:], b"2|y\n3|z\n")
+
+    def test_dispatch_workers(self):
+        with mock.patch.object(process_input, "invoke_lambda") as invoke_lambda:
+            process_input.dispatch_workers(
+                "function", {"Records": []}, [(4, 10), (10, 20)], ["a", "b"], "utf-8", "|")
+        events = sorted((call.args[1] for call in invoke_lambda.call_args_list),
+                        key=lambda event: event["offset"])
+        self.assertEqual([(event["offset"], event["end_offset"]) for event in events],
+                         [(4, 10), (10, 20)])
+        self.assertEqual(events[0]["fieldnames"], ["a", "b"])
+
+    def test_handler_without_context(self):
+        with mock.patch.object(process_input, "invoke_lambda") as invoke_lambda:
+            process_input.lambda_handler({"Records": []}, None)
+        invoke_lambda.assert_not_called()
+
+    def test_batched_event_is_dispatched_per_record(self):
+        s3_record = get_event()["Records"][0]
+        event = {"Records": [s3_record,
+                             {"messageId": "1", "body": process_input.json.dumps({"Records": [s3_record]})}]}
+        with mock.patch.object(process_input, "invoke_lambda") as invoke_lambda:
+            response = process_input.lambda_handler(event, FakeContext([]))
+        self.assertEqual(invoke_lambda.call_count, 2)
+        for call in invoke_lambda.call_args_list:
+            self.assertEqual(call.args[1], {"Records": [s3_record]})
+        self.assertEqual(response, {"batchItemFailures": []})
+
+    def test_batched_event_reports_failed_dispatches(self):
+        s3_record = get_event()["Records"][0]
+        event = {"Records": [{"messageId": message_id, "body": process_input.json.dumps({"Records": [s3_record]})}
+                             for message_id in ["1", "2", "3"]]}
+        with mock.patch.object(process_input, "invoke_lambda",
+                               side_effect=[None, Exception("throttled"), None]):
+            # One worker keeps the order of the invocations
+            with mock.patch.object(process_input, "MAX_WORKERS", 1):
+                response = process_input.lambda_handler(event, FakeContext([]))
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "2"}]})
+
+        # S3 notifications cannot be reported one by one, the invocation fails
+        with mock.patch.object(process_input, "invoke_lambda", side_effect=Exception("throttled")):
+            with self.assertRaises(Exception):
+                process_input.lambda_handler({"Records": [s3_record, s3_record]}, FakeContext([]))